@@ -0,0 +1 @@
+default_app_config = 'imager_images.apps.ImagerImagesConfig'
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from imager_images.models import Photo, Album
+from imager_images.models import Photo, Album, Job
 
 
 class PhotoAdmin(admin.ModelAdmin):
@@ -14,3 +14,4 @@ class AlbumAdmin(admin.ModelAdmin):
 # Register your models here.
 admin.site.register(Photo)
 admin.site.register(Album)
+admin.site.register(Job)
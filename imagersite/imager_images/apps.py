@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ImagerImagesConfig(AppConfig):
     name = 'imager_images'
+
+    def ready(self):
+        """Connect signal receivers."""
+        from . import signals  # noqa: F401
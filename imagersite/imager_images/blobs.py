@@ -0,0 +1,129 @@
+"""Content-addressed storage of photo originals, shared by reference count."""
+import hashlib
+import os
+from collections import Counter
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from sorl.thumbnail import delete as delete_with_thumbnails
+from .models import ImageBlob
+
+
+def digest_of(upload):
+    """Return an upload's sha256, reusing the one hashed while it streamed in."""
+    digest = getattr(upload, 'sha256', None)
+    if digest:
+        return digest
+    sha = hashlib.sha256()
+    for chunk in upload.chunks():
+        sha.update(chunk)
+    upload.seek(0)
+    return sha.hexdigest()
+
+
+def blob_name(digest, filename):
+    """Storage name for content with a given digest."""
+    extension = os.path.splitext(filename)[1].lower()
+    return 'user_images/{}/{}{}'.format(digest[:2], digest, extension)
+
+
+def save_content(upload, digest):
+    """Put content in storage under its digest unless it is already there.
+
+    Touches storage only, so it is safe to call from worker threads.
+    """
+    name = blob_name(digest, upload.name)
+    if default_storage.exists(name):
+        return name
+    return default_storage.save(name, upload)
+
+
+def acquire_many(entries):
+    """Take one reference per (digest, name, size) entry, in bulk.
+
+    Returns ImageBlob rows keyed by digest. Every stored name other than
+    its blob's own, such as copies that lost a race to save the same
+    content, is deleted so only one copy is kept.
+    """
+    counts = Counter(digest for digest, name, size in entries)
+    details = dict((digest, (name, size)) for digest, name, size in entries)
+    names = set((digest, name) for digest, name, size in entries)
+    with transaction.atomic():
+        existing = dict((blob.sha256, blob) for blob in
+                        ImageBlob.objects.select_for_update()
+                                 .filter(sha256__in=list(counts)))
+        by_count = {}
+        for digest in existing:
+            by_count.setdefault(counts[digest], []).append(digest)
+        for count, digests in by_count.items():
+            (ImageBlob.objects.filter(sha256__in=digests)
+                              .update(refcount=F('refcount') + count))
+        ImageBlob.objects.bulk_create([
+            ImageBlob(sha256=digest, name=details[digest][0],
+                      size=details[digest][1], refcount=counts[digest])
+            for digest in counts if digest not in existing])
+        blobs = dict((blob.sha256, blob) for blob in
+                     ImageBlob.objects.filter(sha256__in=list(counts)))
+    for digest, name in names:
+        if blobs[digest].name != name:
+            default_storage.delete(name)
+    return blobs
+
+
+def acquire(digest, name, size):
+    """Take a reference to the blob for a digest, creating it if new."""
+    try:
+        return acquire_many([(digest, name, size)])[digest]
+    except IntegrityError:
+        # Another upload created the same blob first; take a reference to it.
+        return acquire_many([(digest, name, size)])[digest]
+
+
+def store(upload):
+    """Store an upload content-addressed and return its referenced blob."""
+    digest = digest_of(upload)
+    name = save_content(upload, digest)
+    return acquire(digest, name, upload.size)
+
+
+def attach(photo, upload):
+    """Point a photo at the shared blob for an uploaded file."""
+    blob = store(upload)
+    photo.blob = blob
+    photo.photo = blob.name
+    return blob
+
+
+def adopt(photo):
+    """Move a photo stored under its own name, e.g. a direct upload, to a blob.
+
+    Identical content already stored is shared rather than kept twice.
+    The photo's own file is deleted once the move commits.
+    """
+    old_name = photo.photo.name
+    with transaction.atomic():
+        with default_storage.open(old_name) as original:
+            blob = store(File(original, name=old_name))
+        photo.blob = blob
+        photo.photo = blob.name
+        photo.save(update_fields=['blob', 'photo', 'date_modified'])
+        if old_name != blob.name:
+            transaction.on_commit(lambda: delete_with_thumbnails(old_name))
+    return blob
+
+
+def release(blob_id):
+    """Drop a reference, deleting the blob and its thumbnails at zero."""
+    with transaction.atomic():
+        blob = (ImageBlob.objects.select_for_update()
+                         .filter(id=blob_id).first())
+        if blob is None:
+            return
+        if blob.refcount > 1:
+            blob.refcount = F('refcount') - 1
+            blob.save(update_fields=['refcount'])
+            return
+        name = blob.name
+        blob.delete()
+    delete_with_thumbnails(name)
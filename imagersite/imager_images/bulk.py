@@ -0,0 +1,140 @@
+"""Upload many photos in one go with batched database writes."""
+from collections import OrderedDict
+from functools import reduce
+from multiprocessing.pool import ThreadPool
+from operator import or_
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from PIL import Image
+from taggit.models import Tag, TaggedItem
+from . import blobs, page_cache, postings, search, tag_cloud, thumbnails
+from .models import Photo
+
+
+def max_files():
+    """Most files a single bulk upload may carry."""
+    return getattr(settings, 'IMAGER_BULK_UPLOAD_MAX_FILES', 200)
+
+
+def check_file(upload):
+    """Validate an uploaded image and hash it.
+
+    Returns a (digest, error) pair; either the digest or the error is set.
+    """
+    try:
+        Image.open(upload).verify()
+        upload.seek(0)
+    except Exception:
+        return None, 'Not a valid image.'
+    return blobs.digest_of(upload), None
+
+
+def store_file(digest_and_upload):
+    """Save a checked upload content-addressed.
+
+    Returns a (storage name, error) pair; either the name or the error is
+    set.
+    """
+    digest, upload = digest_and_upload
+    try:
+        return blobs.save_content(upload, digest), None
+    except Exception as error:
+        return None, 'Could not store file: {}'.format(error)
+
+
+def store_files(files, workers):
+    """Check and store files, saving each distinct content only once.
+
+    Returns a (storage name, digest, error) triple per file, in order.
+    Identical files saved side by side would race to the same name and
+    leave numbered copies behind, so only the first of each is saved.
+    """
+    checked = workers.map(check_file, files)
+    firsts = OrderedDict()
+    for upload, (digest, error) in zip(files, checked):
+        if digest:
+            firsts.setdefault(digest, upload)
+    saved = dict(zip(firsts, workers.map(store_file, list(firsts.items()))))
+    stored = []
+    for digest, error in checked:
+        if digest is None:
+            stored.append((None, None, error))
+            continue
+        name, error = saved[digest]
+        stored.append((name, digest if name else None, error))
+    return stored
+
+
+def get_or_create_tags(names):
+    """Return Tag rows for names, creating only the missing ones."""
+    if not names:
+        return []
+    existing = list(Tag.objects.filter(
+        reduce(or_, [Q(name__iexact=name) for name in names])))
+    known = set(tag.name.lower() for tag in existing)
+    for name in names:
+        if name.lower() not in known:
+            existing.append(Tag.objects.create(name=name))
+            known.add(name.lower())
+    return existing
+
+
+def bulk_upload(user, files, published='PV', tags=()):
+    """Store files concurrently and create their photos in bulk.
+
+    Returns one result dict per file, in order, with the created photo or
+    the error that kept the file out.
+    """
+    workers = ThreadPool(getattr(settings, 'IMAGER_BULK_UPLOAD_WORKERS', 8))
+    try:
+        stored = store_files(files, workers)
+    finally:
+        workers.close()
+        workers.join()
+
+    now = timezone.now()
+    ok = [(upload, name, digest) for upload, (name, digest, error)
+          in zip(files, stored) if name]
+    with transaction.atomic():
+        shared = blobs.acquire_many([(digest, name, upload.size)
+                                     for upload, name, digest in ok])
+        created = [Photo(user=user,
+                         title=upload.name.rsplit('.', 1)[0][:100],
+                         published=published,
+                         date_published=now if published == 'PB' else None,
+                         photo=shared[digest].name,
+                         blob=shared[digest])
+                   for upload, name, digest in ok]
+        Photo.objects.bulk_create(created)
+        if created and created[0].pk is None:
+            # Backends that can't return ids from bulk inserts (SQLite)
+            # serialize writers, so the newest ids are the ones just made.
+            ids = (Photo.objects.filter(user=user)
+                                .order_by('-id')
+                                .values_list('id', flat=True)[:len(created)])
+            for photo, pk in zip(created, reversed(list(ids))):
+                photo.pk = pk
+        tag_rows = get_or_create_tags(list(tags))
+        photo_type = ContentType.objects.get_for_model(Photo)
+        TaggedItem.objects.bulk_create([
+            TaggedItem(tag=tag, content_type=photo_type, object_id=photo.id)
+            for photo in created for tag in tag_rows])
+        search.update_photo_vectors([photo.id for photo in created])
+        if published == 'PB':
+            postings.add([tag.id for tag in tag_rows],
+                         [photo.id for photo in created])
+    tag_cloud.invalidate_user(user.id)
+    if created and published == 'PB':
+        page_cache.bump('photos', 'albums', 'user:{}'.format(user.id))
+    thumbnails.enqueue_many(created)
+
+    results = []
+    photos = iter(created)
+    for upload, (name, digest, error) in zip(files, stored):
+        results.append({'name': upload.name,
+                        'photo': next(photos) if name else None,
+                        'error': error})
+    return results
@@ -0,0 +1,46 @@
+"""Precomputed album covers, so album grids need no per-album lookups."""
+from .models import Album, Photo
+from .thumbnails import prefetch_thumbnails
+
+
+def resolve_cover(album):
+    """The photo id an album should display.
+
+    The owner's chosen cover wins; otherwise the album's first public photo.
+    """
+    if album.cover_id is not None:
+        return album.cover_id
+    return (Photo.objects.public()
+                         .filter(albums=album)
+                         .order_by('id')
+                         .values_list('id', flat=True).first())
+
+
+def refresh_covers(album_ids):
+    """Recompute effective_cover for albums, writing only what changed."""
+    albums = (Album.objects.filter(id__in=set(album_ids))
+                           .only('id', 'cover', 'effective_cover'))
+    for album in albums:
+        cover_id = resolve_cover(album)
+        if cover_id != album.effective_cover_id:
+            (Album.objects.filter(id=album.id)
+                          .update(effective_cover_id=cover_id))
+
+
+def albums_for_photo(photo_id):
+    """Ids of the albums holding a photo or showing it as their cover."""
+    held = Album.photos.through.objects.filter(
+        photo_id=photo_id).values_list('album_id', flat=True)
+    shown = Album.objects.filter(
+        effective_cover_id=photo_id).values_list('id', flat=True)
+    return set(held) | set(shown)
+
+
+def prefetch_covers(albums, geometry):
+    """Attach cover thumbnails for a list of albums in one lookup.
+
+    Albums should come from a queryset using select_related('effective_cover').
+    """
+    prefetch_thumbnails([album.effective_cover for album in albums
+                         if album.effective_cover is not None], geometry)
+    return albums
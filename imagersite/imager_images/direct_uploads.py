@@ -0,0 +1,184 @@
+"""Uploads the browser sends straight to storage.
+
+issue() grants the client a short-lived right to write one object under
+the user's direct upload prefix, and finalize() creates the Photo once the
+object has landed. Against S3 the grant is a presigned POST policy for a
+key under MediaStorage.location, capped at the declared size, so the
+bytes never pass through an app server. Any S3-compatible service works,
+e.g. MinIO locally through AWS_S3_ENDPOINT_URL. Processing later moves
+the object into a content-addressed blob, so an image uploaded twice is
+stored once.
+
+Other storages get a signed URL on this site that accepts a PUT of the
+file, standing in for S3 in development and tests.
+"""
+import mimetypes
+import os
+import uuid
+from tempfile import SpooledTemporaryFile
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.urls import reverse
+from taggit.utils import parse_tags
+from . import thumbnails
+from .models import Photo
+from .uploads import COPY_BUFFER, UploadError, copy_stream, max_upload_size
+
+SALT = 'imager_images.direct_uploads'
+
+HEADER_BYTES = 16
+# Leading bytes of the image formats browsers display.
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+class DirectUploadError(Exception):
+    """A direct upload could not be granted or finalized."""
+
+
+def expires_in():
+    """Seconds a grant stays valid."""
+    return getattr(settings, 'IMAGER_DIRECT_UPLOAD_EXPIRES', 15 * 60)
+
+
+def prefix(user):
+    """Storage prefix holding a user's direct uploads."""
+    return 'direct_uploads/{}/'.format(user.id)
+
+
+def upload_name(user, filename, storage=default_storage):
+    """A fresh storage name for a user's file."""
+    return '{}{}/{}'.format(prefix(user), uuid.uuid4().hex,
+                            storage.get_valid_name(os.path.basename(filename)))
+
+
+def is_s3(storage):
+    """Whether a storage writes to an S3 bucket."""
+    return hasattr(storage, 'bucket_name')
+
+
+def s3_key(storage, name):
+    """The bucket key a storage name is written to."""
+    return storage._encode_name(
+        storage._normalize_name(storage._clean_name(name)))
+
+
+def sniff(header):
+    """The image type a file's leading bytes announce, or None."""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in SIGNATURES:
+        if header.startswith(signature):
+            return content_type
+    return None
+
+
+def read_header(storage, name):
+    """An object's stored content type and first HEADER_BYTES bytes.
+
+    Against S3 only those bytes are fetched, with a ranged GET. Other
+    storages keep no content type, so it is guessed from the name.
+    """
+    if is_s3(storage):
+        response = storage.bucket.Object(s3_key(storage, name)).get(
+            Range='bytes=0-{}'.format(HEADER_BYTES - 1))
+        return response['ContentType'], response['Body'].read()
+    with storage.open(name) as stored:
+        return mimetypes.guess_type(name)[0] or '', stored.read(HEADER_BYTES)
+
+
+def issue(user, filename, content_type, size, storage=default_storage):
+    """Grant a user the right to upload one image of at most size bytes.
+
+    Returns the storage name to finalize and how to send the file: an
+    HTTP method, a URL, form fields to POST along with it (S3) and
+    headers to send (the local stand-in's PUT).
+    """
+    if not filename or not 0 < size <= max_upload_size():
+        raise DirectUploadError('Invalid filename or size.')
+    if not content_type.startswith('image/'):
+        raise DirectUploadError('Only images can be uploaded.')
+    name = upload_name(user, filename, storage)
+    if is_s3(storage):
+        post = storage.connection.meta.client.generate_presigned_post(
+            storage.bucket_name, s3_key(storage, name),
+            Fields={'acl': storage.default_acl, 'Content-Type': content_type},
+            Conditions=[{'acl': storage.default_acl},
+                        {'Content-Type': content_type},
+                        ['content-length-range', 1, size]],
+            ExpiresIn=expires_in())
+        return {'name': name, 'method': 'POST', 'url': post['url'],
+                'fields': post['fields'], 'headers': {}}
+    token = signing.dumps({'name': name, 'size': size}, salt=SALT)
+    return {'name': name,
+            'method': 'PUT',
+            'url': reverse('direct_upload_put', kwargs={'token': token}),
+            'fields': {},
+            'headers': {'Content-Type': content_type}}
+
+
+def receive(token, stream, length, storage=default_storage):
+    """Store a file PUT to a local grant URL; returns its storage name."""
+    try:
+        grant = signing.loads(token, salt=SALT, max_age=expires_in())
+    except signing.BadSignature:
+        raise DirectUploadError('Upload grant is invalid or has expired.')
+    if not 0 < length <= grant['size']:
+        raise DirectUploadError('Upload is larger than granted.')
+    if storage.exists(grant['name']):
+        raise DirectUploadError('Upload grant was already used.')
+    with SpooledTemporaryFile(max_size=COPY_BUFFER * 16) as spool:
+        try:
+            copy_stream(stream, spool, length)
+        except UploadError as error:
+            raise DirectUploadError(str(error))
+        spool.seek(0)
+        content = File(spool, name=os.path.basename(grant['name']))
+        content.size = length
+        return storage.save(grant['name'], content)
+
+
+def finalize(user, name, title='', description='', published='PV', tags='',
+             storage=default_storage):
+    """Create the Photo for an uploaded object and queue its processing.
+
+    Only the object's size, content type and leading bytes are checked
+    here, so finalizing stays cheap; the image itself is decoded by the
+    background processing.
+    """
+    if published not in dict(Photo.PUBLISHED_STATUS):
+        raise DirectUploadError('Invalid published status.')
+    if not name.startswith(prefix(user)) or '..' in name:
+        raise DirectUploadError('Not one of your uploads.')
+    if not storage.exists(name):
+        raise DirectUploadError('Nothing has been uploaded yet.')
+    if Photo.objects.filter(photo=name).exists():
+        raise DirectUploadError('Upload was already finalized.')
+    if storage.size(name) > max_upload_size():
+        storage.delete(name)
+        raise DirectUploadError('Upload is too large.')
+    content_type, header = read_header(storage, name)
+    if not content_type.startswith('image/') or sniff(header) is None:
+        storage.delete(name)
+        raise DirectUploadError('Upload is not an image.')
+    with transaction.atomic():
+        # Finalizes of one user's uploads take turns on their row, so two
+        # racing requests cannot both turn the object into a photo.
+        list(User.objects.select_for_update().filter(pk=user.pk))
+        if Photo.objects.filter(photo=name).exists():
+            raise DirectUploadError('Upload was already finalized.')
+        photo = Photo(user=user, title=title, description=description,
+                      published=published)
+        photo.photo.name = name
+        photo.save()
+        photo.tags.add(*parse_tags(tags))
+        thumbnails.enqueue(photo)
+    return photo
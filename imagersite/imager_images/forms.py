@@ -0,0 +1,14 @@
+"""Forms for image related views."""
+from django import forms
+from taggit.forms import TagField
+from .models import Photo
+
+
+class BulkPhotoForm(forms.Form):
+    """Upload many photos at once with shared settings."""
+
+    photos = forms.FileField(
+        widget=forms.ClearableFileInput(attrs={'multiple': True}))
+    published = forms.ChoiceField(choices=Photo.PUBLISHED_STATUS,
+                                  initial='PV')
+    tags = TagField(required=False)
@@ -0,0 +1,210 @@
+"""A database-backed queue for background work.
+
+enqueue() writes a Job row in the caller's transaction, so workers only
+see a job once the rows it needs have committed, and a queued job
+survives the web process that queued it. A task is the dotted path of a
+function called with the job's JSON arguments.
+
+Jobs carry an idempotency key. Enqueueing a key that is already queued
+does nothing; a key whose job has finished is queued again. A running
+job is left to its worker and marked to run once more when it finishes,
+so it never runs twice at the same time.
+
+The run_jobs command starts worker processes. Each claims a ready job
+with a conditional UPDATE, so two workers never take the same job and
+no database-specific row locking is needed. A failing job is retried
+with exponential backoff and jitter until max_attempts, then kept as
+failed with its traceback; one raising PermanentError fails at once.
+
+A job left running by a dead worker is claimed again after
+IMAGER_JOB_TIMEOUT seconds. The lost run counts as an attempt, so a job
+that keeps killing its worker fails at max_attempts.
+"""
+import json
+import logging
+import random
+import time
+import traceback
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = 'QU', 'RN', 'DN', 'FL'
+
+
+class PermanentError(Exception):
+    """A job failure that retrying cannot fix."""
+
+
+def max_attempts():
+    """Attempts a job gets before it is marked failed."""
+    return getattr(settings, 'IMAGER_JOB_MAX_ATTEMPTS', 5)
+
+
+def timeout():
+    """Seconds after which a running job is presumed abandoned."""
+    return getattr(settings, 'IMAGER_JOB_TIMEOUT', 15 * 60)
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that failed attempts times."""
+    delay = min(getattr(settings, 'IMAGER_JOB_BACKOFF_MAX', 60 * 60),
+                getattr(settings, 'IMAGER_JOB_BACKOFF', 10) *
+                2 ** (attempts - 1))
+    # Jitter spreads out retries of jobs that failed together.
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def fresh(now):
+    """Field values that queue a job to run from its first attempt."""
+    return dict(status=QUEUED, attempts=0, max_attempts=max_attempts(),
+                run_at=now, last_error='', rerun=False, date_finished=None)
+
+
+def enqueue(task, args=(), key=None):
+    """Queue task(*args) under an idempotency key and return the key."""
+    key = key or uuid.uuid4().hex
+    enqueue_many(task, [(key, args)])
+    return key
+
+
+def enqueue_many(task, calls):
+    """Queue task once for each (key, args) pair in a few queries."""
+    calls = dict((key, json.dumps(list(args))) for key, args in calls)
+    if not calls:
+        return
+    now = timezone.now()
+    existing = dict(Job.objects.filter(key__in=list(calls))
+                               .values_list('key', 'status'))
+    new = [Job(task=task, key=key, args=args, max_attempts=max_attempts(),
+               run_at=now)
+           for key, args in calls.items() if key not in existing]
+    try:
+        with transaction.atomic():
+            Job.objects.bulk_create(new)
+    except IntegrityError:
+        # Another process queued some of the same keys first.
+        for job in new:
+            try:
+                with transaction.atomic():
+                    job.save()
+            except IntegrityError:
+                pass
+    for key, status in existing.items():
+        if status == QUEUED:
+            continue
+        # The worker running the job already read its arguments.
+        if (status == RUNNING and
+                Job.objects.filter(key=key, status=RUNNING)
+                           .update(task=task, args=calls[key], rerun=True)):
+            continue
+        (Job.objects.filter(key=key)
+                    .exclude(status__in=[QUEUED, RUNNING])
+                    .update(task=task, args=calls[key], **fresh(now)))
+
+
+def fail_abandoned(now):
+    """Fail abandoned jobs whose lost run was their last attempt.
+
+    One whose key was queued again while it ran is queued afresh instead.
+    """
+    abandoned = Job.objects.filter(
+        status=RUNNING, attempts__gte=F('max_attempts'),
+        locked_at__lt=now - timedelta(seconds=timeout()))
+    abandoned.filter(rerun=True).update(**fresh(now))
+    abandoned.update(status=FAILED, date_finished=now,
+                     last_error='The worker running the job stopped.')
+
+
+def claim(worker):
+    """Take the oldest ready job for worker, or None if there is none."""
+    now = timezone.now()
+    fail_abandoned(now)
+    claimable = (Q(status=QUEUED, run_at__lte=now) |
+                 Q(status=RUNNING, locked_at__lt=now - timedelta(
+                     seconds=timeout())))
+    ready = (Job.objects.filter(claimable)
+                        .order_by('run_at', 'id')
+                        .values_list('id', flat=True)[:10])
+    for job_id in ready:
+        # Only one worker's UPDATE can still match; the rest move on.
+        if (Job.objects.filter(claimable, id=job_id)
+                       .update(status=RUNNING, locked_by=worker,
+                               locked_at=now,
+                               attempts=F('attempts') + 1)):
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def finish(mine, **fields):
+    """Record how a run went, or queue the job afresh if it was queued again.
+
+    Only enqueue_many() sets rerun, and only while the job runs, so if the
+    first UPDATE misses, the job was queued again or is no longer mine.
+    """
+    if not mine.filter(rerun=False).update(**fields):
+        mine.update(**fresh(timezone.now()))
+
+
+def run(job):
+    """Run a claimed job and record how it went; True if it succeeded."""
+    mine = Job.objects.filter(id=job.id, status=RUNNING,
+                              locked_by=job.locked_by)
+    try:
+        import_string(job.task)(*json.loads(job.args))
+    except Exception as exception:
+        logger.exception('Job %s (%s) failed on attempt %s',
+                         job.key, job.task, job.attempts)
+        error = traceback.format_exc()
+        if (job.attempts >= job.max_attempts or
+                isinstance(exception, PermanentError)):
+            finish(mine, status=FAILED, last_error=error,
+                   date_finished=timezone.now())
+        else:
+            finish(mine, status=QUEUED, last_error=error,
+                   run_at=timezone.now() + timedelta(
+                       seconds=backoff(job.attempts)))
+        return False
+    finish(mine, status=DONE, last_error='', date_finished=timezone.now())
+    return True
+
+
+def release_connections():
+    """Drop broken or expired connections between jobs, as requests do.
+
+    Skipped inside a transaction, which only tests run workers in.
+    """
+    if not transaction.get_connection().in_atomic_block:
+        close_old_connections()
+
+
+def work(worker, stop=None, burst=False, poll=None):
+    """Run jobs until stop is set, or until none are ready when bursting.
+
+    Returns how many jobs were run.
+    """
+    if poll is None:
+        poll = getattr(settings, 'IMAGER_JOB_POLL_INTERVAL', 1.0)
+    ran = 0
+    while stop is None or not stop.is_set():
+        job = claim(worker)
+        if job is None:
+            release_connections()
+            if burst:
+                break
+            if stop is None:
+                time.sleep(poll)
+            else:
+                stop.wait(poll)
+            continue
+        run(job)
+        ran += 1
+        release_connections()
+    return ran
@@ -0,0 +1,97 @@
+"""Compare request latency with fresh, persistent and pooled connections."""
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.utils import load_backend
+from imager_images.models import Photo
+
+POSTGRES_ENGINE = 'django.db.backends.postgresql'
+POOL_ENGINE = 'imagersite.postgresql_pool'
+
+
+def percentile(timings, fraction):
+    """The value at a fraction of the way through sorted timings."""
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def mode_settings(base, mode, pool_size):
+    """DATABASES entry for a connection mode."""
+    settings_dict = dict(base)
+    if mode == 'pooled':
+        settings_dict['ENGINE'] = POOL_ENGINE
+        settings_dict['CONN_MAX_AGE'] = 0
+        settings_dict['POOL'] = dict(base.get('POOL') or {},
+                                     MAX_SIZE=pool_size)
+    else:
+        settings_dict['ENGINE'] = POSTGRES_ENGINE
+        settings_dict['CONN_MAX_AGE'] = None if mode == 'persistent' else 0
+    return settings_dict
+
+
+def simulate_requests(settings_dict, requests, sql, params, timings):
+    """Run short queries as a request thread would, timing each request.
+
+    Every mode but 'persistent' closes the connection when a request ends,
+    just as Django does with CONN_MAX_AGE = 0.
+    """
+    wrapper = load_backend(settings_dict['ENGINE']).DatabaseWrapper(
+        settings_dict, 'benchmark')
+    try:
+        for _ in range(requests):
+            start = time.time()
+            with wrapper.cursor() as cursor:
+                cursor.execute(sql, params)
+                cursor.fetchall()
+            if settings_dict['CONN_MAX_AGE'] is not None:
+                wrapper.close()
+            timings.append((time.time() - start) * 1000)
+    finally:
+        wrapper.close()
+
+
+class Command(BaseCommand):
+    """Load the database from many threads in each connection mode."""
+
+    help = ('Measure p50/p99 request latency against PostgreSQL with a new '
+            'connection per request, persistent connections and the pool.')
+
+    def add_arguments(self, parser):
+        """Load shape options."""
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Requests per thread.')
+        parser.add_argument('--pool-size', type=int, default=None,
+                            help='Pool size; defaults to --threads.')
+        parser.add_argument('--modes', default='new,persistent,pooled')
+
+    def handle(self, *args, **options):
+        """Run each mode and print its latency distribution."""
+        if connection.vendor != 'postgresql':
+            raise CommandError('benchmark_connections needs PostgreSQL; '
+                               'the default database is {}.'.format(
+                                   connection.vendor))
+        sql = ('SELECT id FROM {} WHERE published = %s '
+               'ORDER BY date_published DESC, id DESC LIMIT 24'
+               .format(Photo._meta.db_table))
+        pool_size = options['pool_size'] or options['threads']
+        for mode in options['modes'].split(','):
+            settings_dict = mode_settings(connection.settings_dict, mode,
+                                          pool_size)
+            timings = []
+            threads = [threading.Thread(
+                target=simulate_requests,
+                args=(settings_dict, options['requests'], sql, ['PB'],
+                      timings))
+                for _ in range(options['threads'])]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+            timings.sort()
+            self.stdout.write(
+                '{:<12} p50 {:8.2f} ms   p99 {:8.2f} ms   {:8.1f} req/s'.format(
+                    mode, percentile(timings, 0.5), percentile(timings, 0.99),
+                    len(timings) / elapsed))
@@ -0,0 +1,64 @@
+"""Compare serial and concurrent transfers against the S3 media storage."""
+import os
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from imager_images.direct_uploads import is_s3
+from imager_images.management.commands.benchmark_connections import percentile
+
+
+class Command(BaseCommand):
+    """Upload, download and delete files one at a time, then from a pool.
+
+    Point AWS_S3_ENDPOINT_URL at a local S3-compatible server such as
+    MinIO to benchmark without touching a real bucket.
+    """
+
+    help = ('Measure S3 upload and download throughput serially and with '
+            'concurrent workers on the shared client.')
+
+    def add_arguments(self, parser):
+        """Workload options."""
+        parser.add_argument('--files', type=int, default=200)
+        parser.add_argument('--size', type=int, default=256 * 1024,
+                            help='Bytes per file.')
+        parser.add_argument('--workers', type=int, default=16)
+
+    def handle(self, *args, **options):
+        """Run each pass and print its throughput."""
+        if not is_s3(default_storage):
+            raise CommandError('benchmark_storage needs the S3 media storage; '
+                               'the default storage is {}.'.format(
+                                   type(default_storage._wrapped).__name__))
+        payload = os.urandom(options['size'])
+        prefix = 'benchmark_storage/{}/'.format(uuid.uuid4().hex)
+        names = ['{}{}.bin'.format(prefix, i) for i in range(options['files'])]
+        for workers in (1, options['workers']):
+            self.measure(workers, 'upload', names, lambda name:
+                         default_storage.save(name, ContentFile(payload)))
+            self.measure(workers, 'download', names, lambda name:
+                         default_storage.open(name).read())
+            self.measure(workers, 'delete', names, default_storage.delete)
+
+    def measure(self, workers, operation, names, run):
+        """Run an operation on every name from a pool of workers."""
+        def timed(name):
+            start = time.time()
+            run(name)
+            return (time.time() - start) * 1000
+        pool = ThreadPool(workers)
+        try:
+            start = time.time()
+            timings = sorted(pool.map(timed, names))
+            elapsed = time.time() - start
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write(
+            '{:<8} {:>3} workers   p50 {:8.2f} ms   p99 {:8.2f} ms   '
+            '{:8.1f} files/s'.format(
+                operation, workers, percentile(timings, 0.5),
+                percentile(timings, 0.99), len(timings) / elapsed))
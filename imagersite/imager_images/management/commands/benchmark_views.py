@@ -0,0 +1,169 @@
+"""Seed a large dataset and report query plans and latency per view."""
+import random
+import time
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from taggit.models import Tag, TaggedItem
+from imager_images import postings
+from imagersite import metrics
+from imager_images.models import Photo, Album
+from imager_profile.views import publish_counts
+
+# The listing indexes from 0003 and 0004. The partial ones are missing on
+# SQLite once a table rebuild has dropped them, hence IF EXISTS below.
+ACCESS_PATTERN_INDEXES = [
+    'photo_published_date_idx',
+    'album_published_date_idx',
+    'photo_user_published_idx',
+    'album_user_published_idx',
+    'photo_public_user_date_idx',
+    'album_public_user_date_idx',
+]
+
+
+def photo_urls(photos):
+    """Build the URL of every photo, as a listing template would."""
+    return [photo.photo.url for photo in photos]
+
+
+def view_queries(user, slug):
+    """Return (name, callable) pairs for the work each view does."""
+    newest = ('-date_published', '-id')
+    return [
+        ('photos', lambda: photo_urls(Photo.objects.filter(published='PB')
+                                      .order_by(*newest)[:24])),
+        ('albums', lambda: list(Album.objects.filter(published='PB')
+                                .order_by(*newest)[:24])),
+        ('tagged_images', lambda: photo_urls(Photo.objects
+                                             .filter(id__in=postings.photo_ids(
+                                                 slug)[-24:],
+                                                 published='PB'))),
+        ('library', lambda: (list(Photo.objects.filter(user=user)),
+                             list(Album.objects.filter(user=user)))),
+        ('public_profile', lambda: (photo_urls(Photo.objects
+                                               .filter(user=user,
+                                                       published='PB')
+                                               .order_by(*newest)),
+                                    list(Album.objects
+                                         .filter(user=user, published='PB')
+                                         .order_by(*newest)))),
+        ('profile', lambda: (publish_counts(Photo.objects.filter(user=user)),
+                             publish_counts(Album.objects.filter(user=user)))),
+    ]
+
+
+def explain(sql, params):
+    """Return the database's query plan for a statement."""
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [' '.join(str(col) for col in row) for row in cursor.fetchall()]
+
+
+class Command(BaseCommand):
+    """Benchmark the gallery view queries against a seeded dataset.
+
+    Everything runs inside a transaction that is rolled back, so the
+    database is left untouched. Pass --drop-indexes to measure without the
+    access pattern indexes and compare against a normal run.
+    """
+
+    help = 'Seed photos and albums, then time and explain each view query.'
+
+    def add_arguments(self, parser):
+        """Dataset size and measurement options."""
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--photos', type=int, default=100000)
+        parser.add_argument('--runs', type=int, default=20)
+        parser.add_argument('--drop-indexes', action='store_true')
+        parser.add_argument('--no-plans', action='store_true')
+
+    def handle(self, *args, **options):
+        """Seed, measure and roll everything back."""
+        with transaction.atomic():
+            if options['drop_indexes']:
+                with connection.cursor() as cursor:
+                    for name in ACCESS_PATTERN_INDEXES:
+                        cursor.execute('DROP INDEX IF EXISTS {}'.format(name))
+            user, slug = self.seed(options['users'], options['photos'])
+            for name, run in view_queries(user, slug):
+                self.measure(name, run, options['runs'], not options['no_plans'])
+            transaction.set_rollback(True)
+
+    def seed(self, user_count, photo_count):
+        """Bulk insert users, photos, albums and tags."""
+        self.stdout.write('Seeding {} users and {} photos...'.format(
+            user_count, photo_count))
+        User.objects.bulk_create(
+            [User(username='benchmark{}'.format(i)) for i in range(user_count)])
+        user_ids = list(User.objects.filter(username__startswith='benchmark')
+                        .values_list('id', flat=True))
+        now = timezone.now()
+        statuses = ['PB', 'PB', 'PV', 'SH']
+        batch = []
+        for i in range(photo_count):
+            published = random.choice(statuses)
+            batch.append(Photo(
+                title='Benchmark {}'.format(i),
+                photo='user_images/benchmark-{}.jpg'.format(i),
+                user_id=random.choice(user_ids),
+                published=published,
+                date_published=(now - timedelta(minutes=i)
+                                if published == 'PB' else None)))
+            if len(batch) == 5000:
+                Photo.objects.bulk_create(batch)
+                batch = []
+        Photo.objects.bulk_create(batch)
+        Album.objects.bulk_create(
+            [Album(title='Benchmark {}'.format(i),
+                   user_id=random.choice(user_ids),
+                   published=random.choice(statuses),
+                   date_published=now - timedelta(minutes=i))
+             for i in range(photo_count // 10)])
+        tags = [Tag.objects.create(name='benchmark-{}'.format(i),
+                                   slug='benchmark-{}'.format(i))
+                for i in range(50)]
+        photo_type = ContentType.objects.get_for_model(Photo)
+        photo_ids = (Photo.objects.filter(title__startswith='Benchmark')
+                     .values_list('id', flat=True))
+        TaggedItem.objects.bulk_create(
+            [TaggedItem(tag=random.choice(tags), content_type=photo_type,
+                        object_id=photo_id)
+             for photo_id in photo_ids if photo_id % 3 == 0])
+        postings.rebuild([tag.id for tag in tags])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        return User.objects.get(id=random.choice(user_ids)), tags[0].slug
+
+    def measure(self, name, run, runs, show_plans):
+        """Time a view's queries and print their plans."""
+        run()
+        timings = []
+        for i in range(runs):
+            start = time.time()
+            with metrics.collect() as collected:
+                run()
+            timings.append((time.time() - start) * 1000)
+        timings.sort()
+        self.stdout.write('{:<16} p50 {:8.2f} ms   p95 {:8.2f} ms   '
+                          '{} storage calls'.format(
+                              name, timings[len(timings) // 2],
+                              timings[min(len(timings) - 1,
+                                          int(len(timings) * 0.95))],
+                              collected.storage_calls))
+        if not show_plans:
+            return
+        start = len(connection.queries_log)
+        with_logging = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        try:
+            run()
+        finally:
+            connection.force_debug_cursor = with_logging
+        for query in list(connection.queries_log)[start:]:
+            for line in explain(query['sql'], None):
+                self.stdout.write('    ' + line)
@@ -0,0 +1,21 @@
+"""Clean up chunked uploads that were started but never finished."""
+from django.core.management.base import BaseCommand
+from imager_images.uploads import expire_uploads
+
+
+class Command(BaseCommand):
+    """Abort idle uploads and remove the parts they left behind.
+
+    Run it from cron; uploads idle longer than IMAGER_UPLOAD_EXPIRES
+    seconds are discarded.
+    """
+
+    help = ('Abort chunked uploads left idle past IMAGER_UPLOAD_EXPIRES and '
+            'remove their partial files or multipart uploads.')
+
+    def handle(self, *args, **options):
+        """Expire uploads and report what was removed."""
+        aborted, deleted, orphans = expire_uploads()
+        self.stdout.write(
+            'Aborted {} uploads, deleted {} finished uploads, removed {} '
+            'orphaned parts'.format(aborted, deleted, orphans))
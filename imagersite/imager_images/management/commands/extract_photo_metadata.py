@@ -0,0 +1,34 @@
+"""Backfill EXIF metadata and upright originals for existing photos."""
+from django.core.management.base import BaseCommand
+from imager_images import jobs
+from imager_images.models import Photo
+from imager_images.thumbnails import INGEST_TASK
+
+
+class Command(BaseCommand):
+    """Queue a metadata job for each photo, for the run_jobs workers."""
+
+    help = ('Read EXIF metadata for existing photos and rotate their '
+            'originals upright, through the job queue.')
+
+    def add_arguments(self, parser):
+        """Batching and scope options."""
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--all', action='store_true', dest='reread',
+                            help='Reread photos that already have metadata.')
+
+    def handle(self, *args, **options):
+        """Queue jobs in batches so no single insert grows too large."""
+        photos = (Photo.objects
+                  .exclude(photo__isnull=True)
+                  .exclude(photo='')
+                  .order_by('id'))
+        if not options['reread']:
+            photos = photos.filter(width__isnull=True)
+        photo_ids = list(photos.values_list('id', flat=True))
+        size = options['batch_size']
+        for i in range(0, len(photo_ids), size):
+            jobs.enqueue_many(INGEST_TASK, [
+                ('ingest_photo:{}'.format(photo_id), [photo_id])
+                for photo_id in photo_ids[i:i + size]])
+        self.stdout.write('Queued {} photos'.format(len(photo_ids)))
@@ -0,0 +1,67 @@
+"""Backfill perceptual hashes for existing photos."""
+from multiprocessing import Pool
+from django.core.management.base import BaseCommand
+from django.db import connections
+from imager_images.models import Photo, PhotoHash
+from imager_images.similarity import build_hash, hash_file
+
+
+def hash_batch(batch):
+    """Hash a batch of (photo id, file name) pairs without touching the db."""
+    hashed = []
+    failed = []
+    for photo_id, name in batch:
+        try:
+            hashed.append((photo_id, hash_file(name)))
+        except Exception:
+            failed.append(photo_id)
+    return hashed, failed
+
+
+class Command(BaseCommand):
+    """Decode originals in worker processes and store their hashes."""
+
+    help = 'Compute perceptual hashes for photos, for similarity lookups.'
+
+    def add_arguments(self, parser):
+        """Batching, concurrency and scope options."""
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--all', action='store_true', dest='rehash',
+                            help='Rehash photos that already have a hash.')
+
+    def handle(self, *args, **options):
+        """Split photos into batches and hash them across processes."""
+        photos = (Photo.objects
+                  .exclude(photo__isnull=True)
+                  .exclude(photo='')
+                  .order_by('id'))
+        if not options['rehash']:
+            photos = photos.filter(perceptual_hash__isnull=True)
+        pending = list(photos.values_list('id', 'photo'))
+        size = options['batch_size']
+        batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+        if options['workers'] > 1:
+            # Forked children must not share the parent's db socket.
+            connections.close_all()
+            workers = Pool(options['workers'])
+            results = workers.imap_unordered(hash_batch, batches)
+        else:
+            workers = None
+            results = (hash_batch(batch) for batch in batches)
+        done = 0
+        failed = []
+        for hashed, batch_failed in results:
+            PhotoHash.objects.filter(
+                photo_id__in=[photo_id for photo_id, _ in hashed]).delete()
+            PhotoHash.objects.bulk_create(
+                [build_hash(photo_id, value) for photo_id, value in hashed])
+            done += len(hashed) + len(batch_failed)
+            failed.extend(batch_failed)
+            self.stdout.write('Hashed {}/{} photos'.format(done, len(pending)))
+        if workers is not None:
+            workers.close()
+            workers.join()
+        if failed:
+            self.stderr.write('Failed photo ids: {}'.format(
+                ', '.join(str(photo_id) for photo_id in sorted(failed))))
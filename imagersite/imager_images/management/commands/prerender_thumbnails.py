@@ -0,0 +1,79 @@
+"""Backfill the standard thumbnails for existing photos."""
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from imager_images.models import Photo
+from imager_images.thumbnails import render_photo, render_thumbnails
+from imager_images.variants import render_variants
+
+
+def render_photo_and_variants(photo_id):
+    """Render thumbnails and responsive variants for a photo id."""
+    photo = Photo.objects.filter(id=photo_id).first()
+    if photo is not None:
+        render_thumbnails(photo)
+        render_variants(photo)
+
+
+def render_batch(photo_ids, render=render_photo):
+    """Render thumbnails for a batch of photo ids."""
+    failed = []
+    for photo_id in photo_ids:
+        try:
+            render(photo_id)
+        except Exception:
+            failed.append(photo_id)
+    return len(photo_ids), failed
+
+
+def render_batch_in_thread(photo_ids, render=render_photo):
+    """Render a batch from a pool thread, releasing its db connection."""
+    try:
+        return render_batch(photo_ids, render)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    """Render thumbnails for every photo in parallel batches."""
+
+    help = 'Pre-render the standard thumbnail geometries for existing photos.'
+
+    def add_arguments(self, parser):
+        """Batching and concurrency options."""
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--variants', action='store_true',
+                            help='Also render responsive image variants.')
+
+    def handle(self, *args, **options):
+        """Split photo ids into batches and render them concurrently."""
+        photo_ids = list(Photo.objects
+                         .exclude(photo__isnull=True)
+                         .exclude(photo='')
+                         .order_by('id')
+                         .values_list('id', flat=True))
+        size = options['batch_size']
+        batches = [photo_ids[i:i + size] for i in range(0, len(photo_ids), size)]
+        render = (render_photo_and_variants if options['variants']
+                  else render_photo)
+        if options['workers'] > 1:
+            workers = ThreadPool(options['workers'])
+            results = workers.imap_unordered(
+                partial(render_batch_in_thread, render=render), batches)
+        else:
+            workers = None
+            results = (render_batch(batch, render) for batch in batches)
+        done = 0
+        failed = []
+        for count, batch_failed in results:
+            done += count
+            failed.extend(batch_failed)
+            self.stdout.write('Rendered {}/{} photos'.format(done, len(photo_ids)))
+        if workers is not None:
+            workers.close()
+            workers.join()
+        if failed:
+            self.stderr.write('Failed photo ids: {}'.format(
+                ', '.join(str(photo_id) for photo_id in sorted(failed))))
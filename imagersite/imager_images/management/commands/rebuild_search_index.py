@@ -0,0 +1,29 @@
+"""Recompute the full-text search vectors for every photo and album."""
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from imager_images import search
+from imager_images.models import Album, Photo
+
+
+class Command(BaseCommand):
+    """Rewrite search vectors in id ranges so no lock is held for long."""
+
+    help = 'Rebuild the PostgreSQL search vectors for photos and albums.'
+
+    def add_arguments(self, parser):
+        """Batching options."""
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        """Update each table one id range at a time."""
+        if not search.enabled():
+            raise CommandError('Full-text search vectors need PostgreSQL.')
+        size = options['batch_size']
+        for model, update in ((Photo, search.update_photo_vectors),
+                              (Album, search.update_album_vectors)):
+            highest = model.objects.aggregate(high=Max('id'))['high'] or 0
+            for low in range(0, highest + 1, size):
+                update(low=low, high=low + size - 1)
+                self.stdout.write('{}: indexed ids up to {}'.format(
+                    model._meta.verbose_name_plural,
+                    min(low + size - 1, highest)))
@@ -0,0 +1,26 @@
+"""Recompute the per-tag posting lists and stats of public photos."""
+from django.core.management.base import BaseCommand
+from taggit.models import Tag
+from imager_images import postings, tag_cloud
+
+
+class Command(BaseCommand):
+    """Rebuild posting lists from the tag table."""
+
+    help = ('Rebuild the posting lists behind multi-tag photo listings and '
+            'the popular tag counts, for every tag or the given tag slugs.')
+
+    def add_arguments(self, parser):
+        """Optional tag slugs."""
+        parser.add_argument('slugs', nargs='*')
+
+    def handle(self, *args, **options):
+        """Rebuild and report how many tags have public photos."""
+        tag_ids = None
+        if options['slugs']:
+            tag_ids = list(Tag.objects
+                           .filter(slug__in=options['slugs'])
+                           .values_list('id', flat=True))
+        count = postings.rebuild(tag_ids)
+        tag_cloud.invalidate_popular()
+        self.stdout.write('Rebuilt posting lists for {} tags.'.format(count))
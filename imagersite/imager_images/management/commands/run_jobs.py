@@ -0,0 +1,61 @@
+"""Run background jobs from the database queue in worker processes."""
+import multiprocessing
+import os
+import signal
+import socket
+from django.core.management.base import BaseCommand
+from django.db import connections
+from imager_images import jobs
+
+
+def worker_name(index):
+    """A name for a worker unique across hosts and processes."""
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), index)
+
+
+def run_worker(index, stop, burst, poll):
+    """Work jobs in a child process until told to stop."""
+    # Finish the current job on Ctrl-C or TERM instead of dying mid-way.
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+    jobs.work(worker_name(index), stop=stop, burst=burst, poll=poll)
+
+
+class Command(BaseCommand):
+    """Start worker processes that claim and run queued jobs."""
+
+    help = ('Run queued background jobs, such as photo processing, in '
+            'worker processes.')
+
+    def add_arguments(self, parser):
+        """Worker options."""
+        parser.add_argument('--workers', type=int,
+                            default=multiprocessing.cpu_count(),
+                            help='Worker processes; defaults to one per core.')
+        parser.add_argument('--burst', action='store_true',
+                            help='Exit once no jobs are ready.')
+        parser.add_argument('--poll', type=float, default=None,
+                            help='Seconds to wait when the queue is empty.')
+
+    def handle(self, *args, **options):
+        """Run the workers in this process or in child processes."""
+        if options['workers'] <= 1:
+            ran = jobs.work(worker_name(0), burst=options['burst'],
+                            poll=options['poll'])
+            self.stdout.write('Ran {} jobs'.format(ran))
+            return
+        # Children must open their own connections, not share the parent's.
+        connections.close_all()
+        stop = multiprocessing.Event()
+        workers = [multiprocessing.Process(
+            target=run_worker,
+            args=(i, stop, options['burst'], options['poll']),
+            name='job-worker-{}'.format(i))
+            for i in range(options['workers'])]
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+        for worker in workers:
+            worker.start()
+        self.stdout.write('Started {} workers'.format(len(workers)))
+        for worker in workers:
+            worker.join()
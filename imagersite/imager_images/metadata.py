@@ -0,0 +1,277 @@
+"""Photo metadata read once at ingest, with originals rotated upright.
+
+ingest() runs first in a photo's background processing. It reads the
+original's dimensions and EXIF once: orientation, camera, when it was
+taken and where. The values are stored on the Photo, so templates and
+filters never open the file.
+
+An original whose EXIF orientation asks for a rotation or flip is
+re-encoded upright, with its orientation tag reset, and stored as a new
+blob. Thumbnails, variants and browsers then all see the same upright
+pixels and never rotate it again. Every photo sharing the old blob moves
+to the new one.
+
+EXIF times carry no zone, so they are read in the site's time zone.
+"""
+import os
+import struct
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.six import BytesIO, text_type
+from PIL import Image
+from sorl.thumbnail import delete as delete_with_thumbnails
+from . import blobs
+from .models import ImageBlob, Photo
+
+ORIENTATION = 274
+MAKE = 271
+MODEL = 272
+DATETIME = 306
+DATETIME_ORIGINAL = 36867
+GPS_INFO = 34853
+GPS_LATITUDE_REF, GPS_LATITUDE = 1, 2
+GPS_LONGITUDE_REF, GPS_LONGITUDE = 3, 4
+
+# The transpositions that undo each EXIF orientation.
+UPRIGHT = {
+    2: [Image.FLIP_LEFT_RIGHT],
+    3: [Image.ROTATE_180],
+    4: [Image.FLIP_TOP_BOTTOM],
+    5: [Image.TRANSPOSE],
+    6: [Image.ROTATE_270],
+    7: [Image.TRANSPOSE, Image.ROTATE_180],
+    8: [Image.ROTATE_90],
+}
+
+FIELDS = ['width', 'height', 'taken_at', 'camera_make', 'camera_model',
+          'latitude', 'longitude']
+
+
+class UnreadableImage(Exception):
+    """A photo's original is not an image Pillow can decode."""
+
+
+def raw_exif(image):
+    """An image's EXIF tags by number; empty if it has none or they break."""
+    getexif = getattr(image, '_getexif', None)
+    if getexif is None:
+        return {}
+    try:
+        return getexif() or {}
+    except Exception:
+        return {}
+
+
+def _text(value, max_length=100):
+    """An EXIF string, trimmed of padding."""
+    if isinstance(value, bytes):
+        value = value.decode('latin-1')
+    if not isinstance(value, text_type):
+        return ''
+    return value.replace('\x00', '').strip()[:max_length]
+
+
+def _number(value):
+    """An EXIF rational as a float."""
+    if isinstance(value, tuple) and len(value) == 2:
+        numerator, denominator = value
+        return float(numerator) / denominator if denominator else None
+    try:
+        return float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def parse_datetime(value):
+    """An EXIF 'YYYY:MM:DD HH:MM:SS' time as an aware datetime."""
+    try:
+        taken = datetime.strptime(_text(value)[:19], '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+    return timezone.make_aware(taken) if settings.USE_TZ else taken
+
+
+def parse_coordinate(value, ref, negative):
+    """Degrees, minutes and seconds as signed decimal degrees."""
+    try:
+        parts = [_number(part) for part in value]
+    except TypeError:
+        return None
+    if len(parts) != 3 or None in parts:
+        return None
+    degrees = parts[0] + parts[1] / 60 + parts[2] / 3600
+    return -degrees if _text(ref).upper() == negative else degrees
+
+
+def parse_day(value):
+    """A 'YYYY-MM-DD' query value as a date, or None if it is not one."""
+    try:
+        return parse_date(value or '')
+    except ValueError:
+        return None
+
+
+def _start_of(day):
+    """The first moment of a day in the site's time zone."""
+    start = datetime.combine(day, time())
+    return timezone.make_aware(start) if settings.USE_TZ else start
+
+
+def taken_between(photos, first_day=None, last_day=None):
+    """Photos taken on or between two days, either of which may be open.
+
+    Compares against day boundaries rather than the date of taken_at, so
+    the query can use the (user, taken_at) index.
+    """
+    if first_day:
+        photos = photos.filter(taken_at__gte=_start_of(first_day))
+    if last_day:
+        photos = photos.filter(
+            taken_at__lt=_start_of(last_day + timedelta(days=1)))
+    return photos
+
+
+def read_exif(image):
+    """The metadata of an opened image, as Photo field values."""
+    exif = raw_exif(image)
+    gps = exif.get(GPS_INFO)
+    if not isinstance(gps, dict):
+        gps = {}
+    latitude = parse_coordinate(gps.get(GPS_LATITUDE, ()),
+                                gps.get(GPS_LATITUDE_REF), 'S')
+    longitude = parse_coordinate(gps.get(GPS_LONGITUDE, ()),
+                                 gps.get(GPS_LONGITUDE_REF), 'W')
+    if not (latitude is not None and longitude is not None and
+            -90 <= latitude <= 90 and -180 <= longitude <= 180):
+        latitude = longitude = None
+    orientation = exif.get(ORIENTATION, 1)
+    return {
+        'orientation': orientation if orientation in UPRIGHT else 1,
+        'taken_at': parse_datetime(exif.get(DATETIME_ORIGINAL) or
+                                   exif.get(DATETIME)),
+        'camera_make': _text(exif.get(MAKE)),
+        'camera_model': _text(exif.get(MODEL)),
+        'latitude': latitude,
+        'longitude': longitude,
+    }
+
+
+def reset_orientation(exif):
+    """Raw EXIF bytes with the orientation tag set to upright.
+
+    Returns None if the bytes cannot be patched, so the tag is dropped
+    rather than applied a second time.
+    """
+    if not exif or not exif.startswith(b'Exif\x00\x00'):
+        return None
+    tiff = 6
+    order = {b'II': '<', b'MM': '>'}.get(exif[tiff:tiff + 2])
+    if order is None:
+        return None
+    data = bytearray(exif)
+    try:
+        ifd = tiff + struct.unpack(order + 'I', exif[tiff + 4:tiff + 8])[0]
+        count = struct.unpack(order + 'H', exif[ifd:ifd + 2])[0]
+        for i in range(count):
+            entry = ifd + 2 + 12 * i
+            tag, kind = struct.unpack(order + 'HH', exif[entry:entry + 4])
+            if tag == ORIENTATION and kind == 3:
+                struct.pack_into(order + 'H', data, entry + 8, 1)
+    except struct.error:
+        return None
+    return bytes(data)
+
+
+def upright(image, orientation):
+    """Re-encode an image with its orientation applied to the pixels."""
+    turned = image
+    for method in UPRIGHT[orientation]:
+        turned = turned.transpose(method)
+    options = {}
+    if image.info.get('icc_profile'):
+        options['icc_profile'] = image.info['icc_profile']
+    if image.format == 'JPEG':
+        options.update(quality=95, optimize=True)
+        exif = reset_orientation(image.info.get('exif'))
+        if exif:
+            options['exif'] = exif
+    out = BytesIO()
+    turned.save(out, image.format, **options)
+    return turned.size, out.getvalue()
+
+
+def store_upright(content, filename, references):
+    """Store an upright original as a blob holding references refs."""
+    upload = ContentFile(content, name=filename)
+    digest = blobs.digest_of(upload)
+    name = blobs.save_content(upload, digest)
+    return blobs.acquire_many([(digest, name, len(content))] *
+                              references)[digest]
+
+
+def ingest(photo):
+    """Record a photo's metadata, rotating its original upright.
+
+    Returns the other photos whose original was replaced along with it.
+    """
+    if not photo.photo:
+        return []
+    # Pillow reads from the open file; only a rotation decodes the pixels.
+    with default_storage.open(photo.photo.name) as original:
+        try:
+            image = Image.open(original)
+        except (IOError, SyntaxError) as error:
+            raise UnreadableImage(error)
+        values = read_exif(image)
+        orientation = values.pop('orientation')
+        values['width'], values['height'] = image.size
+        photos = [photo]
+        blob = None
+        with transaction.atomic():
+            if orientation != 1 and photo.blob_id is not None:
+                # Photos sharing the blob are ingested in turn. One that
+                # waited finds the first moved it, and everything with it.
+                list(ImageBlob.objects.select_for_update()
+                              .filter(id=photo.blob_id))
+                if not Photo.objects.filter(id=photo.id,
+                                            blob_id=photo.blob_id).exists():
+                    photo.refresh_from_db()
+                    return []
+                photos += list(Photo.objects.filter(blob_id=photo.blob_id)
+                                            .exclude(id=photo.id))
+            if orientation != 1:
+                try:
+                    (values['width'], values['height']), content = upright(
+                        image, orientation)
+                except (IOError, SyntaxError) as error:
+                    raise UnreadableImage(error)
+                blob = store_upright(content,
+                                     os.path.basename(photo.photo.name),
+                                     len(photos))
+            for shared in photos:
+                _record(shared, values, blob)
+    return photos[1:]
+
+
+def _record(photo, values, blob):
+    """Save metadata on a photo, moving it to an upright blob if given."""
+    for field, value in values.items():
+        setattr(photo, field, value)
+    if blob is None:
+        photo.save(update_fields=FIELDS)
+        return
+    old_blob, old_name = photo.blob_id, photo.photo.name
+    photo.blob = blob
+    photo.photo = blob.name
+    # A new modification stamp retires cached cards showing old thumbnails.
+    photo.save(update_fields=FIELDS + ['blob', 'photo', 'date_modified'])
+    # Files cannot be brought back by a rollback, so let go after commit.
+    if old_blob is not None:
+        transaction.on_commit(lambda: blobs.release(old_blob))
+    elif old_name != blob.name:
+        transaction.on_commit(lambda: delete_with_thumbnails(old_name))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 12:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def stamp_published_dates(apps, schema_editor):
+    """Give already-public rows a publish date to sort on."""
+    Photo = apps.get_model('imager_images', 'Photo')
+    Album = apps.get_model('imager_images', 'Album')
+    (Photo.objects.filter(published='PB', date_published__isnull=True)
+                  .update(date_published=F('date_uploaded')))
+    (Album.objects.filter(published='PB', date_published__isnull=True)
+                  .update(date_published=F('date_created')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imager_images', '0002_photo_tags'),
+    ]
+
+    operations = [
+        migrations.RunPython(stamp_published_dates,
+                             migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='album',
+            index=models.Index(fields=['published', '-date_published', '-id'], name='album_published_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['published', '-date_published', '-id'], name='photo_published_date_idx'),
+        ),
+    ]
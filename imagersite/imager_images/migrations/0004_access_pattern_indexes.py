@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 12:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imager_images', '0003_public_listing_order'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='album',
+            index=models.Index(fields=['user', 'published'], name='album_user_published_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['user', 'published'], name='photo_user_published_idx'),
+        ),
+        # Partial indexes covering only public rows. The public profile
+        # page lists one user's public photos and albums newest first
+        # (user_id = %s AND published = 'PB' ORDER BY date_published DESC,
+        # id DESC), which the (user, published) indexes above cannot order.
+        # The site-wide listings are served by 0003's published/date
+        # indexes. Django does not know about these two, so on SQLite they
+        # are lost when a later migration rebuilds the table; PostgreSQL
+        # keeps them.
+        migrations.RunSQL(
+            ['CREATE INDEX photo_public_user_date_idx '
+             'ON imager_images_photo (user_id, date_published DESC, id DESC) '
+             "WHERE published = 'PB'"],
+            ['DROP INDEX photo_public_user_date_idx'],
+        ),
+        migrations.RunSQL(
+            ['CREATE INDEX album_public_user_date_idx '
+             'ON imager_images_album (user_id, date_published DESC, id DESC) '
+             "WHERE published = 'PB'"],
+            ['DROP INDEX album_public_user_date_idx'],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 12:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imager_images', '0006_imageblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoHash',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField()),
+                ('segment_0', models.IntegerField(db_index=True)),
+                ('segment_1', models.IntegerField(db_index=True)),
+                ('segment_2', models.IntegerField(db_index=True)),
+                ('segment_3', models.IntegerField(db_index=True)),
+                ('photo', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='perceptual_hash', to='imager_images.Photo')),
+            ],
+        ),
+    ]
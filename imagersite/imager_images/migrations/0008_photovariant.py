@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 13:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imager_images', '0007_photohash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoVariant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(max_length=10)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('file', models.FileField(max_length=255, upload_to='variants')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('photo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='imager_images.Photo')),
+            ],
+            options={
+                'ordering': ('photo', 'format', 'width'),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='photovariant',
+            unique_together=set([('photo', 'format', 'width')]),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 13:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_effective_covers(apps, schema_editor):
+    """Resolve the cover every existing album should display."""
+    Album = apps.get_model('imager_images', 'Album')
+    Photo = apps.get_model('imager_images', 'Photo')
+    for album in Album.objects.all():
+        cover_id = album.cover_id or (Photo.objects
+                                      .filter(albums=album, published='PB')
+                                      .exclude(photo__isnull=True)
+                                      .exclude(photo='')
+                                      .order_by('id')
+                                      .values_list('id', flat=True).first())
+        if cover_id is not None:
+            (Album.objects.filter(id=album.id)
+                          .update(effective_cover_id=cover_id))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imager_images', '0008_photovariant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='effective_cover',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='imager_images.Photo'),
+        ),
+        migrations.RunPython(fill_effective_covers,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 13:12
+from __future__ import unicode_literals
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+def create_gin_indexes(apps, schema_editor):
+    """Index the search vectors; only PostgreSQL has tsvector and GIN."""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX photo_search_vector_idx ON imager_images_photo '
+        'USING gin (search_vector)')
+    schema_editor.execute(
+        'CREATE INDEX album_search_vector_idx ON imager_images_album '
+        'USING gin (search_vector)')
+
+
+def drop_gin_indexes(apps, schema_editor):
+    """Drop the search vector indexes."""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS photo_search_vector_idx')
+    schema_editor.execute('DROP INDEX IF EXISTS album_search_vector_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imager_images', '0009_album_effective_cover'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_gin_indexes, drop_gin_indexes),
+    ]
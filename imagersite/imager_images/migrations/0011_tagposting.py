@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 13:16
+from __future__ import unicode_literals
+
+import sys
+from array import array
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def encode(ids):
+    """Pack sorted ids as little-endian unsigned 32-bit integers.
+
+    A frozen copy of imager_images.postings.encode, so this migration
+    keeps writing the format it was written for.
+    """
+    packed = array('I', ids)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes() if hasattr(packed, 'tobytes') else packed.tostring()
+
+
+def fill_postings(apps, schema_editor):
+    """Build posting lists for the tags of existing public photos."""
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Photo = apps.get_model('imager_images', 'Photo')
+    TaggedItem = apps.get_model('taggit', 'TaggedItem')
+    TagPosting = apps.get_model('imager_images', 'TagPosting')
+    photo_type = ContentType.objects.filter(app_label='imager_images',
+                                            model='photo').first()
+    if photo_type is None:
+        return
+    public = set(Photo.objects.filter(published='PB')
+                              .values_list('id', flat=True))
+    lists = {}
+    for tag_id, photo_id in (TaggedItem.objects
+                             .filter(content_type_id=photo_type.id)
+                             .values_list('tag_id', 'object_id')):
+        if photo_id in public:
+            lists.setdefault(tag_id, set()).add(photo_id)
+    TagPosting.objects.bulk_create([
+        TagPosting(tag_id=tag_id, count=len(ids), photo_ids=encode(sorted(ids)))
+        for tag_id, ids in lists.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taggit', '0002_auto_20150616_2121'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('imager_images', '0010_search_vectors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagPosting',
+            fields=[
+                ('tag', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='posting', serialize=False, to='taggit.Tag')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('photo_ids', models.BinaryField(default=b'')),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(fill_postings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 13:20
+from __future__ import unicode_literals
+
+import sys
+from array import array
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def decode(data):
+    """Unpack ids written by 0011_tagposting's encode.
+
+    A frozen copy of imager_images.postings.decode.
+    """
+    packed = array('I')
+    data = bytes(data or b'')
+    if hasattr(packed, 'frombytes'):
+        packed.frombytes(data)
+    else:
+        packed.fromstring(data)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return list(packed)
+
+
+def fill_stats(apps, schema_editor):
+    """Count each tag's public photos from its posting list."""
+    Photo = apps.get_model('imager_images', 'Photo')
+    TagPosting = apps.get_model('imager_images', 'TagPosting')
+    TagStat = apps.get_model('imager_images', 'TagStat')
+    published = dict(Photo.objects.filter(published='PB')
+                                  .values_list('id', 'date_published'))
+    stats = []
+    for posting in TagPosting.objects.all():
+        dates = [published[photo_id] for photo_id in decode(posting.photo_ids)
+                 if published.get(photo_id)]
+        stats.append(TagStat(tag_id=posting.tag_id, count=posting.count,
+                             last_used=max(dates) if dates else None))
+    TagStat.objects.bulk_create(stats)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taggit', '0002_auto_20150616_2121'),
+        ('imager_images', '0011_tagposting'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagStat',
+            fields=[
+                ('tag', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stat', serialize=False, to='taggit.Tag')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('last_used', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='tagstat',
+            index=models.Index(fields=['-count', 'tag'], name='tagstat_popular_idx'),
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 14:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imager_images', '0014_photo_metadata'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='photovariant',
+            options={'ordering': ('format', 'width')},
+        ),
+        migrations.AddField(
+            model_name='photovariant',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='imager_images.ImageBlob'),
+        ),
+        migrations.AlterField(
+            model_name='photovariant',
+            name='photo',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='imager_images.Photo'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='photovariant',
+            unique_together=set([('photo', 'format', 'width'), ('blob', 'format', 'width')]),
+        ),
+    ]
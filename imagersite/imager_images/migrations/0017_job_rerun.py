@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 14:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imager_images', '0016_photo_processing_failed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='rerun',
+            field=models.BooleanField(default=False),
+        ),
+    ]
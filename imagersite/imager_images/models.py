@@ -1,10 +1,73 @@
 """."""
+import random
+import uuid
 from django.db import models
+from django.db.models import Max, Min
+from django.db.models.functions import Coalesce, Now
 from django.contrib.auth.models import User
+from django.contrib.postgres.search import SearchVectorField
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from taggit.managers import TaggableManager
+from taggit.models import Tag
 
 
+class PublishedQuerySet(models.QuerySet):
+    """Rows with a publish date, stamped by update() as save() does."""
+
+    def update(self, **kwargs):
+        """Stamp rows made public without a publish date yet."""
+        if kwargs.get('published') == 'PB' and 'date_published' not in kwargs:
+            kwargs['date_published'] = Coalesce('date_published', Now())
+        return super(PublishedQuerySet, self).update(**kwargs)
+
+
+class PhotoManager(models.Manager.from_queryset(PublishedQuerySet)):
+    """Manager with helpers for public photo lookups."""
+
+    def public(self):
+        """Return public photos that have an image attached."""
+        return (self.get_queryset()
+                .filter(published='PB')
+                .exclude(photo__isnull=True)
+                .exclude(photo=''))
+
+    def random_public(self, count=1):
+        """Pick up to count random public photos without a table scan.
+
+        Draws a random pivot between the lowest and highest public id and
+        takes the first public photo at or above it, so each pick is a
+        single indexed lookup no matter how many photos exist.
+        """
+        public = self.public()
+        bounds = public.aggregate(low=Min('id'), high=Max('id'))
+        if bounds['low'] is None:
+            return []
+        picked = {}
+        for _ in range(count * 2):
+            if len(picked) == count:
+                break
+            pivot = random.randint(bounds['low'], bounds['high'])
+            photo = public.filter(id__gte=pivot).order_by('id').first()
+            if photo is not None:
+                picked[photo.id] = photo
+        return list(picked.values())
+
+
+@python_2_unicode_compatible
+class ImageBlob(models.Model):
+    """A stored original, shared by every photo with the same bytes."""
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField(default=0)
+    refcount = models.PositiveIntegerField(default=0)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """Represent."""
+        return "{} ({} refs)".format(self.name, self.refcount)
+
 
 @python_2_unicode_compatible
 class Photo(models.Model):
@@ -35,6 +98,45 @@ class Photo(models.Model):
         upload_to='user_images',
         null=True
     )
+    blob = models.ForeignKey(
+        'ImageBlob',
+        null=True,
+        blank=True,
+        editable=False,
+        on_delete=models.SET_NULL,
+        related_name='photos')
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Read from the original once, when it is processed.
+    width = models.PositiveIntegerField(null=True, editable=False)
+    height = models.PositiveIntegerField(null=True, editable=False)
+    taken_at = models.DateTimeField(null=True, editable=False)
+    camera_make = models.CharField(max_length=100, blank=True, default='',
+                                   editable=False)
+    camera_model = models.CharField(max_length=100, blank=True, default='',
+                                    editable=False)
+    latitude = models.FloatField(null=True, editable=False)
+    longitude = models.FloatField(null=True, editable=False)
+    # Set when the original turns out not to decode; it is not retried.
+    processing_failed = models.BooleanField(default=False, editable=False)
+    objects = PhotoManager()
+
+    class Meta:
+        """Index the listing order, per-user lookups and date taken."""
+
+        indexes = [
+            models.Index(fields=['published', '-date_published', '-id'],
+                         name='photo_published_date_idx'),
+            models.Index(fields=['user', 'published'],
+                         name='photo_user_published_idx'),
+            models.Index(fields=['user', 'taken_at'],
+                         name='photo_user_taken_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """Stamp the publish date the first time a photo goes public."""
+        if self.published == 'PB' and self.date_published is None:
+            self.date_published = timezone.now()
+        super(Photo, self).save(*args, **kwargs)
 
     def __str__(self):
         """Represent."""
@@ -73,7 +175,223 @@ class Album(models.Model):
         null=True,
         blank=True,
         related_name='+')
+    effective_cover = models.ForeignKey(
+        Photo,
+        null=True,
+        blank=True,
+        editable=False,
+        on_delete=models.SET_NULL,
+        related_name='+')
+    search_vector = SearchVectorField(null=True, editable=False)
+    objects = models.Manager.from_queryset(PublishedQuerySet)()
+
+    class Meta:
+        """Index the listing order and per-user lookups."""
+
+        indexes = [
+            models.Index(fields=['published', '-date_published', '-id'],
+                         name='album_published_date_idx'),
+            models.Index(fields=['user', 'published'],
+                         name='album_user_published_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """Stamp the publish date the first time an album goes public."""
+        if self.published == 'PB' and self.date_published is None:
+            self.date_published = timezone.now()
+        super(Album, self).save(*args, **kwargs)
 
     def __str__(self):
         """Represent."""
         return "{}".format(self.title)
+
+
+@python_2_unicode_compatible
+class ChunkedUpload(models.Model):
+    """A resumable upload of a photo original, received in chunks."""
+
+    STATUS = (
+        ('AC', 'active'),
+        ('CG', 'completing'),
+        ('CP', 'complete'),
+        ('AB', 'aborted'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        User,
+        null=False,
+        on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    key = models.CharField(max_length=255)
+    upload_id = models.CharField(max_length=255, blank=True, default='')
+    parts = models.PositiveIntegerField(default=0)
+    status = models.CharField(
+        max_length=2,
+        choices=STATUS,
+        default='AC')
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """Represent."""
+        return "{} ({}/{})".format(self.filename, self.offset, self.size)
+
+
+@python_2_unicode_compatible
+class PhotoHash(models.Model):
+    """A photo's 64-bit perceptual hash, split for multi-index lookups.
+
+    Each 16-bit segment is indexed on its own. Two hashes within d bits
+    of each other have a segment differing in at most d // 4 bits, so
+    candidate matches come from indexed lookups of the values near each
+    segment instead of a scan over every photo.
+    """
+
+    photo = models.OneToOneField(
+        Photo,
+        on_delete=models.CASCADE,
+        related_name='perceptual_hash')
+    value = models.BigIntegerField()
+    segment_0 = models.IntegerField(db_index=True)
+    segment_1 = models.IntegerField(db_index=True)
+    segment_2 = models.IntegerField(db_index=True)
+    segment_3 = models.IntegerField(db_index=True)
+
+    def __str__(self):
+        """Represent."""
+        return "{:016x}".format(self.value & 0xFFFFFFFFFFFFFFFF)
+
+
+@python_2_unicode_compatible
+class PhotoVariant(models.Model):
+    """A resized, re-encoded copy of a photo for responsive images.
+
+    Variants of a shared original belong to its blob, so they are built
+    once for every photo with the same bytes. Only photos stored before
+    blobs have variants of their own.
+    """
+
+    photo = models.ForeignKey(
+        Photo,
+        null=True,
+        on_delete=models.CASCADE,
+        related_name='variants')
+    blob = models.ForeignKey(
+        ImageBlob,
+        null=True,
+        on_delete=models.CASCADE,
+        related_name='variants')
+    format = models.CharField(max_length=10)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    size = models.PositiveIntegerField(default=0)
+    file = models.FileField(upload_to='variants', max_length=255)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        """One file per original, format and width."""
+
+        unique_together = (('photo', 'format', 'width'),
+                           ('blob', 'format', 'width'))
+        ordering = ('format', 'width')
+
+    def __str__(self):
+        """Represent."""
+        return "{} {}w {}".format(self.blob_id or self.photo_id, self.width,
+                                  self.format)
+
+
+@python_2_unicode_compatible
+class TagPosting(models.Model):
+    """The sorted ids of a tag's public photos, packed as 32-bit integers.
+
+    Multi-tag listings intersect or merge these lists instead of joining
+    the generic TaggedItem table once per tag.
+    """
+
+    tag = models.OneToOneField(
+        Tag,
+        primary_key=True,
+        on_delete=models.CASCADE,
+        related_name='posting')
+    count = models.PositiveIntegerField(default=0)
+    photo_ids = models.BinaryField(default=b'')
+    date_modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """Represent."""
+        return "{} ({} photos)".format(self.tag_id, self.count)
+
+
+@python_2_unicode_compatible
+class TagStat(models.Model):
+    """How many public photos carry a tag, and when it was last applied."""
+
+    tag = models.OneToOneField(
+        Tag,
+        primary_key=True,
+        on_delete=models.CASCADE,
+        related_name='stat')
+    count = models.PositiveIntegerField(default=0)
+    last_used = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        """Popular tags are read straight off the count index."""
+
+        indexes = [
+            models.Index(fields=['-count', 'tag'], name='tagstat_popular_idx'),
+        ]
+
+    def __str__(self):
+        """Represent."""
+        return "{} ({} photos)".format(self.tag_id, self.count)
+
+
+@python_2_unicode_compatible
+class Job(models.Model):
+    """A unit of background work, claimed and run by run_jobs workers.
+
+    The key makes enqueueing idempotent: a key names one job, which is
+    queued again, or marked to rerun if it is running, rather than
+    duplicated.
+    """
+
+    STATUS = (
+        ('QU', 'queued'),
+        ('RN', 'running'),
+        ('DN', 'done'),
+        ('FL', 'failed'),
+    )
+
+    task = models.CharField(max_length=255)
+    key = models.CharField(max_length=255, unique=True)
+    args = models.TextField(default='[]')
+    status = models.CharField(
+        max_length=2,
+        choices=STATUS,
+        default='QU')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=255, blank=True, default='')
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    # Set when the key is queued again while the job runs.
+    rerun = models.BooleanField(default=False)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        """Workers look for the oldest ready job by status and time."""
+
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_ready_idx'),
+        ]
+
+    def __str__(self):
+        """Represent."""
+        return "{} {} ({})".format(self.task, self.key,
+                                   self.get_status_display())
@@ -0,0 +1,121 @@
+"""Whole-page caching for anonymous visitors, keyed on version stamps.
+
+Every cached page records the versions of the scopes it was built from,
+e.g. 'photos' for the public photo listing or 'album:12' for one album.
+Signal receivers bump a scope's version when something it shows changes,
+so the next request misses and rebuilds while untouched pages keep
+hitting. Nothing is ever deleted; superseded entries just age out.
+
+A page rebuilt just after a bump is read from the primary, so a lagging
+replica cannot store the old page under the new version.
+"""
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.http import HttpResponse
+from imagersite import db_router, metrics, storage_urls
+
+PAGE_TIMEOUT = 60 * 60
+
+
+def _version_key(scope):
+    """Cache key holding a scope's version."""
+    return 'imager_images:version:{}'.format(scope)
+
+
+def _fresh_version():
+    """A version that cannot repeat one evicted from the cache."""
+    return int(time.time() * 1000)
+
+
+def versions(scopes):
+    """Current versions for scopes, fetched in a single cache round trip."""
+    keys = [_version_key(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    missing = dict((key, _fresh_version()) for key in keys if key not in found)
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    return [found[key] for key in keys]
+
+
+def _changed_names(scopes):
+    """Names under which bumps of scopes are noted for replica routing."""
+    return ['page:{}'.format(scope) for scope in scopes]
+
+
+def _bump(scopes):
+    """Increment the versions of scopes."""
+    db_router.note_changed(_changed_names(scopes))
+    for scope in scopes:
+        key = _version_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_version(), None)
+
+
+def bump(*scopes):
+    """Invalidate every page built from any of the scopes.
+
+    Inside a transaction the versions are bumped again on commit, so a
+    page rendered from pre-commit data in the meantime is not kept.
+    """
+    scopes = set(scopes)
+    _bump(scopes)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: _bump(scopes))
+
+
+def page_key(request, scopes):
+    """Cache key for a request's page at the scopes' current versions."""
+    path = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+    stamp = '.'.join(str(version) for version in versions(scopes))
+    return 'imager_images:page:{}:{}'.format(path, stamp)
+
+
+class PublicPageCacheMixin(object):
+    """Serve a view's rendered page to anonymous visitors from the cache.
+
+    Views list the scopes their output depends on in get_cache_scopes().
+    Logged in users always get a freshly rendered page.
+    """
+
+    def get_cache_scopes(self):
+        """Return the scopes this page is built from, or None to skip."""
+        return []
+
+    def dispatch(self, request, *args, **kwargs):
+        """Return the cached page on a hit, or render and store it."""
+        scopes = None
+        if (request.method in ('GET', 'HEAD') and
+                not request.user.is_authenticated):
+            scopes = self.get_cache_scopes()
+        if scopes is None:
+            return super(PublicPageCacheMixin, self).dispatch(
+                request, *args, **kwargs)
+        key = page_key(request, scopes)
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+        with db_router.primary_if_changed(_changed_names(scopes)):
+            response = super(PublicPageCacheMixin, self).dispatch(
+                request, *args, **kwargs)
+            if response.status_code == 200:
+                timeout = storage_urls.cache_timeout(getattr(
+                    settings, 'IMAGER_PAGE_CACHE_TIMEOUT', PAGE_TIMEOUT))
+
+                def store(rendered):
+                    cache.set(key, (rendered.content,
+                                    rendered['Content-Type']), timeout)
+                if hasattr(response, 'add_post_render_callback'):
+                    response.add_post_render_callback(store)
+                else:
+                    store(response)
+            # Templates query lazily, so render while the routing holds.
+            if hasattr(response, 'render'):
+                metrics.render_response(response)
+        return response
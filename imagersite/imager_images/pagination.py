@@ -0,0 +1,131 @@
+"""Keyset (cursor) pagination for the public listing views."""
+import base64
+import binascii
+from bisect import bisect_left, bisect_right
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(obj):
+    """Encode an object's position in the listing order."""
+    value = '{}|{}'.format(obj.date_published.isoformat(), obj.id)
+    return base64.urlsafe_b64encode(value.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into a (date_published, id) pair."""
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii')
+        date_published, pk = value.split('|')
+        date_published = parse_datetime(date_published)
+        pk = int(pk)
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise Http404('Invalid cursor.')
+    if date_published is None:
+        raise Http404('Invalid cursor.')
+    return date_published, pk
+
+
+class KeysetPage(object):
+    """A page of results with cursors to the neighbouring pages."""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        """Hold the page rows and neighbour cursors."""
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        """Return whether a later page exists."""
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        """Return whether an earlier page exists."""
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        """Return whether any other page exists."""
+        return self.has_next() or self.has_previous()
+
+    def __iter__(self):
+        """Iterate over the page rows."""
+        return iter(self.object_list)
+
+    def __len__(self):
+        """Return the number of rows on the page."""
+        return len(self.object_list)
+
+
+class KeysetPaginationMixin(object):
+    """Paginate a ListView newest-first on (date_published, id).
+
+    Pages are addressed with ?after=<cursor> or ?before=<cursor> instead of
+    page numbers, so every page is an index range scan of page_size rows
+    rather than an OFFSET that grows with depth.
+    """
+
+    paginate_by = 24
+
+    def paginate_queryset(self, queryset, page_size):
+        """Return the page of rows around the requested cursor."""
+        after = self.request.GET.get('after')
+        before = self.request.GET.get('before')
+        # Rows made public behind the models' backs have no position.
+        queryset = queryset.filter(date_published__isnull=False)
+        if before:
+            date_published, pk = decode_cursor(before)
+            rows = list(queryset
+                        .filter(Q(date_published__gt=date_published) |
+                                Q(date_published=date_published, id__gt=pk))
+                        .order_by('date_published', 'id')[:page_size + 1])
+            has_previous = len(rows) > page_size
+            rows = rows[:page_size][::-1]
+            has_next = True
+        else:
+            queryset = queryset.order_by('-date_published', '-id')
+            if after:
+                date_published, pk = decode_cursor(after)
+                queryset = queryset.filter(
+                    Q(date_published__lt=date_published) |
+                    Q(date_published=date_published, id__lt=pk))
+            rows = list(queryset[:page_size + 1])
+            has_next = len(rows) > page_size
+            rows = rows[:page_size]
+            has_previous = bool(after)
+        page = KeysetPage(
+            rows,
+            next_cursor=encode_cursor(rows[-1]) if rows and has_next else None,
+            previous_cursor=(encode_cursor(rows[0])
+                             if rows and has_previous else None))
+        return (None, page, rows, page.has_other_pages())
+
+
+def parse_id_cursor(cursor):
+    """Decode a cursor over an id-ordered listing."""
+    try:
+        return int(cursor)
+    except ValueError:
+        raise Http404('Invalid cursor.')
+
+
+def id_page(ids, page_size, after=None, before=None):
+    """Page through sorted ids newest (highest) first.
+
+    Return the page's ids with the cursors of its neighbours, using the
+    same ?after= / ?before= scheme as KeysetPaginationMixin.
+    """
+    if before:
+        start = bisect_right(ids, parse_id_cursor(before))
+        page = ids[start:start + page_size][::-1]
+        has_previous = start + page_size < len(ids)
+        has_next = True
+    else:
+        end = bisect_left(ids, parse_id_cursor(after)) if after else len(ids)
+        page = ids[max(0, end - page_size):end][::-1]
+        has_next = end > page_size
+        has_previous = bool(after)
+    return KeysetPage(
+        page,
+        next_cursor=str(page[-1]) if page and has_next else None,
+        previous_cursor=str(page[0]) if page and has_previous else None)
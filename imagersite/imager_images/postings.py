@@ -0,0 +1,192 @@
+"""Per-tag posting lists of public photo ids for multi-tag queries.
+
+A tag expression is a comma separated list of alternatives, each a plus
+separated list of slugs that must all match: 'beach+sunset,snow' means
+photos tagged beach and sunset, or tagged snow. Each slug's posting list
+is loaded in one query and combined in memory, so the cost is one query
+however many tags are involved.
+
+Each tag's TagStat row (its public photo count and when it was last
+applied) is written alongside its posting list, in the same transaction.
+"""
+import heapq
+import sys
+from array import array
+from bisect import bisect_left, insort
+from itertools import groupby
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import timezone
+from taggit.models import TaggedItem
+from .models import Photo, TagPosting, TagStat
+
+
+def encode(ids):
+    """Pack sorted ids as little-endian unsigned 32-bit integers."""
+    packed = array('I', ids)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes() if hasattr(packed, 'tobytes') else packed.tostring()
+
+
+def decode(data):
+    """Unpack ids written by encode."""
+    packed = array('I')
+    data = bytes(data or b'')
+    if hasattr(packed, 'frombytes'):
+        packed.frombytes(data)
+    else:
+        packed.fromstring(data)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return list(packed)
+
+
+def intersect(lists):
+    """Ids present in every sorted list, smallest list driving the search."""
+    if not lists:
+        return []
+    lists = sorted(lists, key=len)
+    found = []
+    positions = [0] * len(lists)
+    for value in lists[0]:
+        for i, other in enumerate(lists[1:], 1):
+            positions[i] = bisect_left(other, value, positions[i])
+            if positions[i] == len(other):
+                return found
+            if other[positions[i]] != value:
+                break
+        else:
+            found.append(value)
+    return found
+
+
+def union(lists):
+    """Sorted, distinct ids present in any of the sorted lists."""
+    return [value for value, _ in groupby(heapq.merge(*lists))]
+
+
+def parse(expression):
+    """Split a tag expression into alternatives of required slugs."""
+    return [[slug for slug in group.split('+') if slug]
+            for group in expression.split(',') if group.strip('+')]
+
+
+def photo_ids(expression):
+    """Sorted ids of public photos matching a tag expression."""
+    groups = parse(expression)
+    slugs = set(slug for group in groups for slug in group)
+    if not slugs:
+        return []
+    lists = dict((slug, decode(data)) for slug, data in
+                 TagPosting.objects.filter(tag__slug__in=slugs)
+                                   .values_list('tag__slug', 'photo_ids'))
+    return union([intersect([lists.get(slug, []) for slug in group])
+                  for group in groups])
+
+
+def _photo_type_id():
+    """Content type id for photos."""
+    return ContentType.objects.get_for_model(Photo).id
+
+
+def rebuild(tag_ids=None):
+    """Recompute posting lists and stats from the tag table."""
+    public = Photo.objects.filter(published='PB')
+    items = (TaggedItem.objects
+             .filter(content_type_id=_photo_type_id(),
+                     object_id__in=public.values('id'))
+             .order_by('tag_id', 'object_id')
+             .values_list('tag_id', 'object_id'))
+    stale = TagPosting.objects.all()
+    stats = TagStat.objects.all()
+    if tag_ids is not None:
+        items = items.filter(tag_id__in=tag_ids)
+        stale = stale.filter(tag_id__in=tag_ids)
+        stats = stats.filter(tag_id__in=tag_ids)
+    published = dict(public.values_list('id', 'date_published'))
+    rows, stat_rows = [], []
+    for tag_id, group in groupby(items, key=lambda item: item[0]):
+        ids = sorted(set(object_id for _, object_id in group))
+        rows.append(TagPosting(tag_id=tag_id, count=len(ids),
+                               photo_ids=encode(ids)))
+        dates = [published[photo_id] for photo_id in ids
+                 if published.get(photo_id)]
+        stat_rows.append(TagStat(tag_id=tag_id, count=len(ids),
+                                 last_used=max(dates) if dates else None))
+    with transaction.atomic():
+        last_used = dict(stats.values_list('tag_id', 'last_used'))
+        for stat in stat_rows:
+            stat.last_used = last_used.get(stat.tag_id) or stat.last_used
+        stale.delete()
+        stats.delete()
+        TagPosting.objects.bulk_create(rows)
+        TagStat.objects.bulk_create(stat_rows)
+    return len(rows)
+
+
+def _change(tag_ids, photo_ids_, add):
+    """Add photo ids to, or remove them from, the postings of tags."""
+    tag_ids = set(tag_ids)
+    if not tag_ids or not photo_ids_:
+        return
+    with transaction.atomic():
+        postings = dict((posting.tag_id, posting) for posting in
+                        TagPosting.objects.select_for_update()
+                                          .filter(tag_id__in=tag_ids))
+        for tag_id in tag_ids:
+            posting = postings.get(tag_id)
+            if posting is None:
+                if not add:
+                    continue
+                posting = TagPosting(tag_id=tag_id)
+            ids = decode(posting.photo_ids)
+            changed = False
+            for photo_id in photo_ids_:
+                index = bisect_left(ids, photo_id)
+                present = index < len(ids) and ids[index] == photo_id
+                if add and not present:
+                    insort(ids, photo_id)
+                    changed = True
+                elif not add and present:
+                    del ids[index]
+                    changed = True
+            if not changed:
+                continue
+            _record_stat(tag_id, len(ids), add)
+            if not ids:
+                posting.delete()
+                continue
+            posting.photo_ids = encode(ids)
+            posting.count = len(ids)
+            posting.save()
+
+
+def _record_stat(tag_id, count, used):
+    """Store a tag's public photo count, stamping it when newly used."""
+    values = {'count': count}
+    if used:
+        values['last_used'] = timezone.now()
+    if not TagStat.objects.filter(tag_id=tag_id).update(**values):
+        TagStat.objects.create(tag_id=tag_id, **values)
+
+
+def add(tag_ids, photo_ids_):
+    """Record that public photos carry tags."""
+    _change(tag_ids, photo_ids_, True)
+
+
+def remove(tag_ids, photo_ids_):
+    """Record that photos no longer carry tags, or are no longer public."""
+    _change(tag_ids, photo_ids_, False)
+
+
+def sync_photo(photo):
+    """Bring every posting of a photo's tags in line with its publish status."""
+    tag_ids = (TaggedItem.objects
+               .filter(content_type_id=_photo_type_id(), object_id=photo.id)
+               .values_list('tag_id', flat=True))
+    if photo.published == 'PB':
+        add(tag_ids, [photo.id])
+    else:
+        remove(tag_ids, [photo.id])
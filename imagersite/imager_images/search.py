@@ -0,0 +1,146 @@
+"""Full-text search over photos and albums.
+
+On PostgreSQL each Photo and Album keeps a weighted tsvector in
+search_vector. Titles weigh most, then tag names, then descriptions. The
+vectors are rewritten by a single UPDATE whenever a row, its tags or an
+album's photos change, and queries go through GIN indexes. Other
+databases fall back to case-insensitive substring matching, which is
+fine for development and tests.
+"""
+from functools import reduce
+from operator import and_, or_
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, Q
+from taggit.models import Tag, TaggedItem
+from .models import Album, Photo
+
+DEFAULT_CONFIG = 'english'
+
+PHOTO_VECTOR_SQL = """
+UPDATE {photo} SET search_vector =
+    setweight(to_tsvector(%(config)s::regconfig,
+                          coalesce({photo}.title, '')), 'A') ||
+    setweight(to_tsvector(%(config)s::regconfig, coalesce((
+        SELECT string_agg(tag.name, ' ')
+        FROM {tagged_item} item
+        JOIN {tag} tag ON tag.id = item.tag_id
+        WHERE item.content_type_id = %(content_type)s
+          AND item.object_id = {photo}.id), '')), 'B') ||
+    setweight(to_tsvector(%(config)s::regconfig,
+                          coalesce({photo}.description, '')), 'C')
+WHERE {photo}.id >= %(low)s AND {photo}.id <= %(high)s {ids}
+"""
+
+ALBUM_VECTOR_SQL = """
+UPDATE {album} SET search_vector =
+    setweight(to_tsvector(%(config)s::regconfig,
+                          coalesce({album}.title, '')), 'A') ||
+    setweight(to_tsvector(%(config)s::regconfig, coalesce((
+        SELECT string_agg(DISTINCT tag.name, ' ')
+        FROM {album_photos} member
+        JOIN {photo} photo ON photo.id = member.photo_id
+        JOIN {tagged_item} item ON item.object_id = member.photo_id
+                               AND item.content_type_id = %(content_type)s
+        JOIN {tag} tag ON tag.id = item.tag_id
+        WHERE member.album_id = {album}.id
+          AND photo.published = 'PB'), '')), 'B') ||
+    setweight(to_tsvector(%(config)s::regconfig,
+                          coalesce({album}.description, '')), 'C')
+WHERE {album}.id >= %(low)s AND {album}.id <= %(high)s {ids}
+"""
+
+
+def enabled():
+    """Whether the database supports the tsvector search."""
+    return connection.vendor == 'postgresql'
+
+
+def config():
+    """The text search configuration used for stemming."""
+    return getattr(settings, 'IMAGER_SEARCH_CONFIG', DEFAULT_CONFIG)
+
+
+def _tables():
+    """Table names for the vector SQL."""
+    return {
+        'photo': Photo._meta.db_table,
+        'album': Album._meta.db_table,
+        'album_photos': Album.photos.through._meta.db_table,
+        'tagged_item': TaggedItem._meta.db_table,
+        'tag': Tag._meta.db_table,
+    }
+
+
+def _update(sql, table, ids=None, low=None, high=None):
+    """Run a vector UPDATE for a list of ids or an id range."""
+    if not enabled():
+        return
+    params = {
+        'config': config(),
+        'content_type': ContentType.objects.get_for_model(Photo).id,
+        'low': low if low is not None else 0,
+        'high': high if high is not None else 2 ** 63 - 1,
+    }
+    id_filter = ''
+    if ids is not None:
+        ids = list(ids)
+        if not ids:
+            return
+        params['ids'] = ids
+        id_filter = 'AND {}.id = ANY(%(ids)s)'.format(table)
+    with connection.cursor() as cursor:
+        cursor.execute(sql.format(ids=id_filter, **_tables()), params)
+
+
+def update_photo_vectors(photo_ids=None, low=None, high=None):
+    """Recompute the search vectors of photos by id or id range."""
+    _update(PHOTO_VECTOR_SQL, Photo._meta.db_table, photo_ids, low, high)
+
+
+def update_album_vectors(album_ids=None, low=None, high=None):
+    """Recompute the search vectors of albums by id or id range."""
+    _update(ALBUM_VECTOR_SQL, Album._meta.db_table, album_ids, low, high)
+
+
+def _fallback(queryset, text, fields):
+    """Match every word of text against any of fields, newest first."""
+    words = text.split()
+    return (queryset
+            .filter(reduce(and_, [
+                reduce(or_, [Q(**{field + '__icontains': word})
+                             for field in fields])
+                for word in words]))
+            .distinct()
+            .order_by('-date_published', '-id'))
+
+
+def _ranked(queryset, text):
+    """Filter queryset by a tsquery and order it by rank."""
+    query = SearchQuery(text, config=config())
+    return (queryset
+            .filter(search_vector=query)
+            .annotate(rank=SearchRank(F('search_vector'), query))
+            .order_by('-rank', '-id'))
+
+
+def search_photos(text):
+    """Public photos matching text, best match first."""
+    photos = Photo.objects.public()
+    if not text.strip():
+        return photos.none()
+    if enabled():
+        return _ranked(photos, text)
+    return _fallback(photos, text, ['title', 'description', 'tags__name'])
+
+
+def search_albums(text):
+    """Public albums matching text, best match first."""
+    albums = Album.objects.filter(published='PB')
+    if not text.strip():
+        return albums.none()
+    if enabled():
+        return _ranked(albums, text)
+    return _fallback(albums, text, ['title', 'description'])
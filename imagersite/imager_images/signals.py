@@ -0,0 +1,264 @@
+"""Signal receivers keeping derived image data in sync."""
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_init,
+    post_save,
+    pre_delete
+)
+from django.dispatch import receiver
+from taggit.models import TaggedItem
+from . import blobs, covers, page_cache, postings, search, tag_cloud
+from .models import Photo, Album, PhotoVariant
+
+
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=TaggedItem)
+def tagged_item_changed(sender, instance, **kwargs):
+    """Invalidate tag clouds when a photo gains or loses a tag."""
+    if instance.content_type_id != ContentType.objects.get_for_model(Photo).id:
+        return
+    tag_cloud.invalidate_photo(instance.object_id)
+
+
+@receiver(post_save, sender=Photo)
+@receiver(pre_delete, sender=Photo)
+def photo_changed(sender, instance, **kwargs):
+    """Invalidate tag clouds when a photo is published, hidden or removed."""
+    tag_cloud.invalidate_photo(instance.id, instance.user_id)
+
+
+@receiver(m2m_changed, sender=Album.photos.through)
+def album_photos_changed(sender, instance, action, pk_set, **kwargs):
+    """Invalidate tag clouds when album membership changes."""
+    if isinstance(instance, Album):
+        if action.startswith('post_'):
+            tag_cloud.invalidate_album(instance.id)
+    elif action == 'pre_clear':
+        tag_cloud.invalidate_photo(instance.id, instance.user_id)
+    elif action in ('post_add', 'post_remove'):
+        for album_id in pk_set:
+            tag_cloud.invalidate_album(album_id)
+
+
+@receiver(post_delete, sender=Photo)
+def photo_deleted(sender, instance, **kwargs):
+    """Release the photo's reference to its shared original."""
+    if instance.blob_id is not None:
+        blobs.release(instance.blob_id)
+
+
+@receiver(post_delete, sender=PhotoVariant)
+def variant_deleted(sender, instance, **kwargs):
+    """Remove a variant's file along with its row."""
+    if instance.file:
+        instance.file.storage.delete(instance.file.name)
+
+
+@receiver(m2m_changed, sender=Album.photos.through)
+def album_photos_changed_cover(sender, instance, action, pk_set, **kwargs):
+    """Recompute effective covers when album membership changes."""
+    if isinstance(instance, Album):
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            covers.refresh_covers([instance.id])
+    elif action == 'pre_clear':
+        instance._cover_album_ids = covers.albums_for_photo(instance.id)
+    elif action == 'post_clear':
+        covers.refresh_covers(getattr(instance, '_cover_album_ids', ()))
+    elif action in ('post_add', 'post_remove'):
+        covers.refresh_covers(pk_set)
+
+
+@receiver(post_save, sender=Album)
+def album_saved(sender, instance, **kwargs):
+    """Pick up a newly chosen or cleared cover."""
+    covers.refresh_covers([instance.id])
+
+
+@receiver(post_save, sender=Photo)
+def photo_saved_cover(sender, instance, created, **kwargs):
+    """A photo going public or private can change its albums' covers."""
+    if not created:
+        covers.refresh_covers(covers.albums_for_photo(instance.id))
+
+
+@receiver(pre_delete, sender=Photo)
+def photo_deleting_cover(sender, instance, **kwargs):
+    """Remember which albums need a new cover once the photo is gone."""
+    instance._cover_album_ids = covers.albums_for_photo(instance.id)
+
+
+@receiver(post_delete, sender=Photo)
+def photo_deleted_cover(sender, instance, **kwargs):
+    """Replace covers that pointed at a deleted photo."""
+    covers.refresh_covers(getattr(instance, '_cover_album_ids', ()))
+
+
+def _shown_publicly(instance):
+    """Whether a photo or album is, or was when loaded, public."""
+    return 'PB' in (instance.published,
+                    getattr(instance, '_loaded_published', None))
+
+
+def _album_ids(photo_id):
+    """Ids of the albums holding a photo."""
+    return list(Album.photos.through.objects.filter(
+        photo_id=photo_id).values_list('album_id', flat=True))
+
+
+def _photo_scopes(photo, album_ids):
+    """Page cache scopes showing a public photo."""
+    return (['photos', 'albums', 'user:{}'.format(photo.user_id)] +
+            ['album:{}'.format(album_id) for album_id in album_ids])
+
+
+@receiver(post_init, sender=Photo)
+@receiver(post_init, sender=Album)
+def remember_published(sender, instance, **kwargs):
+    """Note the loaded publish status to spot a public row going private."""
+    instance._loaded_published = instance.published
+
+
+@receiver(post_save, sender=Photo)
+def photo_saved_pages(sender, instance, created, **kwargs):
+    """Invalidate the public pages showing a saved photo."""
+    if _shown_publicly(instance):
+        album_ids = [] if created else _album_ids(instance.id)
+        page_cache.bump(*_photo_scopes(instance, album_ids))
+    instance._loaded_published = instance.published
+
+
+@receiver(pre_delete, sender=Photo)
+def photo_deleting_pages(sender, instance, **kwargs):
+    """Remember a public photo's albums before the links are removed."""
+    if _shown_publicly(instance):
+        instance._page_album_ids = _album_ids(instance.id)
+
+
+@receiver(post_delete, sender=Photo)
+def photo_deleted_pages(sender, instance, **kwargs):
+    """Invalidate the public pages that showed a deleted photo."""
+    if _shown_publicly(instance):
+        page_cache.bump(*_photo_scopes(
+            instance, getattr(instance, '_page_album_ids', ())))
+
+
+@receiver(post_save, sender=Album)
+@receiver(post_delete, sender=Album)
+def album_changed_pages(sender, instance, **kwargs):
+    """Invalidate the pages showing an album."""
+    scopes = ['album:{}'.format(instance.id)]
+    if _shown_publicly(instance):
+        scopes += ['albums', 'user:{}'.format(instance.user_id)]
+    page_cache.bump(*scopes)
+    instance._loaded_published = instance.published
+
+
+@receiver(m2m_changed, sender=Album.photos.through)
+def album_photos_changed_pages(sender, instance, action, pk_set, **kwargs):
+    """Invalidate album pages when their photos change."""
+    if isinstance(instance, Album):
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            page_cache.bump('albums', 'album:{}'.format(instance.id))
+    elif action == 'pre_clear':
+        instance._page_album_ids = _album_ids(instance.id)
+    elif action == 'post_clear':
+        album_ids = getattr(instance, '_page_album_ids', ())
+        page_cache.bump('albums', *['album:{}'.format(album_id)
+                                    for album_id in album_ids])
+    elif action in ('post_add', 'post_remove'):
+        page_cache.bump('albums', *['album:{}'.format(album_id)
+                                    for album_id in pk_set])
+
+
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=TaggedItem)
+def tagged_item_changed_pages(sender, instance, **kwargs):
+    """Invalidate tag listings and album pages when a public photo's tags change."""
+    if instance.content_type_id != ContentType.objects.get_for_model(Photo).id:
+        return
+    photo = (Photo.objects.filter(id=instance.object_id, published='PB')
+             .only('id', 'user_id', 'published').first())
+    if photo is not None:
+        page_cache.bump(*_photo_scopes(photo, _album_ids(photo.id)))
+
+
+@receiver(post_save, sender=Photo)
+def photo_saved_search(sender, instance, created, **kwargs):
+    """Reindex a saved photo and the albums whose tags it contributes."""
+    if not search.enabled():
+        return
+    search.update_photo_vectors([instance.id])
+    if not created:
+        search.update_album_vectors(_album_ids(instance.id))
+
+
+@receiver(post_save, sender=Album)
+def album_saved_search(sender, instance, **kwargs):
+    """Reindex a saved album."""
+    if search.enabled():
+        search.update_album_vectors([instance.id])
+
+
+@receiver(m2m_changed, sender=Album.photos.through)
+def album_photos_changed_search(sender, instance, action, pk_set, **kwargs):
+    """Reindex albums whose photos, and so tags, changed."""
+    if not search.enabled():
+        return
+    if isinstance(instance, Album):
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            search.update_album_vectors([instance.id])
+    elif action == 'pre_clear':
+        instance._search_album_ids = _album_ids(instance.id)
+    elif action == 'post_clear':
+        search.update_album_vectors(
+            getattr(instance, '_search_album_ids', ()))
+    elif action in ('post_add', 'post_remove'):
+        search.update_album_vectors(pk_set)
+
+
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=TaggedItem)
+def tagged_item_changed_search(sender, instance, **kwargs):
+    """Reindex a photo, and its albums, when its tags change."""
+    if not search.enabled():
+        return
+    if instance.content_type_id != ContentType.objects.get_for_model(Photo).id:
+        return
+    search.update_photo_vectors([instance.object_id])
+    search.update_album_vectors(_album_ids(instance.object_id))
+
+
+@receiver(post_save, sender=TaggedItem)
+def tagged_item_saved_postings(sender, instance, **kwargs):
+    """Add a public photo to the posting list of its new tag."""
+    if instance.content_type_id != ContentType.objects.get_for_model(Photo).id:
+        return
+    if Photo.objects.filter(id=instance.object_id, published='PB').exists():
+        postings.add([instance.tag_id], [instance.object_id])
+
+
+@receiver(post_delete, sender=TaggedItem)
+def tagged_item_deleted_postings(sender, instance, **kwargs):
+    """Drop a photo from the posting list of a removed tag."""
+    if instance.content_type_id != ContentType.objects.get_for_model(Photo).id:
+        return
+    postings.remove([instance.tag_id], [instance.object_id])
+
+
+@receiver(post_save, sender=Photo)
+def photo_saved_postings(sender, instance, created, **kwargs):
+    """Publishing or hiding a photo adds it to or drops it from its tags."""
+    if not created:
+        postings.sync_photo(instance)
+
+
+@receiver(pre_delete, sender=Photo)
+def photo_deleting_postings(sender, instance, **kwargs):
+    """Drop a deleted photo from its tags' posting lists."""
+    tag_ids = (TaggedItem.objects
+               .filter(content_type_id=ContentType.objects
+                       .get_for_model(Photo).id, object_id=instance.id)
+               .values_list('tag_id', flat=True))
+    postings.remove(tag_ids, [instance.id])
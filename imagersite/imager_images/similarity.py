@@ -0,0 +1,155 @@
+"""Perceptual hashes and near-duplicate lookups for photos.
+
+Hashes are split into SEGMENTS indexed segments. If two hashes are at
+most d bits apart, one of their segments differs in at most
+d // SEGMENTS bits, so looking up every value within that many bits of
+each segment finds every match without scanning all photos.
+"""
+from functools import reduce
+from itertools import combinations
+from operator import or_
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from PIL import Image
+from .models import Photo, PhotoHash
+
+HASH_SIZE = 8
+SEGMENTS = 4
+SEGMENT_BITS = 64 // SEGMENTS
+SEGMENT_MASK = (1 << SEGMENT_BITS) - 1
+
+# Hamming distance under which two photos count as the same picture.
+DUPLICATE_DISTANCE = 3
+# Looser distance for the "similar photos" list on the photo page.
+SIMILAR_DISTANCE = 10
+# Beyond this many bits per segment, probing costs more than a scan.
+MAX_PROBE_BITS = 2
+
+
+def dhash(image):
+    """Return the 64-bit difference hash of a PIL image as an unsigned int."""
+    small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE),
+                                      Image.ANTIALIAS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hash_file(name):
+    """Hash an image in storage by name."""
+    with default_storage.open(name) as image_file:
+        image = Image.open(image_file)
+        image.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+        return dhash(image)
+
+
+def to_signed(value):
+    """Fit an unsigned 64-bit hash into a signed BigIntegerField."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value):
+    """Undo to_signed."""
+    return value & 0xFFFFFFFFFFFFFFFF
+
+
+def segments(value):
+    """Split an unsigned hash into its indexed segments."""
+    return [(value >> (SEGMENT_BITS * i)) & SEGMENT_MASK
+            for i in range(SEGMENTS)]
+
+
+def distance(a, b):
+    """Hamming distance between two hashes."""
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count('1')
+
+
+def build_hash(photo_id, value):
+    """Build an unsaved PhotoHash row for an unsigned hash."""
+    parts = segments(value)
+    return PhotoHash(photo_id=photo_id,
+                     value=to_signed(value),
+                     segment_0=parts[0],
+                     segment_1=parts[1],
+                     segment_2=parts[2],
+                     segment_3=parts[3])
+
+
+def index_photo(photo):
+    """Compute and store a photo's perceptual hash.
+
+    Photos sharing an original with an already hashed photo reuse its hash
+    instead of decoding the image again.
+    """
+    if not photo.photo:
+        return None
+    value = None
+    if photo.blob_id is not None:
+        shared = (PhotoHash.objects
+                  .filter(photo__blob_id=photo.blob_id)
+                  .values_list('value', flat=True).first())
+        if shared is not None:
+            value = to_unsigned(shared)
+    if value is None:
+        value = hash_file(photo.photo.name)
+    PhotoHash.objects.filter(photo_id=photo.id).delete()
+    row = build_hash(photo.id, value)
+    row.save()
+    return row
+
+
+def nearby(part, bits):
+    """Every segment value within bits of part."""
+    values = [part]
+    for flipped in range(1, bits + 1):
+        for positions in combinations(range(SEGMENT_BITS), flipped):
+            values.append(reduce(lambda value, i: value ^ (1 << i),
+                                 positions, part))
+    return values
+
+
+def candidates(value, max_distance):
+    """PhotoHash rows that may lie within max_distance of a hash.
+
+    Includes every row that does; callers still check the distance.
+    """
+    bits = max_distance // SEGMENTS
+    if bits > MAX_PROBE_BITS:
+        return PhotoHash.objects.all()
+    parts = segments(to_unsigned(value))
+    return PhotoHash.objects.filter(reduce(or_, [
+        Q(**{'segment_{}__in'.format(i): nearby(part, bits)})
+        for i, part in enumerate(parts)]))
+
+
+def matches(photo, queryset, max_distance, limit):
+    """Photos from queryset within max_distance of photo, closest first."""
+    own = PhotoHash.objects.filter(photo=photo).first()
+    if own is None:
+        return []
+    rows = (candidates(own.value, max_distance)
+            .exclude(photo=photo)
+            .filter(photo__in=queryset)
+            .values_list('photo_id', 'value'))
+    found = [(distance(own.value, value), photo_id)
+             for photo_id, value in rows]
+    found = sorted(pair for pair in found if pair[0] <= max_distance)[:limit]
+    photos = Photo.objects.in_bulk([photo_id for _, photo_id in found])
+    return [photos[photo_id] for _, photo_id in found if photo_id in photos]
+
+
+def similar_photos(photo, limit=8):
+    """Public photos that look like this one."""
+    return matches(photo, Photo.objects.filter(published='PB'),
+                   SIMILAR_DISTANCE, limit)
+
+
+def near_duplicates(photo, limit=20):
+    """Photos in the owner's library that are the same picture."""
+    return matches(photo, Photo.objects.filter(user_id=photo.user_id),
+                   DUPLICATE_DISTANCE, limit)
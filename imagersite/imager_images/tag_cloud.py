@@ -0,0 +1,121 @@
+"""Cached tag clouds for a user's library, an album or the whole site.
+
+Dropping a cloud is noted for replica routing, so the refill that follows
+reads from the primary rather than a replica still missing the change.
+"""
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models import Count
+from taggit.models import TaggedItem
+from imagersite import db_router
+from .models import Photo, Album, TagStat
+
+CACHE_TIMEOUT = 60 * 60
+POPULAR_KEY = 'imager_images:tags:popular'
+
+
+def _user_key(user_id):
+    """Cache key for a user's library tags."""
+    return 'imager_images:tags:user:{}'.format(user_id)
+
+
+def _album_key(album_id):
+    """Cache key for an album's tags."""
+    return 'imager_images:tags:album:{}'.format(album_id)
+
+
+def aggregate_tags(photos):
+    """Return distinct tags with counts for a photo queryset in one query."""
+    photo_type = ContentType.objects.get_for_model(Photo)
+    rows = (TaggedItem.objects
+            .filter(content_type=photo_type,
+                    object_id__in=photos.values('id'))
+            .values('tag__name', 'tag__slug')
+            .annotate(count=Count('id'))
+            .order_by('tag__name'))
+    return [{'name': row['tag__name'],
+             'slug': row['tag__slug'],
+             'count': row['count']} for row in rows]
+
+
+def library_tags(user):
+    """Return the tag cloud for every photo in a user's library."""
+    key = _user_key(user.id)
+    tags = cache.get(key)
+    if tags is None:
+        with db_router.primary_if_changed([key]):
+            tags = aggregate_tags(Photo.objects.filter(user=user))
+        cache.set(key, tags, CACHE_TIMEOUT)
+    return tags
+
+
+def album_tags(album):
+    """Return the tag cloud for the public photos in an album."""
+    key = _album_key(album.id)
+    tags = cache.get(key)
+    if tags is None:
+        with db_router.primary_if_changed([key]):
+            tags = aggregate_tags(album.photos.filter(published='PB'))
+        cache.set(key, tags, CACHE_TIMEOUT)
+    return tags
+
+
+def popular_limit():
+    """How many of the most used tags are cached."""
+    return getattr(settings, 'IMAGER_POPULAR_TAGS_LIMIT', 50)
+
+
+def popular_tags(limit=None):
+    """Return the tags on the most public photos, most used first.
+
+    Read off TagStat's count index and cached for a few minutes; a tag's
+    count may trail its photos by up to IMAGER_POPULAR_TAGS_TIMEOUT.
+    """
+    tags = cache.get(POPULAR_KEY)
+    if tags is None:
+        with db_router.primary_if_changed([POPULAR_KEY]):
+            rows = list(TagStat.objects
+                        .filter(count__gt=0)
+                        .order_by('-count', 'tag')
+                        .values('tag__name', 'tag__slug',
+                                'count')[:popular_limit()])
+        tags = [{'name': row['tag__name'],
+                 'slug': row['tag__slug'],
+                 'count': row['count']} for row in rows]
+        cache.set(POPULAR_KEY, tags,
+                  getattr(settings, 'IMAGER_POPULAR_TAGS_TIMEOUT', 5 * 60))
+    return tags[:limit]
+
+
+def invalidate_popular():
+    """Drop the cached site-wide tag cloud."""
+    db_router.note_changed([POPULAR_KEY])
+    cache.delete(POPULAR_KEY)
+
+
+def invalidate_photo(photo_id, user_id=None):
+    """Drop the cached clouds that include a photo."""
+    if user_id is None:
+        user_id = (Photo.objects.filter(id=photo_id)
+                   .values_list('user_id', flat=True).first())
+    keys = [_album_key(album_id) for album_id in
+            Album.photos.through.objects
+                 .filter(photo_id=photo_id)
+                 .values_list('album_id', flat=True)]
+    if user_id is not None:
+        keys.append(_user_key(user_id))
+    db_router.note_changed(keys)
+    cache.delete_many(keys)
+
+
+def invalidate_user(user_id):
+    """Drop the cached cloud for a user's library."""
+    db_router.note_changed([_user_key(user_id)])
+    cache.delete(_user_key(user_id))
+
+
+def invalidate_album(album_id):
+    """Drop the cached cloud for an album."""
+    db_router.note_changed([_album_key(album_id)])
+    cache.delete(_album_key(album_id))
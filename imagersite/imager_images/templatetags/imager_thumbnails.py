@@ -0,0 +1,65 @@
+"""Template tags for thumbnails resolved ahead of the template loop."""
+from django import template
+from sorl.thumbnail import get_thumbnail
+from imager_images import variants
+from imager_images.thumbnails import geometry_options
+from imagersite import storage_urls
+
+register = template.Library()
+
+
+@register.simple_tag
+def prefetched_thumbnail(photo, geometry):
+    """Return a photo's thumbnail, using prefetch_thumbnails results if any.
+
+    Usage: {% prefetched_thumbnail photo "100x100" as im %}
+    """
+    if photo is None:
+        return None
+    prefetched = getattr(photo, '_prefetched_thumbnails', {})
+    if geometry in prefetched:
+        return prefetched[geometry]
+    if not photo.photo:
+        return None
+    return get_thumbnail(photo.photo, geometry, **geometry_options(geometry))
+
+
+@register.simple_tag
+def media_cache_timeout(timeout):
+    """Return a fragment cache timeout no longer than media URLs last.
+
+    Usage: {% media_cache_timeout 3600 as timeout %}
+    """
+    return storage_urls.cache_timeout(timeout)
+
+
+@register.inclusion_tag('imager_images/includes/picture.html')
+def responsive_image(photo, sizes='100vw', alt=''):
+    """Render a <picture> choosing between a photo's stored variants.
+
+    Usage: {% responsive_image photo sizes="(max-width: 500px) 100vw, 500px" %}
+
+    Photos without variants yet fall back to the 500x500 thumbnail rather
+    than the full original.
+    """
+    photo_variants = list(variants.of_photo(photo))
+    jpegs = sorted((v for v in photo_variants if v.format == 'jpeg'),
+                   key=lambda v: v.width)
+    sources = [source for source in variants.srcsets(photo_variants)
+               if source[0] != 'jpeg']
+    if jpegs:
+        fallback = jpegs[-1]
+        src = fallback.file.url
+    else:
+        fallback = prefetched_thumbnail(photo, '500x500')
+        src = fallback.url if fallback else ''
+    return {
+        'sources': sources,
+        'srcset': ', '.join('{} {}w'.format(v.file.url, v.width)
+                            for v in jpegs),
+        'src': src,
+        'width': fallback.width if fallback else None,
+        'height': fallback.height if fallback else None,
+        'sizes': sizes,
+        'alt': alt or photo.title,
+    }
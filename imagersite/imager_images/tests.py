@@ -1,17 +1,40 @@
 """Tests for Imager Profile app."""
 
 from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.contrib.auth.models import User
 from django.urls import reverse, reverse_lazy
+from django.utils import timezone
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase, Client
-from imager_images.models import Photo, Album
-from imagersite.settings import MEDIA_ROOT
+from django.test import (TestCase, TransactionTestCase, Client,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import BytesIO, StringIO
+from imager_images.models import (Photo, Album, ChunkedUpload, ImageBlob,
+                                   Job, PhotoHash, PhotoVariant, TagStat)
+from imager_images.tag_cloud import album_tags, library_tags, popular_tags
+from imager_images.views import PhotoListView
+from imager_images import (blobs, bulk, direct_uploads, jobs, metadata,
+                           postings, search, similarity, thumbnails, uploads,
+                           variants)
+from sorl.thumbnail import default, get_thumbnail
+from taggit.models import Tag
 from bs4 import BeautifulSoup
+from PIL import Image
 import faker
 import datetime
+import hashlib
+import logging
 import factory
 import os
+import shutil
+import struct
+import tempfile
+import time
 
 fake = faker.Faker()
 
@@ -19,6 +42,89 @@ fake = faker.Faker()
 HERE = os.path.dirname(__file__)
 
 
+def record_job(*args):
+    """A job task that remembers its arguments."""
+    RAN_JOBS.append(list(args))
+
+
+def failing_job():
+    """A job task that always fails."""
+    raise IOError('Storage unavailable.')
+
+
+def rejecting_job():
+    """A job task whose failure retrying cannot fix."""
+    raise jobs.PermanentError('Not an image.')
+
+
+RAN_JOBS = []
+
+
+def tiff_ifd(entries, start, order='<'):
+    """Pack (tag, type, count, payload) entries as a TIFF IFD at start."""
+    data_at = start + 2 + 12 * len(entries) + 4
+    table, data = [], b''
+    for tag, kind, count, payload in sorted(entries):
+        if len(payload) <= 4:
+            value = payload.ljust(4, b'\x00')
+        else:
+            value = struct.pack(order + 'I', data_at + len(data))
+            data += payload
+        table.append(struct.pack(order + 'HHI', tag, kind, count) + value)
+    return (struct.pack(order + 'H', len(entries)) + b''.join(table) +
+            struct.pack(order + 'I', 0) + data)
+
+
+def exif_bytes(orientation=1, make='', model='', taken='', gps=None):
+    """Raw EXIF as a camera writes it, for Pillow versions without Exif()."""
+    def ascii(tag, text):
+        payload = text.encode('ascii') + b'\x00'
+        return (tag, 2, len(payload), payload)
+    entries = [(274, 3, 1, struct.pack('<H', orientation))]
+    for tag, text in ((271, make), (272, model), (306, taken)):
+        if text:
+            entries.append(ascii(tag, text))
+    if gps is None:
+        return b'Exif\x00\x00II*\x00' + struct.pack('<I', 8) + tiff_ifd(
+            entries, 8)
+    entries.append((34853, 4, 1, b''))
+    gps_at = 8 + len(tiff_ifd(entries, 8))
+    entries[-1] = (34853, 4, 1, struct.pack('<I', gps_at))
+    gps_entries = []
+    for ref_tag, ref, tag, value in ((1, gps[0], 2, gps[1]),
+                                     (3, gps[2], 4, gps[3])):
+        gps_entries.append(ascii(ref_tag, ref))
+        gps_entries.append((tag, 5, 3, b''.join(
+            struct.pack('<II', part, 1) for part in value)))
+    return (b'Exif\x00\x00II*\x00' + struct.pack('<I', 8) +
+            tiff_ifd(entries, 8) + tiff_ifd(gps_entries, gps_at))
+
+
+def use_temp_media(test):
+    """Keep the files a test writes under a MEDIA_ROOT removed after it."""
+    root = tempfile.mkdtemp()
+    media = override_settings(
+        MEDIA_ROOT=root,
+        IMAGER_UPLOAD_TEMP_DIR=os.path.join(root, 'uploads_tmp'))
+    media.enable()
+    # sorl remembers thumbnails in the cache; forget ones from other roots.
+    cache.clear()
+    # Cleanups run after tearDown, so its deletes still see this root.
+    test.addCleanup(cache.clear)
+    test.addCleanup(shutil.rmtree, root, True)
+    test.addCleanup(media.disable)
+    return root
+
+
+def jpeg_bytes(size=(40, 20), **exif):
+    """A JPEG, left half red and right half blue, with the given EXIF."""
+    image = Image.new('RGB', size, 'blue')
+    image.paste('red', (0, 0, size[0] // 2, size[1]))
+    out = BytesIO()
+    image.save(out, 'JPEG', exif=exif_bytes(**exif))
+    return out.getvalue()
+
+
 class PhotoFactory(factory.django.DjangoModelFactory):
     """Factory for creating photos."""
 
@@ -61,6 +167,7 @@ class PhotoTestModels(TestCase):
 
     def setUp(self):
         """Create a user and a photo."""
+        use_temp_media(self)
         user = User(
             username='morgan',
             email='morgan@morgan.com'
@@ -73,11 +180,6 @@ class PhotoTestModels(TestCase):
         photo.save()
         self.photo = photo
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_upload_image_adds_new_photo_instance(self):
         """New photo has been created."""
         self.assertEqual(Photo.objects.count(), 1)
@@ -127,6 +229,7 @@ class TestPhotoView(TestCase):
 
     def setUp(self):
         """Create users, photos and albums."""
+        use_temp_media(self)
         user_1 = User(
             username='morgan',
             email='morgan@morgan.com'
@@ -185,11 +288,6 @@ class TestPhotoView(TestCase):
         self.albums = albums
         self.client = Client()
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_image_count_correct(self):
         """Test img element count is equal to public images."""
         response = self.client.get(reverse_lazy('photos'))
@@ -203,6 +301,7 @@ class AlbumsTestModels(TestCase):
 
     def setUp(self):
         """Create a user, photos and albums."""
+        use_temp_media(self)
         user = User(
             username='morgan',
             email='morgan@morgan.com'
@@ -224,11 +323,6 @@ class AlbumsTestModels(TestCase):
             album.cover = photos[idx]
         self.albums = albums
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_delete_user_with_albums_albums_deleted(self):
         """Delete user deletes albums."""
         self.assertTrue(Album.objects.count() == 5)
@@ -262,6 +356,7 @@ class TestLibraryView(TestCase):
 
     def setUp(self):
         """Create users, photos and albums."""
+        use_temp_media(self)
         user_1 = User(
             username='morgan',
             email='morgan@morgan.com'
@@ -320,11 +415,6 @@ class TestLibraryView(TestCase):
         self.albums = albums
         self.client = Client()
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_logged_out_user_redirects(self):
         """Logged out user redirects to login."""
         response = self.client.get(reverse_lazy('library'))
@@ -371,12 +461,37 @@ class TestLibraryView(TestCase):
         tags = album_cover.attrs
         self.assertTrue(tags['alt'] == 'default cover image: camera')
 
+    def test_library_filters_photos_by_date_taken(self):
+        """Only photos taken within the requested days are listed."""
+        taken = timezone.make_aware(datetime.datetime(2017, 6, 1, 23, 30))
+        Photo.objects.filter(id=self.photos_1[0].id).update(taken_at=taken)
+        Photo.objects.filter(id=self.photos_1[1].id).update(
+            taken_at=taken + datetime.timedelta(days=2))
+        self.client.force_login(self.user_1)
+        response = self.client.get(reverse_lazy('library'),
+                                   {'taken_from': '2017-06-01',
+                                    'taken_to': '2017-06-01'})
+        self.assertEqual([photo.id for photo in response.context['photos']],
+                         [self.photos_1[0].id])
+        response = self.client.get(reverse_lazy('library'),
+                                   {'taken_from': '2017-06-02'})
+        self.assertEqual([photo.id for photo in response.context['photos']],
+                         [self.photos_1[1].id])
+
+    def test_library_ignores_invalid_dates(self):
+        """A malformed date filters nothing."""
+        self.client.force_login(self.user_1)
+        response = self.client.get(reverse_lazy('library'),
+                                   {'taken_from': '2017-13-01'})
+        self.assertEqual(len(response.context['photos']), 10)
+
 
 class TestAlbumView(TestCase):
     """Test album views."""
 
     def setUp(self):
         """Create users, photos and albums."""
+        use_temp_media(self)
         user_1 = User(
             username='morgan',
             email='morgan@morgan.com'
@@ -435,11 +550,6 @@ class TestAlbumView(TestCase):
         self.albums = albums
         self.client = Client()
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_albums_logged_in_logged_out_users_see_same_content(self):
         """View is the same regardless of auth."""
         logged_out_response = self.client.get(reverse_lazy('albums'))
@@ -484,6 +594,7 @@ class TestAddPhotos(TestCase):
 
     def setUp(self):
         """Create a user and a photo to upload."""
+        use_temp_media(self)
         user = User(
             username='morgan',
             email='morgan@morgan.com'
@@ -499,11 +610,6 @@ class TestAddPhotos(TestCase):
                 'New-smaller-Coca-Cola-can-001.jpg'), 'rb').read(),
             content_type='image/jpeg')
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_user_must_be_logged_in_to_photo_add(self):
         """User must be logged in to add photos."""
         response = self.client.get(reverse_lazy('photo_add'))
@@ -568,6 +674,7 @@ class TestPhotoEdit(TestCase):
 
     def setUp(self):
         """Create a user and photos."""
+        use_temp_media(self)
         user = User(
             username='morgan',
             email='morgan@morgan.com'
@@ -586,11 +693,6 @@ class TestPhotoEdit(TestCase):
         self.photos = photos
         self.client = Client()
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_user_must_be_logged_in_to_edit_album(self):
         """User must be logged in to add photo."""
         photos = Photo.objects.all()
@@ -670,6 +772,7 @@ class TestAddAlbums(TestCase):
 
     def setUp(self):
         """Create a user and photos."""
+        use_temp_media(self)
         user = User(
             username='morgan',
             email='morgan@morgan.com'
@@ -681,11 +784,6 @@ class TestAddAlbums(TestCase):
         photo.save()
         self.photo = photo
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_user_must_be_logged_in_to_add_album(self):
         """User must be logged in to add album."""
         response = self.client.get(reverse_lazy('album_add'))
@@ -757,6 +855,7 @@ class TestAlbumEdit(TestCase):
 
     def setUp(self):
         """Create a user, photos and an album."""
+        use_temp_media(self)
         user = User(
             username='morgan',
             email='morgan@morgan.com'
@@ -786,11 +885,6 @@ class TestAlbumEdit(TestCase):
         self.albums = album
         self.client = Client()
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_user_must_be_logged_in_to_edit_album(self):
         """User must be logged in to add album."""
         albums = Album.objects.all()
@@ -872,3 +966,2136 @@ class TestAlbumEdit(TestCase):
         self.assertEqual(updated_album.description, 'Brand new description')
         self.assertEqual(updated_album.cover.id, photo_cover)
         self.assertEqual(updated_album.published, 'PV')
+
+
+class TestTagCloud(TestCase):
+    """Test tag aggregation for libraries and albums."""
+
+    def setUp(self):
+        """Create a user with tagged photos in an album."""
+        use_temp_media(self)
+        cache.clear()
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+
+        photos = [PhotoFactory.build() for i in range(5)]
+        for photo in photos:
+            photo.user = user
+            photo.published = 'PB'
+            photo.save()
+            photo.tags.add('sky')
+        photos[0].tags.add('sea')
+        photos[1].published = 'PV'
+        photos[1].save()
+        photos[1].tags.add('secret')
+
+        album = AlbumFactory.build()
+        album.user = user
+        album.published = 'PB'
+        album.save()
+        album.photos.add(*photos)
+
+        self.photos = photos
+        self.album = album
+
+    def test_library_tags_have_counts(self):
+        """Library tags include private photos and count each photo."""
+        tags = dict((tag['name'], tag['count']) for tag in library_tags(self.user))
+        self.assertEqual(tags, {'sea': 1, 'secret': 1, 'sky': 5})
+
+    def test_album_tags_only_count_public_photos(self):
+        """Album tags leave out private photos."""
+        tags = dict((tag['name'], tag['count']) for tag in album_tags(self.album))
+        self.assertEqual(tags, {'sea': 1, 'sky': 4})
+
+    def test_library_tags_cached(self):
+        """A second lookup is served from the cache."""
+        library_tags(self.user)
+        with self.assertNumQueries(0):
+            library_tags(self.user)
+
+    def test_new_tag_invalidates_library_and_album(self):
+        """Tagging a photo refreshes the cached clouds."""
+        library_tags(self.user)
+        album_tags(self.album)
+        self.photos[2].tags.add('sunset')
+        self.assertIn('sunset', [tag['name'] for tag in library_tags(self.user)])
+        self.assertIn('sunset', [tag['name'] for tag in album_tags(self.album)])
+
+    def test_removed_tag_invalidates_library(self):
+        """Removing a tag refreshes the cached cloud."""
+        library_tags(self.user)
+        self.photos[0].tags.remove('sea')
+        self.assertNotIn('sea', [tag['name'] for tag in library_tags(self.user)])
+
+    def test_publishing_photo_invalidates_album(self):
+        """Publishing a photo adds its tags to the album cloud."""
+        album_tags(self.album)
+        self.photos[1].published = 'PB'
+        self.photos[1].save()
+        self.assertIn('secret', [tag['name'] for tag in album_tags(self.album)])
+
+    def test_removing_photo_from_album_invalidates_album(self):
+        """Album membership changes refresh the album cloud."""
+        album_tags(self.album)
+        self.album.photos.remove(self.photos[0])
+        self.assertNotIn('sea', [tag['name'] for tag in album_tags(self.album)])
+
+    def test_library_view_query_count_independent_of_size(self):
+        """Library tags cost one query regardless of photo count."""
+        for i in range(5):
+            photo = PhotoFactory.build()
+            photo.user = self.user
+            photo.save()
+            photo.tags.add('more{}'.format(i))
+        cache.clear()
+        with self.assertNumQueries(1):
+            library_tags(self.user)
+
+    def test_library_view_shows_tag_links(self):
+        """Library page links to each tag."""
+        self.client.force_login(self.user)
+        response = self.client.get(reverse_lazy('library'))
+        self.assertIn(b'/images/photos/tag/sky/', response.content)
+
+
+class TestKeysetPagination(TestCase):
+    """Test cursor pagination on the public listing views."""
+
+    def setUp(self):
+        """Create more public photos than fit on one page."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        page_size = PhotoListView.paginate_by
+        photos = [PhotoFactory.build() for i in range(page_size + 5)]
+        for photo in photos:
+            photo.user = user
+            photo.published = 'PB'
+            photo.save()
+            photo.tags.add('sky')
+        private = PhotoFactory.build()
+        private.user = user
+        private.save()
+        self.photos = photos
+
+    def test_publishing_stamps_date_published(self):
+        """Public photos get a publish date."""
+        self.assertFalse(Photo.objects.filter(published='PB',
+                                              date_published__isnull=True).exists())
+
+    def test_bulk_publishing_stamps_date_published(self):
+        """Photos and albums made public by update() get a publish date."""
+        private = Photo.objects.get(published='PV')
+        Photo.objects.filter(id=private.id).update(published='PB')
+        self.assertIsNotNone(Photo.objects.get(id=private.id).date_published)
+        album = Album.objects.create(user=self.user)
+        Album.objects.filter(id=album.id).update(published='PB')
+        self.assertIsNotNone(Album.objects.get(id=album.id).date_published)
+
+    def test_undated_public_photo_does_not_break_paging(self):
+        """Public rows without a publish date are left out, not a crash."""
+        dated = self.photos[-3:]
+        (Photo.objects.filter(published='PB')
+                      .exclude(id__in=[photo.id for photo in dated])
+                      .update(date_published=None))
+        response = self.client.get(reverse_lazy('photos'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['photo_list']), dated[::-1])
+
+    def test_first_page_is_newest_photos(self):
+        """First page holds the newest page_size photos."""
+        response = self.client.get(reverse_lazy('photos'))
+        photos = list(response.context['photo_list'])
+        self.assertEqual(len(photos), PhotoListView.paginate_by)
+        self.assertEqual(photos[0], self.photos[-1])
+        self.assertTrue(response.context['page_obj'].has_next())
+
+    def test_next_cursor_walks_every_public_photo_once(self):
+        """Following next cursors visits each public photo exactly once."""
+        seen = []
+        url = reverse_lazy('photos')
+        response = self.client.get(url)
+        seen.extend(response.context['photo_list'])
+        page = response.context['page_obj']
+        while page.has_next():
+            response = self.client.get(url, {'after': page.next_cursor})
+            seen.extend(response.context['photo_list'])
+            page = response.context['page_obj']
+        self.assertEqual(len(seen), len(self.photos))
+        self.assertEqual(set(seen), set(self.photos))
+
+    def test_previous_cursor_returns_first_page(self):
+        """Going forward then back returns the first page."""
+        url = reverse_lazy('photos')
+        first = self.client.get(url)
+        cursor = first.context['page_obj'].next_cursor
+        second = self.client.get(url, {'after': cursor})
+        cursor = second.context['page_obj'].previous_cursor
+        back = self.client.get(url, {'before': cursor})
+        self.assertEqual(list(back.context['photo_list']),
+                         list(first.context['photo_list']))
+        self.assertFalse(back.context['page_obj'].has_previous())
+
+    def test_invalid_cursor_is_404(self):
+        """A garbage cursor is a 404."""
+        response = self.client.get(reverse_lazy('photos'), {'after': 'nope'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_tag_list_is_paginated(self):
+        """Tag listings are paginated too."""
+        response = self.client.get(reverse_lazy('tagged_images',
+                                                kwargs={'slug': 'sky'}))
+        self.assertEqual(len(response.context['photo_list']),
+                         PhotoListView.paginate_by)
+        self.assertIn(b'?after=', response.content)
+
+    def test_album_list_only_public(self):
+        """Album listing is filtered in the queryset."""
+        album = AlbumFactory.build()
+        album.user = self.user
+        album.save()
+        response = self.client.get(reverse_lazy('albums'))
+        self.assertEqual(len(response.context['album_list']), 0)
+
+
+class TestThumbnailPrerender(TestCase):
+    """Test thumbnails are rendered ahead of the templates."""
+
+    def setUp(self):
+        """Create a user and a photo to upload."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.photo = SimpleUploadedFile(
+            name='example.jpg',
+            content=open(os.path.join(
+                HERE,
+                'static',
+                'New-smaller-Coca-Cola-can-001.jpg'), 'rb').read(),
+            content_type='image/jpeg')
+
+    def assertThumbnailsStored(self, photo):
+        """Every standard geometry is in the thumbnail key value store."""
+        with self.assertNumQueries(0):
+            rendered = thumbnails.render_thumbnails(photo)
+        self.assertEqual(len(rendered), len(thumbnails.geometries()))
+        for thumbnail in rendered:
+            self.assertIsNotNone(default.kvstore.get(thumbnail))
+            self.assertTrue(thumbnail.exists())
+
+    @override_settings(IMAGER_THUMBNAIL_ASYNC=False)
+    def test_upload_renders_every_geometry(self):
+        """Uploading a photo renders all standard thumbnails."""
+        self.client.force_login(self.user)
+        self.client.post(reverse_lazy('photo_add'),
+                         {'title': 'New Test Photo',
+                          'description': 'Short description goes here.',
+                          'published': 'PV',
+                          'photo': self.photo})
+        photo = Photo.objects.get()
+        self.assertThumbnailsStored(photo)
+
+    def test_async_upload_queues_a_job(self):
+        """Uploading queues processing for a worker instead of rendering."""
+        self.client.force_login(self.user)
+        self.client.post(reverse_lazy('photo_add'),
+                         {'title': 'New Test Photo',
+                          'description': 'Short description goes here.',
+                          'published': 'PV',
+                          'photo': self.photo})
+        photo = Photo.objects.get()
+        job = Job.objects.get()
+        self.assertEqual(job.key, 'process_photo:{}'.format(photo.id))
+        self.assertEqual(job.status, jobs.QUEUED)
+        self.assertEqual(jobs.work('test', burst=True), 1)
+        self.assertEqual(Job.objects.get().status, jobs.DONE)
+        self.assertThumbnailsStored(photo)
+
+    def test_backfill_command_renders_existing_photos(self):
+        """The backfill command renders thumbnails for every photo."""
+        photos = [PhotoFactory.build() for i in range(3)]
+        for photo in photos:
+            photo.user = self.user
+            photo.save()
+        out = StringIO()
+        call_command('prerender_thumbnails', workers=1, batch_size=2, stdout=out)
+        self.assertIn('Rendered 3/3 photos', out.getvalue())
+        for photo in photos:
+            self.assertThumbnailsStored(photo)
+
+
+class TestThumbnailPrefetch(TestCase):
+    """Test batched thumbnail lookups for list pages."""
+
+    def setUp(self):
+        """Create a user with rendered photos."""
+        use_temp_media(self)
+        cache.clear()
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        photos = [PhotoFactory.build() for i in range(5)]
+        for photo in photos:
+            photo.user = user
+            photo.published = 'PB'
+            photo.save()
+            thumbnails.render_thumbnails(photo)
+        self.photos = photos
+
+    def test_thumbnail_file_matches_sorl_name(self):
+        """Computed thumbnail names match what sorl renders."""
+        photo = self.photos[0]
+        expected = thumbnails.render_thumbnails(photo)[0]
+        geometry, options = thumbnails.geometries()[0]
+        computed = thumbnails.thumbnail_file(photo.photo, geometry, options)
+        self.assertEqual(computed.name, expected.name)
+
+    def test_prefetch_is_one_query_for_the_page(self):
+        """A cold cache costs one db query for every photo on the page."""
+        cache.clear()
+        photos = list(Photo.objects.filter(user=self.user))
+        with self.assertNumQueries(1):
+            thumbnails.prefetch_thumbnails(photos, '100x100')
+        for photo in photos:
+            self.assertIsNotNone(photo._prefetched_thumbnails['100x100'])
+
+    def test_prefetch_warm_cache_needs_no_queries(self):
+        """A warm cache needs no db queries."""
+        photos = list(Photo.objects.filter(user=self.user))
+        with self.assertNumQueries(0):
+            thumbnails.prefetch_thumbnails(photos, '100x100')
+
+    def test_prefetch_renders_missing_thumbnails(self):
+        """Photos without stored thumbnails are rendered on demand."""
+        photo = PhotoFactory.build()
+        photo.user = self.user
+        photo.save()
+        thumbnails.prefetch_thumbnails([photo], '100x100')
+        self.assertTrue(photo._prefetched_thumbnails['100x100'].exists())
+
+    def test_library_uses_prefetched_thumbnails(self):
+        """Library page shows a thumbnail for each photo."""
+        self.client.force_login(self.user)
+        response = self.client.get(reverse_lazy('library'))
+        html = BeautifulSoup(response.content, 'html.parser')
+        self.assertEqual(len(html.find_all('img', 'photo')), len(self.photos))
+
+
+class TestBenchmarkViews(TestCase):
+    """Smoke test the view query benchmark."""
+
+    def test_benchmark_reports_each_view_and_rolls_back(self):
+        """Benchmark prints every view and leaves no seeded rows."""
+        out = StringIO()
+        call_command('benchmark_views', users=5, photos=50, runs=1, stdout=out)
+        for name in ['photos', 'albums', 'tagged_images', 'library',
+                     'public_profile', 'profile']:
+            self.assertIn(name, out.getvalue())
+        self.assertEqual(Photo.objects.count(), 0)
+        self.assertEqual(User.objects.count(), 0)
+
+    def test_benchmark_without_indexes_restores_them(self):
+        """Dropping the listing indexes is rolled back with the seed data."""
+        out = StringIO()
+        call_command('benchmark_views', users=5, photos=50, runs=1,
+                     drop_indexes=True, no_plans=True, stdout=out)
+        self.assertIn('photos', out.getvalue())
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, 'imager_images_photo')
+        self.assertIn('photo_published_date_idx', constraints)
+
+    def test_storage_benchmark_needs_s3(self):
+        """The storage benchmark refuses to run on local files."""
+        with self.assertRaises(CommandError):
+            call_command('benchmark_storage', files=1, workers=1)
+
+
+@override_settings(IMAGER_UPLOAD_MAX_CHUNK=4096)
+class TestChunkedUpload(TestCase):
+    """Tests for the resumable chunked upload API."""
+
+    def setUp(self):
+        """Create a user and an image to upload in chunks."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.client.force_login(user)
+        with open(os.path.join(HERE, 'static',
+                               'New-smaller-Coca-Cola-can-001.jpg'), 'rb') as f:
+            self.content = f.read()
+
+    def start(self):
+        """Begin an upload and return its id."""
+        response = self.client.post(reverse('upload_start'),
+                                    {'filename': 'example.jpg',
+                                     'size': len(self.content)})
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def put_chunk(self, upload_id, offset, data):
+        """Send one chunk."""
+        return self.client.put(reverse('upload_chunk', kwargs={'pk': upload_id}),
+                               data,
+                               content_type='application/octet-stream',
+                               HTTP_UPLOAD_OFFSET=str(offset))
+
+    def send_all(self, upload_id, start=0):
+        """Send the rest of the file in 4KB chunks."""
+        for offset in range(start, len(self.content), 4096):
+            response = self.put_chunk(upload_id, offset,
+                                      self.content[offset:offset + 4096])
+            self.assertEqual(response.status_code, 200)
+
+    def complete(self, upload_id):
+        """Finish an upload."""
+        return self.client.post(reverse('upload_complete',
+                                        kwargs={'pk': upload_id}),
+                                {'title': 'Chunked', 'published': 'PB',
+                                 'tags': 'big, chunked'})
+
+    def test_chunked_upload_creates_photo(self):
+        """All chunks plus complete creates a photo with the same bytes."""
+        upload_id = self.start()
+        self.send_all(upload_id)
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 201)
+        photo = Photo.objects.get(id=response.json()['photo'])
+        self.assertEqual(photo.title, 'Chunked')
+        self.assertEqual(sorted(photo.tags.names()), ['big', 'chunked'])
+        photo.photo.open('rb')
+        self.assertEqual(photo.photo.read(), self.content)
+        photo.photo.close()
+
+    def test_wrong_offset_returns_resume_point(self):
+        """A chunk at the wrong offset gets a 409 with the server offset."""
+        upload_id = self.start()
+        self.put_chunk(upload_id, 0, self.content[:4096])
+        response = self.put_chunk(upload_id, 0, self.content[:4096])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 4096)
+
+    def test_interrupted_upload_resumes(self):
+        """A client can ask for the offset and carry on from there."""
+        upload_id = self.start()
+        self.put_chunk(upload_id, 0, self.content[:4096])
+        status = self.client.get(reverse('upload_chunk',
+                                         kwargs={'pk': upload_id})).json()
+        self.send_all(upload_id, start=status['offset'])
+        self.assertEqual(self.complete(upload_id).status_code, 201)
+
+    def test_oversized_chunk_rejected(self):
+        """Chunks bigger than the limit are rejected."""
+        upload_id = self.start()
+        response = self.put_chunk(upload_id, 0, self.content[:8192])
+        self.assertEqual(response.status_code, 400)
+
+    def test_incomplete_upload_cannot_finish(self):
+        """Completing before every byte arrived is a conflict."""
+        upload_id = self.start()
+        self.put_chunk(upload_id, 0, self.content[:4096])
+        self.assertEqual(self.complete(upload_id).status_code, 409)
+        self.assertEqual(Photo.objects.count(), 0)
+
+    def test_non_image_rejected(self):
+        """Uploads that are not images don't become photos."""
+        self.content = b'not an image' * 10
+        upload_id = self.start()
+        self.send_all(upload_id)
+        self.assertEqual(self.complete(upload_id).status_code, 400)
+        self.assertEqual(Photo.objects.count(), 0)
+
+    def test_other_users_cannot_touch_upload(self):
+        """Uploads belong to the user that started them."""
+        upload_id = self.start()
+        other = User(username='kurt', email='kurt@kurt.com')
+        other.save()
+        self.client.force_login(other)
+        response = self.put_chunk(upload_id, 0, self.content[:4096])
+        self.assertEqual(response.status_code, 404)
+
+    def test_abort_discards_upload(self):
+        """Deleting an upload aborts it."""
+        upload_id = self.start()
+        self.put_chunk(upload_id, 0, self.content[:4096])
+        self.client.delete(reverse('upload_chunk', kwargs={'pk': upload_id}))
+        self.assertEqual(ChunkedUpload.objects.get(id=upload_id).status, 'AB')
+        self.assertEqual(self.complete(upload_id).status_code, 404)
+
+    def test_complete_twice_creates_one_photo(self):
+        """A repeated complete finds the upload finished."""
+        upload_id = self.start()
+        self.send_all(upload_id)
+        self.assertEqual(self.complete(upload_id).status_code, 201)
+        self.assertEqual(self.complete(upload_id).status_code, 404)
+        self.assertEqual(Photo.objects.count(), 1)
+
+    def test_complete_claims_without_locking(self):
+        """Completing claims the row with one conditional update."""
+        upload_id = self.start()
+        self.send_all(upload_id)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.complete(upload_id).status_code, 201)
+        sql = [query['sql'] for query in queries.captured_queries
+               if 'imager_images_chunkedupload' in query['sql']]
+        self.assertFalse([query for query in sql if 'FOR UPDATE' in query])
+        self.assertTrue(sql[1].startswith('UPDATE'))
+        self.assertIn("'AC'", sql[1])
+
+    def test_completing_upload_cannot_complete_again(self):
+        """An upload another request is completing is not active."""
+        upload_id = self.start()
+        self.send_all(upload_id)
+        ChunkedUpload.objects.filter(id=upload_id).update(status='CG')
+        self.assertEqual(self.complete(upload_id).status_code, 404)
+        self.assertEqual(Photo.objects.count(), 0)
+
+    def age(self, upload_id, seconds):
+        """Make an upload look idle for some seconds."""
+        then = timezone.now() - datetime.timedelta(seconds=seconds)
+        ChunkedUpload.objects.filter(id=upload_id).update(date_modified=then)
+
+    def test_expire_aborts_idle_uploads(self):
+        """Uploads idle past the expiry lose their row and partial file."""
+        idle = self.start()
+        self.put_chunk(idle, 0, self.content[:4096])
+        self.age(idle, uploads.expiry() + 60)
+        fresh = self.start()
+        self.assertEqual(uploads.expire_uploads(), (1, 1, 0))
+        self.assertFalse(ChunkedUpload.objects.filter(id=idle).exists())
+        self.assertFalse(os.path.exists(
+            os.path.join(uploads.temp_dir(), idle)))
+        self.assertEqual(ChunkedUpload.objects.get(id=fresh).status, 'AC')
+        self.assertTrue(os.path.exists(
+            os.path.join(uploads.temp_dir(), fresh)))
+
+    def test_expire_aborts_stuck_completing_uploads(self):
+        """An upload whose complete request died is cleaned up too."""
+        upload_id = self.start()
+        self.send_all(upload_id)
+        ChunkedUpload.objects.filter(id=upload_id).update(status='CG')
+        self.assertEqual(uploads.expire_uploads(), (0, 0, 0))
+        self.age(upload_id, uploads.expiry() + 60)
+        self.assertEqual(uploads.expire_uploads(), (1, 1, 0))
+        self.assertFalse(os.path.exists(
+            os.path.join(uploads.temp_dir(), upload_id)))
+
+    def test_expire_removes_old_finished_rows(self):
+        """Completed uploads are forgotten once they are old enough."""
+        upload_id = self.start()
+        self.send_all(upload_id)
+        self.complete(upload_id)
+        self.assertEqual(uploads.expire_uploads(), (0, 0, 0))
+        self.age(upload_id, uploads.expiry() + 60)
+        self.assertEqual(uploads.expire_uploads(), (0, 1, 0))
+        self.assertEqual(Photo.objects.count(), 1)
+
+    def test_expire_removes_orphaned_partial_files(self):
+        """Partial files without an upload go once they are old."""
+        old = os.path.join(uploads.temp_dir(), 'crashed')
+        new = os.path.join(uploads.temp_dir(), 'starting')
+        for path in (old, new):
+            open(path, 'wb').close()
+        stamp = time.time() - uploads.expiry() - 60
+        os.utime(old, (stamp, stamp))
+        self.assertEqual(uploads.expire_uploads(), (0, 0, 1))
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+    def test_expire_aborts_orphaned_multipart_uploads(self):
+        """Multipart uploads no upload row knows about are aborted."""
+        from botocore.stub import Stubber
+        from imagersite import s3
+        self.addCleanup(s3.close_all)
+        storage = s3.PooledS3Storage(bucket='imager', access_key='key',
+                                  secret_key='secret', region_name='us-east-1',
+                                  location='media')
+        stubber = Stubber(storage.connection.meta.client)
+        old = timezone.now() - datetime.timedelta(
+            seconds=uploads.expiry() + 60)
+        stubber.add_response(
+            'list_multipart_uploads',
+            {'Uploads': [{'Key': 'media/user_images/a.jpg', 'UploadId': 'a',
+                          'Initiated': old},
+                         {'Key': 'media/user_images/b.jpg', 'UploadId': 'b',
+                          'Initiated': old},
+                         {'Key': 'media/user_images/c.jpg', 'UploadId': 'c',
+                          'Initiated': timezone.now()}]},
+            {'Bucket': 'imager', 'Prefix': 'media/user_images/'})
+        stubber.add_response('abort_multipart_upload', {},
+                             {'Bucket': 'imager',
+                              'Key': 'media/user_images/b.jpg',
+                              'UploadId': 'b'})
+        with stubber:
+            cutoff = timezone.now() - datetime.timedelta(
+                seconds=uploads.expiry())
+            self.assertEqual(uploads.abort_s3_orphans(storage, {'a'}, cutoff),
+                             1)
+        stubber.assert_no_pending_responses()
+
+    def test_expire_uploads_command(self):
+        """The command reports what it removed."""
+        upload_id = self.start()
+        self.age(upload_id, uploads.expiry() + 60)
+        out = StringIO()
+        call_command('expire_uploads', stdout=out)
+        self.assertIn('Aborted 1 uploads', out.getvalue())
+
+
+class TestBulkUpload(TestCase):
+    """Tests for uploading many photos at once."""
+
+    def setUp(self):
+        """Create a user and some files to upload."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.client.force_login(user)
+        with open(os.path.join(HERE, 'static',
+                               'New-smaller-Coca-Cola-can-001.jpg'), 'rb') as f:
+            self.content = f.read()
+
+    def make_files(self, count):
+        """Build uploadable image files."""
+        return [SimpleUploadedFile(name='example{}.jpg'.format(i),
+                                   content=self.content,
+                                   content_type='image/jpeg')
+                for i in range(count)]
+
+    def test_bulk_upload_creates_every_photo(self):
+        """Every valid file becomes a photo with the shared settings."""
+        response = self.client.post(reverse_lazy('photo_bulk_add'),
+                                    {'photos': self.make_files(5),
+                                     'published': 'PB',
+                                     'tags': 'beach, trip'})
+        self.assertEqual(response.status_code, 200)
+        photos = Photo.objects.filter(user=self.user)
+        self.assertEqual(photos.count(), 5)
+        for photo in photos:
+            self.assertEqual(photo.published, 'PB')
+            self.assertIsNotNone(photo.date_published)
+            self.assertEqual(sorted(photo.tags.names()), ['beach', 'trip'])
+
+    def test_bulk_upload_reports_bad_files(self):
+        """Invalid files are reported without stopping the others."""
+        files = self.make_files(2)
+        files.append(SimpleUploadedFile(name='notes.jpg', content=b'nope',
+                                        content_type='image/jpeg'))
+        response = self.client.post(reverse_lazy('photo_bulk_add'),
+                                    {'photos': files, 'published': 'PV'})
+        html = BeautifulSoup(response.content, 'html.parser')
+        self.assertEqual(len(html.find_all('li', 'uploaded')), 2)
+        failed = html.find_all('li', 'failed')
+        self.assertEqual(len(failed), 1)
+        self.assertIn('notes.jpg', failed[0].text)
+        self.assertEqual(Photo.objects.count(), 2)
+
+    def test_bulk_upload_query_count_independent_of_file_count(self):
+        """Database writes are batched rather than per photo."""
+        bulk.bulk_upload(self.user, self.make_files(2), 'PV', ['one'])
+        with CaptureQueriesContext(connection) as small:
+            bulk.bulk_upload(self.user, self.make_files(2), 'PV', ['one'])
+        with CaptureQueriesContext(connection) as large:
+            bulk.bulk_upload(self.user, self.make_files(10), 'PV', ['one'])
+        self.assertEqual(len(small), len(large))
+
+    def test_identical_files_in_one_batch_are_stored_once(self):
+        """Copies of one file in a batch leave a single file on disk."""
+        results = bulk.bulk_upload(self.user, self.make_files(8))
+        self.assertEqual(len([r for r in results if r['photo']]), 8)
+        stored = [name for _, _, names in os.walk(
+            os.path.join(settings.MEDIA_ROOT, 'user_images'))
+            for name in names]
+        self.assertEqual(len(stored), 1)
+        self.assertEqual(ImageBlob.objects.get().refcount, 8)
+        Photo.objects.all().delete()
+
+    def test_acquire_deletes_every_losing_copy(self):
+        """Names other than the blob's own are removed."""
+        digest = hashlib.sha256(self.content).hexdigest()
+        names = [default_storage.save(blobs.blob_name(digest, 'a.jpg'),
+                                      SimpleUploadedFile('a.jpg',
+                                                         self.content))
+                 for i in range(3)]
+        blob = blobs.acquire_many([(digest, name, len(self.content))
+                                   for name in names])[digest]
+        self.assertEqual([default_storage.exists(name) for name in names],
+                         [name == blob.name for name in names])
+        self.assertEqual(blob.refcount, 3)
+
+    def test_bulk_upload_reuses_tags_case_insensitively(self):
+        """Existing tags are reused rather than duplicated."""
+        bulk.bulk_upload(self.user, self.make_files(1), 'PV', ['Beach'])
+        bulk.bulk_upload(self.user, self.make_files(1), 'PV', ['beach'])
+        self.assertEqual(Tag.objects.filter(name__iexact='beach').count(), 1)
+
+    def test_bulk_upload_requires_login(self):
+        """Logged out users are redirected."""
+        self.client.logout()
+        response = self.client.get(reverse_lazy('photo_bulk_add'))
+        self.assertEqual(response.status_code, 302)
+
+
+class TestContentDeduplication(TestCase):
+    """Identical uploads share one stored original."""
+
+    def setUp(self):
+        """Create a user and an image to upload repeatedly."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.client.force_login(user)
+        with open(os.path.join(HERE, 'static',
+                               'New-smaller-Coca-Cola-can-001.jpg'), 'rb') as f:
+            self.content = f.read()
+
+    def upload(self, content=None):
+        """Upload the image through the add photo form."""
+        self.client.post(reverse_lazy('photo_add'),
+                         {'title': 'Dup',
+                          'description': 'Same bytes.',
+                          'published': 'PV',
+                          'photo': SimpleUploadedFile(
+                              name='example.jpg',
+                              content=content or self.content,
+                              content_type='image/jpeg')})
+        return Photo.objects.order_by('-id').first()
+
+    def test_upload_handler_hashes_while_streaming(self):
+        """Uploaded files arrive with their digest attached."""
+        first = self.upload()
+        expected = hashlib.sha256(self.content).hexdigest()
+        self.assertEqual(first.blob.sha256, expected)
+        self.assertIn(expected, first.photo.name)
+
+    def test_identical_uploads_share_one_blob(self):
+        """The same bytes uploaded twice are stored once."""
+        first = self.upload()
+        second = self.upload()
+        self.assertEqual(first.photo.name, second.photo.name)
+        self.assertEqual(ImageBlob.objects.count(), 1)
+        self.assertEqual(ImageBlob.objects.get().refcount, 2)
+
+    def test_delete_keeps_blob_until_last_reference(self):
+        """Deleting one of two photos keeps the file."""
+        first = self.upload()
+        second = self.upload()
+        name = first.photo.name
+        first.delete()
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(ImageBlob.objects.get().refcount, 1)
+        second.delete()
+        self.assertFalse(default_storage.exists(name))
+        self.assertEqual(ImageBlob.objects.count(), 0)
+
+    def test_edit_releases_replaced_original(self):
+        """Replacing a photo's image releases the old original."""
+        photo = self.upload()
+        old_name = photo.photo.name
+        with open(os.path.join(HERE, 'static',
+                               'jerry-kiesewetter-192478.jpg'), 'rb') as f:
+            other = SimpleUploadedFile(name='example.jpg', content=f.read(),
+                                       content_type='image/jpeg')
+        self.client.post(reverse_lazy('photo_edit', kwargs={'pk': photo.id}),
+                         {'title': 'Dup', 'description': 'New bytes.',
+                          'published': 'PV', 'photo': other})
+        photo.refresh_from_db()
+        self.assertNotEqual(photo.photo.name, old_name)
+        self.assertFalse(default_storage.exists(old_name))
+
+    def test_bulk_upload_deduplicates(self):
+        """Duplicate files in a bulk upload share a blob."""
+        files = [SimpleUploadedFile(name='example{}.jpg'.format(i),
+                                    content=self.content,
+                                    content_type='image/jpeg')
+                 for i in range(3)]
+        results = bulk.bulk_upload(self.user, files)
+        self.assertEqual(len(set(r['photo'].id for r in results)), 3)
+        self.assertEqual(ImageBlob.objects.get().refcount, 3)
+
+
+class TestPhotoSimilarity(TestCase):
+    """Perceptual hashes find near-duplicate and similar photos."""
+
+    def setUp(self):
+        """Create a user and the images to compare."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.client.force_login(user)
+        with open(os.path.join(HERE, 'static',
+                               'New-smaller-Coca-Cola-can-001.jpg'), 'rb') as f:
+            self.content = f.read()
+        with open(os.path.join(HERE, 'static',
+                               'jerry-kiesewetter-192478.jpg'), 'rb') as f:
+            self.other = f.read()
+
+    def make_photo(self, content=None, published='PV'):
+        """Create and index a photo with the given image bytes."""
+        photo = PhotoFactory.build(user=self.user, published=published)
+        photo.photo = SimpleUploadedFile(name='example.jpg',
+                                         content=content or self.content,
+                                         content_type='image/jpeg')
+        photo.save()
+        similarity.index_photo(photo)
+        return photo
+
+    def reencoded(self):
+        """The test image shrunk and saved at a lower quality."""
+        image = Image.open(os.path.join(HERE, 'static',
+                                        'New-smaller-Coca-Cola-can-001.jpg'))
+        image = image.resize((image.width // 2, image.height // 2))
+        out = BytesIO()
+        image.convert('RGB').save(out, 'JPEG', quality=40)
+        return out.getvalue()
+
+    def test_segments_round_trip(self):
+        """A hash survives the signed column and segment split."""
+        value = 0xF0F0F0F0F0F0F0F0
+        row = similarity.build_hash(1, value)
+        self.assertLess(row.value, 0)
+        self.assertEqual(similarity.to_unsigned(row.value), value)
+        parts = similarity.segments(value)
+        self.assertEqual(sum(part << (16 * i) for i, part in enumerate(parts)),
+                         value)
+
+    def test_identical_photos_are_duplicates(self):
+        """Two uploads of the same image have distance zero."""
+        first = self.make_photo()
+        second = self.make_photo()
+        self.assertEqual(first.perceptual_hash.value,
+                         second.perceptual_hash.value)
+        self.assertEqual(similarity.near_duplicates(first), [second])
+
+    def test_reencoded_photo_is_duplicate(self):
+        """Resizing and recompressing does not hide a duplicate."""
+        first = self.make_photo()
+        second = self.make_photo(self.reencoded())
+        self.assertLessEqual(similarity.distance(first.perceptual_hash.value,
+                                                 second.perceptual_hash.value),
+                             similarity.DUPLICATE_DISTANCE)
+        self.assertEqual(similarity.near_duplicates(first), [second])
+
+    def test_different_photo_is_not_duplicate(self):
+        """An unrelated image is not reported."""
+        first = self.make_photo()
+        self.make_photo(self.other)
+        self.assertEqual(similarity.near_duplicates(first), [])
+
+    def test_similar_photos_are_public_only(self):
+        """Private look-alikes stay out of the public similar list."""
+        first = self.make_photo(published='PB')
+        public = self.make_photo(published='PB')
+        self.make_photo(published='PV')
+        self.assertEqual(similarity.similar_photos(first), [public])
+
+    def hashed_photo(self, value, published='PB'):
+        """A photo carrying a given hash, without decoding any image."""
+        photo = PhotoFactory.create(user=self.user, published=published)
+        similarity.build_hash(photo.id, value).save()
+        return photo
+
+    def test_similar_photos_differing_in_every_segment(self):
+        """Matches up to SIMILAR_DISTANCE are found however bits spread."""
+        value = 0x123456789ABCDEF0
+        first = self.hashed_photo(value)
+        # One flipped bit per segment: distance 4, no segment in common.
+        four = self.hashed_photo(value ^ 0x0001000100010001)
+        # Three, three, two and two bits: distance 10.
+        ten = self.hashed_photo(value ^ 0x0007000700030003)
+        # Three bits in every segment: distance 12, too far.
+        self.hashed_photo(value ^ 0x0007000700070007)
+        self.assertEqual(similarity.similar_photos(first), [four, ten])
+        self.assertEqual(similarity.near_duplicates(first), [])
+
+    def test_nearby_segment_values(self):
+        """Probing covers every value within the radius, once."""
+        values = similarity.nearby(0, 2)
+        self.assertEqual(len(values), 1 + 16 + 120)
+        self.assertEqual(len(set(values)), len(values))
+        self.assertEqual(max(bin(v).count('1') for v in values), 2)
+
+    def test_photo_page_lists_similar_photos(self):
+        """The photo page links to similar public photos."""
+        first = self.make_photo(published='PB')
+        public = self.make_photo(published='PB')
+        response = self.client.get(reverse_lazy('single_photo',
+                                                kwargs={'pk': first.id}))
+        html = BeautifulSoup(response.content, 'html.parser')
+        links = [a['href'] for a in html.find_all('a')]
+        self.assertIn(reverse('single_photo', kwargs={'pk': public.id}), links)
+
+    def test_photo_page_lists_owners_duplicates(self):
+        """Owners see their private copies; other visitors do not."""
+        first = self.make_photo(published='PB')
+        copy = self.make_photo(published='PV')
+        url = reverse('single_photo', kwargs={'pk': first.id})
+        copy_url = reverse('single_photo', kwargs={'pk': copy.id})
+        html = BeautifulSoup(self.client.get(url).content, 'html.parser')
+        self.assertIn(copy_url, [a['href'] for a in html.find_all('a')])
+        self.client.logout()
+        html = BeautifulSoup(self.client.get(url).content, 'html.parser')
+        self.assertNotIn(copy_url, [a['href'] for a in html.find_all('a')])
+
+    @override_settings(IMAGER_THUMBNAIL_ASYNC=False)
+    def test_upload_indexes_photo(self):
+        """Adding a photo stores its hash with the thumbnails."""
+        self.client.post(reverse_lazy('photo_add'),
+                         {'title': 'Hash me',
+                          'description': 'A can.',
+                          'published': 'PV',
+                          'photo': SimpleUploadedFile(
+                              name='example.jpg', content=self.content,
+                              content_type='image/jpeg')})
+        self.assertEqual(PhotoHash.objects.count(), 1)
+
+    def test_command_indexes_existing_photos(self):
+        """The backfill command hashes photos that have no hash yet."""
+        photos = [PhotoFactory.create(user=self.user) for _ in range(3)]
+        similarity.index_photo(photos[0])
+        out = StringIO()
+        call_command('index_photo_hashes', workers=1, batch_size=2, stdout=out)
+        self.assertIn('Hashed 2/2 photos', out.getvalue())
+        self.assertEqual(PhotoHash.objects.count(), 3)
+
+
+class TestResponsiveVariants(TestCase):
+    """Photos get resized, re-encoded variants served through srcset."""
+
+    def setUp(self):
+        """Create a user and a photo 460 pixels wide."""
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        use_temp_media(self)
+        self.photo = PhotoFactory.create(user=user, published='PB')
+
+    def tearDown(self):
+        """Delete photos so their variant rows and files go too."""
+        Photo.objects.all().delete()
+
+    def blob_photo(self):
+        """A photo whose original is the shared blob for its bytes."""
+        photo = Photo(user=self.user, title='Shared', published='PB')
+        with open(self.photo.photo.path, 'rb') as f:
+            blobs.attach(photo, SimpleUploadedFile('example.jpg', f.read()))
+        photo.save()
+        return photo
+
+    def test_target_widths_never_upscale(self):
+        """Originals are not enlarged past their own width."""
+        self.assertEqual(variants.target_widths(460), [320, 460])
+        self.assertEqual(variants.target_widths(5000), [320, 640, 1024, 1600])
+        self.assertEqual(variants.target_widths(100), [100])
+
+    def test_unsupported_formats_are_skipped(self):
+        """Formats Pillow cannot encode fall away, JPEG always stays."""
+        with override_settings(IMAGER_VARIANT_FORMATS=('bogus',)):
+            self.assertEqual(variants.formats(), ['jpeg'])
+        with override_settings(IMAGER_VARIANT_FORMATS=('webp', 'jpeg')):
+            expected = ['webp'] if variants.supported('webp') else []
+            self.assertEqual(variants.formats(), expected + ['jpeg'])
+
+    def test_render_variants_records_every_width_and_format(self):
+        """One row and file per configured width and format."""
+        rendered = variants.render_variants(self.photo)
+        self.assertEqual(len(rendered), 2 * len(variants.formats()))
+        for variant in PhotoVariant.objects.filter(photo=self.photo):
+            self.assertTrue(default_storage.exists(variant.file.name))
+            self.assertEqual(round(variant.width * 276 / 460.0),
+                             variant.height)
+
+    def test_small_variant_is_smaller_than_original(self):
+        """The narrowest variant saves bytes over the original."""
+        variants.render_variants(self.photo)
+        smallest = PhotoVariant.objects.filter(
+            photo=self.photo, format='jpeg').order_by('width').first()
+        self.assertLess(smallest.size, self.photo.photo.size)
+
+    def test_rerender_replaces_variants(self):
+        """Rendering again does not leave stale rows behind."""
+        variants.render_variants(self.photo)
+        variants.render_variants(self.photo)
+        self.assertEqual(PhotoVariant.objects.count(),
+                         2 * len(variants.formats()))
+
+    def test_deleting_photo_removes_variant_files(self):
+        """Variant files go when the photo does."""
+        variants.render_variants(self.photo)
+        names = [v.file.name for v in PhotoVariant.objects.all()]
+        self.photo.delete()
+        for name in names:
+            self.assertFalse(default_storage.exists(name))
+
+    def test_photo_page_emits_srcset(self):
+        """The photo page offers every width to the browser."""
+        variants.render_variants(self.photo)
+        response = self.client.get(reverse_lazy('single_photo',
+                                                kwargs={'pk': self.photo.id}))
+        html = BeautifulSoup(response.content, 'html.parser')
+        img = html.find('picture').find('img')
+        self.assertIn('320w', img['srcset'])
+        self.assertIn('460w', img['srcset'])
+        self.assertEqual(len(html.find('picture').find_all('source')),
+                         len(variants.formats()) - 1)
+
+    def test_photo_page_without_variants_uses_thumbnail(self):
+        """Photos not processed yet show the thumbnail, not the original."""
+        response = self.client.get(reverse_lazy('single_photo',
+                                                kwargs={'pk': self.photo.id}))
+        html = BeautifulSoup(response.content, 'html.parser')
+        img = html.find('picture').find('img')
+        thumbnail = get_thumbnail(self.photo.photo, '500x500', crop='center')
+        self.assertEqual(img['src'], thumbnail.url)
+        self.assertEqual(img['width'], str(thumbnail.width))
+
+    def test_shared_original_is_rendered_once(self):
+        """Photos with the same bytes reuse their blob's variants."""
+        first = self.blob_photo()
+        variants.render_variants(first)
+        second = self.blob_photo()
+        with self.assertNumQueries(2):
+            rendered = variants.render_variants(second)
+        self.assertEqual(len(rendered), 2 * len(variants.formats()))
+        self.assertEqual(PhotoVariant.objects.filter(
+            blob_id=first.blob_id).count(), len(rendered))
+        self.assertEqual(list(variants.of_photo(second)),
+                         list(variants.of_photo(first)))
+
+    def test_blob_is_locked_while_rendering(self):
+        """Photos sharing a blob render in turn, not over each other's files."""
+        photo = self.blob_photo()
+        with CaptureQueriesContext(connection) as queries:
+            variants.render_variants(photo)
+        locks = [query['sql'] for query in queries.captured_queries
+                 if 'imager_images_imageblob' in query['sql']]
+        self.assertEqual(len(locks), 1)
+        if connection.features.has_select_for_update:
+            self.assertIn('FOR UPDATE', locks[0])
+
+    def test_blob_variants_outlive_one_photo(self):
+        """Variant files stay until the last photo sharing them goes."""
+        first = self.blob_photo()
+        second = self.blob_photo()
+        variants.render_variants(first)
+        names = [v.file.name for v in variants.of_photo(first)]
+        first.delete()
+        self.assertTrue(all(default_storage.exists(name) for name in names))
+        second.delete()
+        self.assertFalse(any(default_storage.exists(name) for name in names))
+
+
+class TestAlbumCovers(TestCase):
+    """Albums keep a precomputed cover for their listings."""
+
+    def setUp(self):
+        """Create a user with public and private photos."""
+        use_temp_media(self)
+        cache.clear()
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.client.force_login(user)
+        self.public = [PhotoFactory.create(user=user, published='PB')
+                       for _ in range(2)]
+        self.private = PhotoFactory.create(user=user, published='PV')
+
+    def make_album(self, photos=(), **kwargs):
+        """Create a public album holding photos."""
+        album = AlbumFactory.create(user=self.user, published='PB', **kwargs)
+        album.photos.add(*photos)
+        album.refresh_from_db()
+        return album
+
+    def test_first_public_photo_is_fallback(self):
+        """Albums without a chosen cover show their first public photo."""
+        album = self.make_album([self.private] + self.public)
+        self.assertEqual(album.effective_cover, self.public[0])
+
+    def test_private_only_album_has_no_cover(self):
+        """Private photos are never used as a fallback."""
+        album = self.make_album([self.private])
+        self.assertIsNone(album.effective_cover)
+
+    def test_chosen_cover_wins(self):
+        """An explicit cover is used as is."""
+        album = self.make_album(self.public, cover=self.public[1])
+        self.assertEqual(album.effective_cover, self.public[1])
+
+    def test_removing_cover_photo_picks_next(self):
+        """Removing the fallback photo moves to the next public one."""
+        album = self.make_album(self.public)
+        album.photos.remove(self.public[0])
+        album.refresh_from_db()
+        self.assertEqual(album.effective_cover, self.public[1])
+
+    def test_adding_from_photo_side_updates_cover(self):
+        """Adding an album to a photo's albums is picked up too."""
+        album = self.make_album()
+        self.public[1].albums.add(album)
+        album.refresh_from_db()
+        self.assertEqual(album.effective_cover, self.public[1])
+
+    def test_hiding_photo_updates_cover(self):
+        """A cover photo going private is replaced."""
+        album = self.make_album(self.public)
+        self.public[0].published = 'PV'
+        self.public[0].save()
+        album.refresh_from_db()
+        self.assertEqual(album.effective_cover, self.public[1])
+
+    def test_deleting_photo_updates_cover(self):
+        """A deleted cover photo is replaced."""
+        album = self.make_album(self.public)
+        self.public[0].delete()
+        album.refresh_from_db()
+        self.assertEqual(album.effective_cover, self.public[1])
+
+    def assert_constant_queries(self, url):
+        """The page costs the same number of queries for 1 or 4 albums."""
+        self.make_album(self.public)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as one:
+            self.client.get(url)
+        for _ in range(3):
+            self.make_album(self.public)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(url)
+        self.assertEqual(len(one), len(many))
+
+    def test_album_list_constant_queries(self):
+        """The public album grid does not query per album."""
+        self.assert_constant_queries(reverse('albums'))
+
+    def test_library_constant_queries(self):
+        """The library album grid does not query per album."""
+        self.assert_constant_queries(reverse('library'))
+
+    def test_public_profile_constant_queries(self):
+        """The public profile album grid does not query per album."""
+        self.assert_constant_queries(
+            reverse('public_profile', kwargs={'request_username': 'morgan'}))
+
+
+class TestPageCache(TestCase):
+    """Anonymous public pages are cached until what they show changes."""
+
+    def setUp(self):
+        """Create a user with a public photo in a public album."""
+        use_temp_media(self)
+        cache.clear()
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.photo = PhotoFactory.create(user=user, published='PB',
+                                         title='First')
+        self.album = AlbumFactory.create(user=user, published='PB')
+        self.album.photos.add(self.photo)
+
+    def get(self, url):
+        """Fetch a page anonymously and return its text."""
+        return self.client.get(url).content.decode('utf-8')
+
+    def test_repeat_request_is_served_from_cache(self):
+        """A second anonymous request does not touch the database."""
+        url = reverse('photos')
+        first = self.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            second = self.get(url)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(first, second)
+
+    def test_logged_in_users_get_fresh_pages(self):
+        """Cached anonymous pages are not shown to logged in users."""
+        url = reverse('photos')
+        self.get(url)
+        self.client.force_login(self.user)
+        self.assertIn('Hi, ', self.get(url))
+
+    def test_new_public_photo_invalidates_listing(self):
+        """A photo going public shows up straight away."""
+        url = reverse('photos')
+        self.get(url)
+        PhotoFactory.create(user=self.user, published='PB', title='Second')
+        self.assertIn('Second', self.get(url))
+
+    def test_private_photo_keeps_listing_cached(self):
+        """Private changes do not throw away public pages."""
+        url = reverse('photos')
+        self.get(url)
+        PhotoFactory.create(user=self.user, published='PV')
+        with CaptureQueriesContext(connection) as queries:
+            self.get(url)
+        self.assertEqual(len(queries), 0)
+
+    def test_hiding_photo_invalidates_listing(self):
+        """A public photo going private disappears straight away."""
+        url = reverse('photos')
+        self.assertIn('First', self.get(url))
+        photo = Photo.objects.get(id=self.photo.id)
+        photo.published = 'PV'
+        photo.save()
+        self.assertNotIn('First', self.get(url))
+
+    def test_retitled_photo_card_is_refreshed(self):
+        """Editing a photo refreshes its cached card."""
+        url = reverse('single_album', kwargs={'pk': self.album.id})
+        self.assertIn('First', self.get(url))
+        self.photo.title = 'Renamed'
+        self.photo.save()
+        self.assertIn('Renamed', self.get(url))
+
+    def test_tagging_invalidates_tag_listing(self):
+        """Adding a tag to a public photo updates the tag listing."""
+        url = reverse('tagged_images', kwargs={'slug': 'cans'})
+        self.assertNotIn('First', self.get(url))
+        self.photo.tags.add('cans')
+        self.assertIn('First', self.get(url))
+
+    def test_album_membership_invalidates_album_page(self):
+        """Adding a photo to an album updates the album page."""
+        url = reverse('single_album', kwargs={'pk': self.album.id})
+        self.get(url)
+        other = PhotoFactory.create(user=self.user, published='PB',
+                                    title='Added')
+        self.album.photos.add(other)
+        self.assertIn('Added', self.get(url))
+
+    def test_deleting_album_invalidates_album_list(self):
+        """Deleted albums disappear from the public album list."""
+        url = reverse('albums')
+        self.assertIn(self.album.title, self.get(url))
+        self.album.delete()
+        self.assertNotIn(self.album.title, self.get(url))
+
+    def test_public_profile_invalidated_by_photo(self):
+        """A user's new public photo shows on their public profile."""
+        url = reverse('public_profile', kwargs={'request_username': 'morgan'})
+        self.get(url)
+        PhotoFactory.create(user=self.user, published='PB', title='Profiled')
+        self.assertIn('Profiled', self.get(url))
+
+    def test_bulk_upload_invalidates_listing(self):
+        """Public photos added in bulk show up straight away."""
+        url = reverse('photos')
+        self.get(url)
+        with open(os.path.join(HERE, 'static',
+                               'New-smaller-Coca-Cola-can-001.jpg'), 'rb') as f:
+            upload = SimpleUploadedFile(name='example-bulk.jpg',
+                                        content=f.read(),
+                                        content_type='image/jpeg')
+        bulk.bulk_upload(self.user, [upload], 'PB')
+        self.assertIn('example-bulk', self.get(url))
+
+    def test_unknown_profile_is_not_cached(self):
+        """A missing user's page is not cached for when they sign up."""
+        url = reverse('public_profile', kwargs={'request_username': 'jamie'})
+        self.assertIn("user doesn't exist", self.get(url))
+        User.objects.create(username='jamie')
+        self.assertNotIn("user doesn't exist", self.get(url))
+
+    @override_settings(IMAGER_MEDIA_URL_MODE='signed',
+                       AWS_QUERYSTRING_EXPIRE=600)
+    def test_signed_urls_cap_cache_timeouts(self):
+        """Pages and cards holding signed URLs expire before the URLs."""
+        timeouts = []
+        backend = caches['default']
+        original = backend.set
+
+        def record(key, value, timeout=None, version=None):
+            timeouts.append((key, timeout))
+            return original(key, value, timeout, version)
+        backend.set = record
+        try:
+            self.get(reverse('single_album', kwargs={'pk': self.album.id}))
+        finally:
+            del backend.set
+        stored = [timeout for key, timeout in timeouts
+                  if key.startswith(('imager_images:page:',
+                                     'template.cache.photo_card'))]
+        self.assertEqual(stored, [300, 300])
+
+
+class TestSearch(TestCase):
+    """Search finds public photos and albums by title, tags and text."""
+
+    def setUp(self):
+        """Create photos and an album to search through."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.can = PhotoFactory.create(user=user, published='PB',
+                                       title='Red can',
+                                       description='A cold drink.')
+        self.can.tags.add('soda')
+        self.beach = PhotoFactory.create(user=user, published='PB',
+                                         title='Beach',
+                                         description='Sand and waves.')
+        self.secret = PhotoFactory.create(user=user, published='PV',
+                                          title='Secret can')
+        self.album = AlbumFactory.create(user=user, published='PB',
+                                         title='Summer drinks')
+
+    def test_matches_title(self):
+        """Photos are found by title words."""
+        self.assertEqual(list(search.search_photos('can')), [self.can])
+
+    def test_matches_tags_and_description(self):
+        """Tag names and descriptions are searched too."""
+        self.assertEqual(list(search.search_photos('soda')), [self.can])
+        self.assertEqual(list(search.search_photos('waves')), [self.beach])
+
+    def test_all_words_must_match(self):
+        """Every word of the query has to match."""
+        self.assertEqual(list(search.search_photos('red drink')), [self.can])
+        self.assertEqual(list(search.search_photos('red waves')), [])
+
+    def test_private_photos_are_hidden(self):
+        """Private photos never show up in search."""
+        self.assertNotIn(self.secret, search.search_photos('secret'))
+
+    def test_empty_query_finds_nothing(self):
+        """A blank query returns no results."""
+        self.assertEqual(list(search.search_photos('  ')), [])
+
+    def test_matches_albums(self):
+        """Public albums are searched by title."""
+        self.assertEqual(list(search.search_albums('summer')), [self.album])
+
+    def test_search_page_lists_results(self):
+        """The search page links to matching photos and albums."""
+        response = self.client.get(reverse('search'), {'q': 'drink'})
+        html = BeautifulSoup(response.content, 'html.parser')
+        links = [a['href'] for a in html.find_all('a')]
+        self.assertIn(reverse('single_photo', kwargs={'pk': self.can.id}),
+                      links)
+        self.assertIn(reverse('single_album', kwargs={'pk': self.album.id}),
+                      links)
+
+    def test_search_page_paginates(self):
+        """Results are split into numbered pages."""
+        for _ in range(30):
+            PhotoFactory.create(user=self.user, published='PB',
+                                title='Another can')
+        response = self.client.get(reverse('search'), {'q': 'can'})
+        self.assertEqual(len(response.context['photo_list']), 24)
+        response = self.client.get(reverse('search'), {'q': 'can', 'page': 2})
+        self.assertEqual(len(response.context['photo_list']), 7)
+
+    def test_vector_sql_formats(self):
+        """The vector update statements fill in every table name."""
+        for sql in (search.PHOTO_VECTOR_SQL, search.ALBUM_VECTOR_SQL):
+            statement = sql.format(ids='', **search._tables())
+            self.assertNotIn('{', statement)
+
+    def test_rebuild_needs_postgres(self):
+        """Rebuilding vectors is refused on databases without tsvector."""
+        if search.enabled():
+            self.skipTest('Running against PostgreSQL.')
+        with self.assertRaises(CommandError):
+            call_command('rebuild_search_index')
+
+
+class TestTagPostings(TestCase):
+    """Multi-tag listings are served from per-tag posting lists."""
+
+    def setUp(self):
+        """Create public photos with overlapping tags."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.beach = PhotoFactory.create(user=user, published='PB',
+                                         title='Beach')
+        self.beach.tags.add('sea', 'sunset')
+        self.boat = PhotoFactory.create(user=user, published='PB',
+                                        title='Boat')
+        self.boat.tags.add('sea')
+        self.snow = PhotoFactory.create(user=user, published='PB',
+                                        title='Snow')
+        self.snow.tags.add('snow', 'sunset')
+        self.hidden = PhotoFactory.create(user=user, published='PV',
+                                          title='Hidden')
+        self.hidden.tags.add('sea', 'sunset')
+
+    def listed(self, slug, **params):
+        """Titles on a tag listing page."""
+        response = self.client.get(
+            reverse('tagged_images', kwargs={'slug': slug}), params)
+        return [photo.title for photo in response.context['photo_list']]
+
+    def test_encoding_round_trips(self):
+        """Ids survive packing into a posting list."""
+        ids = [1, 5, 70000, 2 ** 32 - 1]
+        self.assertEqual(postings.decode(postings.encode(ids)), ids)
+        self.assertEqual(postings.decode(b''), [])
+
+    def test_intersect_and_union(self):
+        """Sorted lists are combined without duplicates."""
+        self.assertEqual(postings.intersect([[1, 3, 5, 7], [3, 4, 7], [3, 7]]),
+                         [3, 7])
+        self.assertEqual(postings.intersect([[1, 2], []]), [])
+        self.assertEqual(postings.union([[1, 3], [2, 3], [5]]), [1, 2, 3, 5])
+
+    def test_parse_expression(self):
+        """Commas separate alternatives and pluses join required tags."""
+        self.assertEqual(postings.parse('a+b,c'), [['a', 'b'], ['c']])
+        self.assertEqual(postings.parse('a,,+'), [['a']])
+
+    def test_postings_track_public_photos(self):
+        """Only public photos appear in a tag's posting list."""
+        self.assertEqual(postings.photo_ids('sea'),
+                         [self.beach.id, self.boat.id])
+
+    def test_and_query(self):
+        """A plus lists photos carrying every tag."""
+        self.assertEqual(self.listed('sea+sunset'), ['Beach'])
+
+    def test_or_query(self):
+        """A comma lists photos carrying any of the tags, newest first."""
+        self.assertEqual(self.listed('sea,snow'), ['Snow', 'Boat', 'Beach'])
+
+    def test_unknown_tag_lists_nothing(self):
+        """A tag nobody used matches no photos."""
+        self.assertEqual(self.listed('sea+missing'), [])
+        self.assertEqual(self.listed('missing,snow'), ['Snow'])
+
+    def test_removing_tag_updates_posting(self):
+        """Untagging a photo drops it from the listing."""
+        self.beach.tags.remove('sunset')
+        self.assertEqual(self.listed('sunset'), ['Snow'])
+
+    def test_publishing_updates_posting(self):
+        """Publishing or hiding a photo adds or drops it."""
+        self.hidden.published = 'PB'
+        self.hidden.save()
+        self.assertEqual(self.listed('sea+sunset'), ['Hidden', 'Beach'])
+        self.beach.published = 'PV'
+        self.beach.save()
+        self.assertEqual(self.listed('sea+sunset'), ['Hidden'])
+
+    def test_deleting_photo_updates_posting(self):
+        """A deleted photo leaves its tags' posting lists."""
+        self.snow.delete()
+        self.assertEqual(postings.photo_ids('snow'), [])
+        self.assertEqual(postings.photo_ids('sunset'), [self.beach.id])
+
+    def test_bulk_upload_updates_postings(self):
+        """Public bulk uploads land in their tags' posting lists."""
+        with open(os.path.join(HERE, 'static',
+                               'New-smaller-Coca-Cola-can-001.jpg'), 'rb') as f:
+            content = f.read()
+        results = bulk.bulk_upload(
+            self.user, [SimpleUploadedFile('example.jpg', content,
+                                           content_type='image/jpeg')],
+            published='PB', tags=['sea'])
+        self.assertIn(results[0]['photo'].id, postings.photo_ids('sea'))
+
+    def test_listing_uses_constant_queries(self):
+        """Combining more tags doesn't add joins or queries."""
+        url = reverse('tagged_images', kwargs={'slug': 'sea'})
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as one:
+            self.client.get(url)
+        cache.clear()
+        url = reverse('tagged_images', kwargs={'slug': 'sea+sunset,snow'})
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(url)
+        self.assertEqual(len(one), len(many))
+
+    def test_pages_through_matches(self):
+        """Id cursors walk every matching photo exactly once."""
+        for _ in range(30):
+            PhotoFactory.create(user=self.user, published='PB').tags.add('sea')
+        seen = []
+        url = reverse('tagged_images', kwargs={'slug': 'sea'})
+        response = self.client.get(url)
+        seen.extend(response.context['photo_list'])
+        page = response.context['page_obj']
+        while page.has_next():
+            response = self.client.get(url, {'after': page.next_cursor})
+            seen.extend(response.context['photo_list'])
+            page = response.context['page_obj']
+        self.assertEqual(len(seen), 32)
+        self.assertEqual(len(set(seen)), 32)
+        back = self.client.get(url, {'before': page.previous_cursor})
+        self.assertEqual(len(back.context['photo_list']), 24)
+
+    def test_rebuild_matches_incremental(self):
+        """Rebuilding from the tag table gives the same posting lists."""
+        before = dict((slug, postings.photo_ids(slug))
+                      for slug in ('sea', 'sunset', 'snow'))
+        call_command('rebuild_tag_postings', stdout=StringIO())
+        for slug, ids in before.items():
+            self.assertEqual(postings.photo_ids(slug), ids)
+
+
+class TestPopularTags(TestCase):
+    """Tag popularity is kept in TagStat and served from the cache."""
+
+    def setUp(self):
+        """Create public and private photos sharing tags."""
+        use_temp_media(self)
+        cache.clear()
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.beach = PhotoFactory.create(user=user, published='PB')
+        self.beach.tags.add('sea', 'sunset')
+        self.boat = PhotoFactory.create(user=user, published='PB')
+        self.boat.tags.add('sea')
+        self.hidden = PhotoFactory.create(user=user, published='PV')
+        self.hidden.tags.add('sunset', 'secret')
+
+    def counts(self):
+        """Public photo counts by tag slug, straight from TagStat."""
+        return dict(TagStat.objects.filter(count__gt=0)
+                                   .values_list('tag__slug', 'count'))
+
+    def test_counts_public_photos(self):
+        """Only public photos count towards a tag."""
+        self.assertEqual(self.counts(), {'sea': 2, 'sunset': 1})
+
+    def test_last_used_is_set(self):
+        """Applying a tag to a public photo stamps it."""
+        stat = TagStat.objects.get(tag__slug='sea')
+        self.assertIsNotNone(stat.last_used)
+
+    def test_publish_transitions(self):
+        """Publishing or hiding a photo moves its tags' counts."""
+        self.hidden.published = 'PB'
+        self.hidden.save()
+        self.assertEqual(self.counts(),
+                         {'sea': 2, 'sunset': 2, 'secret': 1})
+        self.boat.published = 'PV'
+        self.boat.save()
+        self.assertEqual(self.counts(),
+                         {'sea': 1, 'sunset': 2, 'secret': 1})
+
+    def test_untag_and_delete(self):
+        """Removing tags or photos lowers the counts."""
+        self.beach.tags.remove('sunset')
+        self.boat.delete()
+        self.assertEqual(self.counts(), {'sea': 1})
+
+    def test_popular_tags_order(self):
+        """The most used tags come first."""
+        self.assertEqual([tag['slug'] for tag in popular_tags()],
+                         ['sea', 'sunset'])
+        self.assertEqual(popular_tags(1), [{'name': 'sea', 'slug': 'sea',
+                                            'count': 2}])
+
+    def test_popular_tags_cached(self):
+        """A cached cloud is served without touching the database."""
+        popular_tags()
+        with self.assertNumQueries(0):
+            popular_tags()
+
+    def test_popular_tags_one_query(self):
+        """Building the cloud is a single read."""
+        with self.assertNumQueries(1):
+            popular_tags()
+
+    def test_endpoint(self):
+        """The endpoint returns the popular tags as JSON."""
+        response = self.client.get(reverse('popular_tags'), {'limit': 1})
+        self.assertEqual(response.json(),
+                         {'limit': 1,
+                          'tags': [{'name': 'sea', 'slug': 'sea',
+                                    'count': 2}]})
+
+    @override_settings(IMAGER_POPULAR_TAGS_LIMIT=1)
+    def test_endpoint_limit_is_capped_at_cached_tags(self):
+        """Asking for more tags than are cached says how many it got."""
+        response = self.client.get(reverse('popular_tags'), {'limit': 100})
+        self.assertEqual(response.json()['limit'], 1)
+        self.assertEqual(len(response.json()['tags']), 1)
+
+    def test_endpoint_rejects_bad_limit(self):
+        """A non-numeric limit is a 400."""
+        response = self.client.get(reverse('popular_tags'), {'limit': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_home_page_cloud(self):
+        """The home page links the popular tags."""
+        response = self.client.get(reverse('home'))
+        html = BeautifulSoup(response.content, 'html.parser')
+        links = [a['href'] for a in html.find_all('a')]
+        self.assertIn(reverse('tagged_images', kwargs={'slug': 'sea'}), links)
+        self.assertNotIn(reverse('tagged_images', kwargs={'slug': 'secret'}),
+                         links)
+
+    def test_rebuild_matches_incremental(self):
+        """Rebuilding gives the same counts and keeps last use times."""
+        before = dict(TagStat.objects.values_list('tag__slug', 'last_used'))
+        call_command('rebuild_tag_postings', stdout=StringIO())
+        self.assertEqual(self.counts(), {'sea': 2, 'sunset': 1})
+        self.assertEqual(
+            dict(TagStat.objects.values_list('tag__slug', 'last_used')),
+            before)
+
+
+class DirectUploadMixin(object):
+    """Sends files through the direct upload views as a browser would."""
+
+    def setUp(self):
+        """Create a user and an image to upload."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.client.force_login(user)
+        with open(os.path.join(HERE, 'static',
+                               'New-smaller-Coca-Cola-can-001.jpg'), 'rb') as f:
+            self.content = f.read()
+
+    def grant(self, **params):
+        """Ask for an upload grant."""
+        data = {'filename': 'example.jpg', 'content_type': 'image/jpeg',
+                'size': len(self.content)}
+        data.update(params)
+        return self.client.post(reverse('direct_upload_start'), data)
+
+    def upload(self, content=None):
+        """Get a grant and send a file to it; returns the grant."""
+        content = self.content if content is None else content
+        grant = self.grant(size=len(content)).json()
+        client = Client()
+        response = client.put(grant['url'], content,
+                              content_type='image/jpeg')
+        self.assertEqual(response.status_code, 201)
+        return grant
+
+    def finalize(self, name, **params):
+        """Finish a direct upload."""
+        data = {'name': name, 'title': 'Direct', 'published': 'PB',
+                'tags': 'fast'}
+        data.update(params)
+        return self.client.post(reverse('direct_upload_finalize'), data)
+
+
+class TestDirectUpload(DirectUploadMixin, TestCase):
+    """Tests for presigned uploads that bypass the app servers."""
+
+    def test_upload_and_finalize_creates_photo(self):
+        """A granted upload plus finalize creates a photo with the bytes."""
+        grant = self.upload()
+        response = self.finalize(grant['name'])
+        self.assertEqual(response.status_code, 201)
+        photo = Photo.objects.get(id=response.json()['photo'])
+        self.assertEqual(photo.title, 'Direct')
+        self.assertEqual(list(photo.tags.names()), ['fast'])
+        photo.photo.open('rb')
+        self.assertEqual(photo.photo.read(), self.content)
+        photo.photo.close()
+
+    def test_grant_rejects_non_images(self):
+        """Only image content types are granted."""
+        response = self.grant(content_type='text/html')
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(IMAGER_UPLOAD_MAX_SIZE=10)
+    def test_grant_rejects_large_files(self):
+        """Files above the upload limit are refused up front."""
+        self.assertEqual(self.grant().status_code, 400)
+
+    def test_put_larger_than_granted(self):
+        """The stand-in refuses more bytes than were granted."""
+        grant = self.grant(size=10).json()
+        response = Client().put(grant['url'], self.content,
+                                content_type='image/jpeg')
+        self.assertEqual(response.status_code, 403)
+
+    def test_put_with_bad_token(self):
+        """A tampered grant is refused."""
+        grant = self.grant().json()
+        response = Client().put(grant['url'].replace('/direct/', '/direct/x'),
+                                self.content, content_type='image/jpeg')
+        self.assertEqual(response.status_code, 403)
+
+    def test_finalize_before_upload(self):
+        """Finalizing an object that never arrived fails."""
+        grant = self.grant().json()
+        self.assertEqual(self.finalize(grant['name']).status_code, 400)
+        self.assertFalse(Photo.objects.exists())
+
+    def test_finalize_twice(self):
+        """An upload becomes at most one photo."""
+        grant = self.upload()
+        self.finalize(grant['name'])
+        self.assertEqual(self.finalize(grant['name']).status_code, 400)
+        self.assertEqual(Photo.objects.count(), 1)
+
+    def test_finalize_checks_under_user_lock(self):
+        """The already finalized check and the insert hold the user's row."""
+        grant = self.upload()
+        with CaptureQueriesContext(connection) as queries:
+            direct_uploads.finalize(self.user, grant['name'])
+        sql = [query['sql'] for query in queries.captured_queries]
+        lock = next(i for i, query in enumerate(sql)
+                    if query.startswith('SELECT') and 'auth_user' in query)
+        insert = next(i for i, query in enumerate(sql)
+                      if query.startswith('INSERT INTO "imager_images_photo"'))
+        checks = [i for i, query in enumerate(sql)
+                  if 'imager_images_photo' in query and
+                  query.startswith('SELECT') and i < insert]
+        self.assertLess(lock, checks[-1])
+        if connection.features.has_select_for_update:
+            self.assertIn('FOR UPDATE', sql[lock])
+
+    def test_finalize_other_users_upload(self):
+        """Users can only finalize their own uploads."""
+        grant = self.upload()
+        other = User.objects.create(username='other')
+        self.client.force_login(other)
+        self.assertEqual(self.finalize(grant['name']).status_code, 400)
+
+    def test_finalize_rejects_non_images(self):
+        """An object that does not start like an image is deleted."""
+        grant = self.upload(b'<html><body>Not a photo</body></html>')
+        response = self.finalize(grant['name'])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Upload is not an image.')
+        self.assertFalse(Photo.objects.exists())
+        self.assertFalse(default_storage.exists(grant['name']))
+
+    def test_sniff_image_headers(self):
+        """Leading bytes are matched against the common image formats."""
+        self.assertEqual(direct_uploads.sniff(self.content[:16]),
+                         'image/jpeg')
+        self.assertEqual(direct_uploads.sniff(b'RIFF\x00\x00\x00\x00WEBPVP8 '),
+                         'image/webp')
+        self.assertIsNone(direct_uploads.sniff(b'GIF00a'))
+
+    def test_s3_header_is_a_ranged_get(self):
+        """Against S3 only the object's first bytes are fetched."""
+        from botocore.response import StreamingBody
+        from botocore.stub import Stubber
+        from imagersite import s3
+        self.addCleanup(s3.close_all)
+        storage = s3.PooledS3Storage(bucket='imager', access_key='key',
+                                     secret_key='secret',
+                                     region_name='us-east-1',
+                                     location='media')
+        header = self.content[:direct_uploads.HEADER_BYTES]
+        stubber = Stubber(storage.connection.meta.client)
+        stubber.add_response(
+            'get_object',
+            {'ContentType': 'image/jpeg',
+             'Body': StreamingBody(BytesIO(header), len(header))},
+            {'Bucket': 'imager', 'Key': 'media/direct_uploads/1/a/b.jpg',
+             'Range': 'bytes=0-15'})
+        with stubber:
+            self.assertEqual(
+                direct_uploads.read_header(storage, 'direct_uploads/1/a/b.jpg'),
+                ('image/jpeg', header))
+        stubber.assert_no_pending_responses()
+
+    def test_s3_grant_is_presigned_post(self):
+        """Against S3 the client gets a POST policy under the location."""
+        from imagersite.s3 import PooledS3Storage
+        storage = PooledS3Storage(bucket='imager', access_key='key',
+                                  secret_key='secret', region_name='us-east-1',
+                                  endpoint_url='http://localhost:9000',
+                                  location='media')
+        grant = direct_uploads.issue(self.user, 'example.jpg', 'image/jpeg',
+                                     len(self.content), storage=storage)
+        self.assertEqual(grant['method'], 'POST')
+        self.assertEqual(grant['url'], 'http://localhost:9000/imager')
+        self.assertTrue(grant['fields']['key'].startswith(
+            'media/direct_uploads/{}/'.format(self.user.id)))
+        self.assertIn('policy', grant['fields'])
+        self.assertEqual(grant['fields']['Content-Type'], 'image/jpeg')
+
+
+class TestDirectUploadProcessing(DirectUploadMixin, TransactionTestCase):
+    """Direct uploads are deduplicated or failed by background processing."""
+
+    def test_identical_uploads_share_one_blob(self):
+        """Processing moves each upload into the same content-addressed blob."""
+        names = [self.upload()['name'] for i in range(2)]
+        for name in names:
+            self.assertEqual(self.finalize(name).status_code, 201)
+        jobs.work('test', burst=True)
+        blob = ImageBlob.objects.get()
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(
+            set(Photo.objects.values_list('blob_id', 'photo')),
+            {(blob.id, blob.name)})
+        for name in names:
+            self.assertFalse(default_storage.exists(name))
+        self.assertEqual(
+            os.listdir(os.path.join(settings.MEDIA_ROOT, 'user_images',
+                                    blob.sha256[:2])),
+            [os.path.basename(blob.name)])
+
+    def test_undecodable_upload_fails_without_retrying(self):
+        """An image header over broken data fails its photo on the first try."""
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        grant = self.upload(b'\xff\xd8\xff' + b'\x00' * 100)
+        photo_id = self.finalize(grant['name']).json()['photo']
+        self.assertEqual(jobs.work('test', burst=True), 1)
+        self.assertTrue(Photo.objects.get(id=photo_id).processing_failed)
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (jobs.FAILED, 1))
+        self.assertIn('does not decode', job.last_error)
+
+
+@override_settings(IMAGER_JOB_MAX_ATTEMPTS=3, IMAGER_JOB_BACKOFF=10)
+class TestJobs(TestCase):
+    """Tests for the database-backed job queue."""
+
+    def setUp(self):
+        """Forget jobs run by earlier tests and quiet failure logs."""
+        del RAN_JOBS[:]
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        """Log again."""
+        logging.disable(logging.NOTSET)
+
+    def test_enqueue_is_idempotent(self):
+        """A key that is already queued is not queued twice."""
+        jobs.enqueue('imager_images.tests.record_job', [1], key='k')
+        jobs.enqueue('imager_images.tests.record_job', [1], key='k')
+        self.assertEqual(Job.objects.count(), 1)
+        self.assertEqual(jobs.work('test', burst=True), 1)
+        self.assertEqual(RAN_JOBS, [[1]])
+
+    def test_finished_key_is_queued_again(self):
+        """Enqueueing a done job's key runs it again."""
+        jobs.enqueue('imager_images.tests.record_job', [1], key='k')
+        jobs.work('test', burst=True)
+        jobs.enqueue('imager_images.tests.record_job', [2], key='k')
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (jobs.QUEUED, 0))
+        jobs.work('test', burst=True)
+        self.assertEqual(RAN_JOBS, [[1], [2]])
+
+    def test_enqueue_many_in_a_few_queries(self):
+        """Queueing many photos costs a constant number of queries."""
+        with self.assertNumQueries(4):
+            jobs.enqueue_many('imager_images.tests.record_job',
+                              [(str(i), [i]) for i in range(20)])
+        self.assertEqual(Job.objects.count(), 20)
+
+    def test_failures_back_off_then_fail(self):
+        """A failing job is retried later, then marked failed."""
+        jobs.enqueue('imager_images.tests.failing_job', key='k')
+        self.assertFalse(jobs.run(jobs.claim('test')))
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (jobs.QUEUED, 1))
+        self.assertIn('Storage unavailable', job.last_error)
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertIsNone(jobs.claim('test'))
+        for attempt in range(2):
+            Job.objects.update(run_at=timezone.now())
+            jobs.run(jobs.claim('test'))
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (jobs.FAILED, 3))
+        self.assertIsNone(jobs.claim('test'))
+
+    def test_permanent_error_fails_at_once(self):
+        """A job that cannot succeed is not retried."""
+        jobs.enqueue('imager_images.tests.rejecting_job', key='k')
+        self.assertFalse(jobs.run(jobs.claim('test')))
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (jobs.FAILED, 1))
+        self.assertIn('Not an image', job.last_error)
+
+    def test_backoff_grows(self):
+        """Each retry waits about twice as long as the last."""
+        self.assertTrue(5 <= jobs.backoff(1) <= 10)
+        self.assertTrue(40 <= jobs.backoff(4) <= 80)
+
+    def test_claimed_job_is_not_claimed_twice(self):
+        """A running job belongs to the worker that claimed it."""
+        jobs.enqueue('imager_images.tests.record_job', key='k')
+        self.assertEqual(jobs.claim('one').locked_by, 'one')
+        self.assertIsNone(jobs.claim('two'))
+
+    def test_abandoned_job_is_claimed_again(self):
+        """A job whose worker died is picked up after the timeout."""
+        jobs.enqueue('imager_images.tests.record_job', key='k')
+        jobs.claim('dead')
+        Job.objects.update(locked_at=timezone.now() -
+                           datetime.timedelta(seconds=jobs.timeout() + 1))
+        job = jobs.claim('alive')
+        self.assertEqual((job.locked_by, job.attempts), ('alive', 2))
+        self.assertTrue(jobs.run(job))
+
+    def test_abandoned_job_fails_at_max_attempts(self):
+        """A job whose worker dies on every attempt is not claimed forever."""
+        jobs.enqueue('imager_images.tests.record_job', key='k')
+        for attempt in range(3):
+            Job.objects.update(locked_at=timezone.now() -
+                               datetime.timedelta(seconds=jobs.timeout() + 1))
+            self.assertIsNotNone(jobs.claim('dead'))
+        Job.objects.update(locked_at=timezone.now() -
+                           datetime.timedelta(seconds=jobs.timeout() + 1))
+        self.assertIsNone(jobs.claim('alive'))
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (jobs.FAILED, 3))
+        self.assertIn('stopped', job.last_error)
+        self.assertEqual(RAN_JOBS, [])
+
+    def test_requeued_while_running_runs_again(self):
+        """Queueing a running job's key leaves it queued when it finishes."""
+        jobs.enqueue('imager_images.tests.record_job', [1], key='k')
+        job = jobs.claim('test')
+        jobs.enqueue('imager_images.tests.record_job', [2], key='k')
+        self.assertEqual(Job.objects.get().status, jobs.RUNNING)
+        self.assertIsNone(jobs.claim('other'))
+        jobs.run(job)
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts, job.rerun),
+                         (jobs.QUEUED, 0, False))
+        self.assertEqual(jobs.work('test', burst=True), 1)
+        self.assertEqual(RAN_JOBS, [[1], [2]])
+        self.assertEqual(Job.objects.get().status, jobs.DONE)
+
+    def test_requeued_while_failing_starts_afresh(self):
+        """A job queued again during its last attempt is not failed."""
+        jobs.enqueue('imager_images.tests.failing_job', key='k')
+        Job.objects.update(attempts=2)
+        job = jobs.claim('test')
+        jobs.enqueue('imager_images.tests.record_job', [1], key='k')
+        self.assertFalse(jobs.run(job))
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (jobs.QUEUED, 0))
+        self.assertLessEqual(job.run_at, timezone.now())
+
+    def test_run_jobs_command(self):
+        """The command drains the queue in burst mode."""
+        jobs.enqueue('imager_images.tests.record_job', [1])
+        jobs.enqueue('imager_images.tests.record_job', [2])
+        out = StringIO()
+        call_command('run_jobs', workers=1, burst=True, stdout=out)
+        self.assertIn('Ran 2 jobs', out.getvalue())
+        self.assertEqual(sorted(RAN_JOBS), [[1], [2]])
+
+
+class TestPhotoMetadata(TransactionTestCase):
+    """EXIF metadata is read at ingest and originals are turned upright.
+
+    Old originals are released on commit, so these tests commit.
+    """
+
+    def setUp(self):
+        """Create a user and a sideways photo taken with GPS on."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        self.content = jpeg_bytes(
+            orientation=6, make='Canon', model='EOS 5D',
+            taken='2017:06:01 12:30:00',
+            gps=('N', (52, 30, 0), 'W', (1, 15, 0)))
+
+    def tearDown(self):
+        """Delete photos so shared originals are released."""
+        Photo.objects.all().delete()
+
+    def make_photo(self, content=None, blob=True):
+        """A photo whose original holds content, shared or legacy."""
+        upload = SimpleUploadedFile('example.jpg', content or self.content,
+                                    content_type='image/jpeg')
+        photo = Photo(user=self.user, title='Sideways', published='PB')
+        if blob:
+            blobs.attach(photo, upload)
+        else:
+            photo.photo = upload
+        photo.save()
+        return photo
+
+    def test_read_exif(self):
+        """Camera, time and position come out as field values."""
+        image = Image.open(BytesIO(self.content))
+        values = metadata.read_exif(image)
+        self.assertEqual(values['orientation'], 6)
+        self.assertEqual((values['camera_make'], values['camera_model']),
+                         ('Canon', 'EOS 5D'))
+        self.assertEqual(values['taken_at'], timezone.make_aware(
+            datetime.datetime(2017, 6, 1, 12, 30)))
+        self.assertAlmostEqual(values['latitude'], 52.5)
+        self.assertAlmostEqual(values['longitude'], -1.25)
+
+    def test_missing_or_broken_exif(self):
+        """Images without EXIF get empty values, not errors."""
+        image = Image.new('RGB', (10, 10))
+        self.assertEqual(metadata.read_exif(image)['orientation'], 1)
+        self.assertIsNone(metadata.parse_datetime('0000:00:00 00:00:00'))
+        self.assertIsNone(metadata.parse_coordinate((), 'N', 'S'))
+        self.assertIsNone(metadata.reset_orientation(b'not exif'))
+
+    def test_reset_orientation(self):
+        """Only the orientation tag changes."""
+        raw = exif_bytes(orientation=8, make='Canon')
+        reset = metadata.reset_orientation(raw)
+        self.assertEqual(len(reset), len(raw))
+        self.assertEqual(reset, exif_bytes(orientation=1, make='Canon'))
+
+    def test_ingest_stores_metadata_and_turns_original_upright(self):
+        """The stored original is upright with its orientation reset."""
+        photo = self.make_photo()
+        old_name = photo.photo.name
+        self.assertEqual(metadata.ingest(photo), [])
+        photo = Photo.objects.get(id=photo.id)
+        self.assertEqual((photo.width, photo.height), (20, 40))
+        self.assertEqual(photo.camera_model, 'EOS 5D')
+        self.assertAlmostEqual(photo.latitude, 52.5)
+        self.assertNotEqual(photo.photo.name, old_name)
+        self.assertFalse(default_storage.exists(old_name))
+        self.assertEqual(photo.blob.name, photo.photo.name)
+        with default_storage.open(photo.photo.name) as f:
+            image = Image.open(BytesIO(f.read()))
+        self.assertEqual(image.size, (20, 40))
+        self.assertEqual(metadata.read_exif(image)['orientation'], 1)
+        # Turned clockwise, the red left half ends up on top.
+        red, green, blue = image.getpixel((10, 5))
+        self.assertGreater(red, blue)
+
+    def test_ingest_retires_cached_cards(self):
+        """Turning a photo upright gives it a new modification stamp."""
+        photo = self.make_photo()
+        stamp = photo.date_modified
+        metadata.ingest(photo)
+        self.assertGreater(Photo.objects.get(id=photo.id).date_modified,
+                           stamp)
+
+    def test_rolled_back_ingest_keeps_the_original(self):
+        """Old files are only let go once the new blob is committed."""
+        photo = self.make_photo()
+        old_name = photo.photo.name
+        with self.assertRaises(IOError):
+            with transaction.atomic():
+                metadata.ingest(photo)
+                raise IOError('Storage unavailable.')
+        self.assertTrue(default_storage.exists(old_name))
+        photo = Photo.objects.get(id=photo.id)
+        self.assertEqual(photo.photo.name, old_name)
+        self.assertIsNone(photo.width)
+
+    def test_ingest_moves_photos_sharing_the_original(self):
+        """Every photo on the old blob moves to the upright one."""
+        first = self.make_photo()
+        second = self.make_photo()
+        self.assertEqual(metadata.ingest(first), [second])
+        first, second = Photo.objects.get(id=first.id), Photo.objects.get(
+            id=second.id)
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(second.height, 40)
+        self.assertEqual(ImageBlob.objects.count(), 1)
+        self.assertEqual(ImageBlob.objects.get().refcount, 2)
+
+    def test_photo_moved_by_another_ingest_is_left_alone(self):
+        """A sharer whose ingest waited on the blob takes no new references."""
+        first = self.make_photo()
+        second = self.make_photo()
+        with transaction.atomic():
+            metadata.ingest(first)
+            # The second photo's job read it before the first moved it.
+            self.assertEqual(metadata.ingest(second), [])
+        self.assertEqual(second.blob_id, first.blob_id)
+        self.assertEqual(second.photo.name, first.photo.name)
+        self.assertEqual(ImageBlob.objects.get().refcount, 2)
+
+    def test_ingest_legacy_photo(self):
+        """A photo stored before blobs gets a blob when rotated."""
+        photo = self.make_photo(blob=False)
+        old_name = photo.photo.name
+        metadata.ingest(photo)
+        photo = Photo.objects.get(id=photo.id)
+        self.assertIsNotNone(photo.blob_id)
+        self.assertFalse(default_storage.exists(old_name))
+
+    def test_upright_photo_keeps_its_original(self):
+        """Nothing is re-encoded when no rotation is needed."""
+        photo = self.make_photo(jpeg_bytes(taken='2016:01:02 03:04:05'))
+        name = photo.photo.name
+        metadata.ingest(photo)
+        photo = Photo.objects.get(id=photo.id)
+        self.assertEqual(photo.photo.name, name)
+        self.assertEqual((photo.width, photo.height), (40, 20))
+        self.assertEqual(photo.taken_at.year, 2016)
+        self.assertIsNone(photo.latitude)
+
+    def test_backfill_command_queues_photos_without_metadata(self):
+        """Only photos never ingested are queued, unless --all is given."""
+        done = self.make_photo()
+        metadata.ingest(done)
+        pending = self.make_photo(jpeg_bytes())
+        out = StringIO()
+        call_command('extract_photo_metadata', stdout=out)
+        self.assertIn('Queued 1 photos', out.getvalue())
+        self.assertEqual(Job.objects.get().key,
+                         'ingest_photo:{}'.format(pending.id))
+        call_command('extract_photo_metadata', reread=True, stdout=out)
+        self.assertEqual(Job.objects.count(), 2)
+
+    def test_ingest_job_reprocesses_rotated_photos(self):
+        """A backfilled photo that was turned gets its thumbnails again."""
+        photo = self.make_photo()
+        thumbnails.ingest_photo_id(photo.id)
+        self.assertEqual(list(Job.objects.values_list('key', flat=True)),
+                         ['process_photo:{}'.format(photo.id)])
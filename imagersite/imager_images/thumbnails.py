@@ -0,0 +1,194 @@
+"""Pre-render the project's standard thumbnails off the request path."""
+from django.conf import settings
+from django.utils.six import string_types
+from sorl.thumbnail import default, get_thumbnail
+from sorl.thumbnail.conf import defaults as sorl_defaults
+from sorl.thumbnail.conf import settings as sorl_settings
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.models import KVStore
+from . import blobs, jobs, metadata, similarity, variants
+from .models import Photo
+
+DEFAULT_GEOMETRIES = (
+    ('100x100', {'crop': 'center'}),
+    ('200x200', {'crop': 'center'}),
+    ('500x500', {'crop': 'center'}),
+)
+
+
+def geometries():
+    """Return the (geometry, options) pairs the templates render."""
+    return getattr(settings, 'IMAGER_THUMBNAIL_GEOMETRIES', DEFAULT_GEOMETRIES)
+
+
+def geometry_options(geometry):
+    """Return the options a standard geometry is rendered with."""
+    return dict(geometries()).get(geometry, {})
+
+
+def thumbnail_file(file_, geometry, options):
+    """Build the ImageFile sorl would look up, without touching storage.
+
+    Mirrors the option defaults in ThumbnailBackend.get_thumbnail so the
+    name and key match what the {% thumbnail %} tag uses.
+    """
+    backend = default.backend
+    source = ImageFile(file_)
+    options = dict(options)
+    if sorl_settings.THUMBNAIL_PRESERVE_FORMAT:
+        options.setdefault('format', backend._get_format(source))
+    for key, value in backend.default_options.items():
+        options.setdefault(key, value)
+    for key, attr in backend.extra_options:
+        value = getattr(sorl_settings, attr)
+        if value != getattr(sorl_defaults, attr):
+            options.setdefault(key, value)
+    name = backend._get_thumbnail_filename(source, geometry, options)
+    return ImageFile(name, default.storage)
+
+
+def _get_many_raw(keys):
+    """Fetch raw key value store entries in one cache and one db round trip."""
+    kvstore = default.kvstore
+    kv_cache = getattr(kvstore, 'cache', None)
+    if kv_cache is None:
+        return dict((key, kvstore._get_raw(key)) for key in keys)
+    found = kv_cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        stored = dict(KVStore.objects
+                      .filter(key__in=missing)
+                      .values_list('key', 'value'))
+        kv_cache.set_many(stored, sorl_settings.THUMBNAIL_CACHE_TIMEOUT)
+        found.update(stored)
+    # Skip the cached_db store's "known missing" sentinel.
+    return dict((key, value) for key, value in found.items()
+                if isinstance(value, string_types))
+
+
+def prefetch_thumbnails(photos, geometry):
+    """Resolve one geometry's thumbnails for a list of photos at once.
+
+    Each photo gets its thumbnail stored under its geometry for the
+    prefetched_thumbnail template tag. Thumbnails missing from the store
+    fall back to sorl, which renders them as before.
+    """
+    options = geometry_options(geometry)
+    wanted = dict((photo.id, thumbnail_file(photo.photo, geometry, options))
+                  for photo in photos if photo.photo)
+    raw = _get_many_raw([add_prefix(thumbnail.key)
+                         for thumbnail in wanted.values()])
+    for photo in photos:
+        if not hasattr(photo, '_prefetched_thumbnails'):
+            photo._prefetched_thumbnails = {}
+        thumbnail = wanted.get(photo.id)
+        if thumbnail is None:
+            photo._prefetched_thumbnails[geometry] = None
+            continue
+        value = raw.get(add_prefix(thumbnail.key))
+        if value is None:
+            photo._prefetched_thumbnails[geometry] = get_thumbnail(
+                photo.photo, geometry, **options)
+        else:
+            photo._prefetched_thumbnails[geometry] = deserialize_image_file(value)
+    return photos
+
+
+def render_thumbnails(photo):
+    """Render every standard thumbnail for a photo and return them."""
+    if not photo.photo:
+        return []
+    return [get_thumbnail(photo.photo, geometry, **options)
+            for geometry, options in geometries()]
+
+
+def fail_photo(photo, error):
+    """Mark a photo whose original does not decode; its job is not retried."""
+    Photo.objects.filter(id=photo.id).update(processing_failed=True)
+    raise jobs.PermanentError('Photo {} does not decode: {}'.format(
+        photo.id, error))
+
+
+def process_photo(photo):
+    """Run the post-upload work: metadata, thumbnails, variants, hash.
+
+    An original not yet in a blob is hashed into one first, and metadata
+    comes next, since it may rotate the original upright. An original
+    that does not decode marks the photo failed and raises PermanentError,
+    so its job is not retried.
+    """
+    if not photo.photo:
+        return
+    try:
+        if photo.blob_id is None:
+            blobs.adopt(photo)
+        enqueue_many(metadata.ingest(photo))
+        render_thumbnails(photo)
+        variants.render_variants(photo)
+    except metadata.UnreadableImage as error:
+        fail_photo(photo, error)
+    if photo.processing_failed:
+        # A replaced original decoded this time.
+        Photo.objects.filter(id=photo.id).update(processing_failed=False)
+    similarity.index_photo(photo)
+
+
+def render_photo(photo_id):
+    """Render thumbnails for a photo id, skipping deleted photos."""
+    photo = Photo.objects.filter(id=photo_id).first()
+    if photo is not None:
+        render_thumbnails(photo)
+
+
+def process_photo_id(photo_id):
+    """Process a photo by id, skipping deleted photos."""
+    photo = Photo.objects.filter(id=photo_id).first()
+    if photo is not None:
+        process_photo(photo)
+
+
+def ingest_photo_id(photo_id):
+    """Read a photo's metadata by id, reprocessing any it rotated."""
+    photo = Photo.objects.filter(id=photo_id).first()
+    if photo is None:
+        return
+    name = photo.photo.name
+    try:
+        moved = metadata.ingest(photo)
+    except metadata.UnreadableImage as error:
+        fail_photo(photo, error)
+    if photo.photo.name != name:
+        enqueue_many([photo] + moved)
+
+
+PROCESS_TASK = 'imager_images.thumbnails.process_photo_id'
+
+INGEST_TASK = 'imager_images.thumbnails.ingest_photo_id'
+
+
+def enqueue_many(photos):
+    """Queue post-upload processing for photos with the run_jobs workers.
+
+    The jobs are written in the current transaction, so the view returns
+    without waiting on any image work. Each photo has one job key, so
+    replacing a photo's image before its job ran queues nothing extra.
+    With IMAGER_THUMBNAIL_ASYNC off the photos are processed inline,
+    which keeps tests and management shells deterministic.
+    """
+    if not getattr(settings, 'IMAGER_THUMBNAIL_ASYNC', True):
+        for photo in photos:
+            try:
+                process_photo(photo)
+            except jobs.PermanentError:
+                # The photo is marked failed, as a worker would leave it.
+                pass
+        return
+    jobs.enqueue_many(PROCESS_TASK,
+                      [('process_photo:{}'.format(photo.id), [photo.id])
+                       for photo in photos])
+
+
+def enqueue(photo):
+    """Queue post-upload processing for one photo."""
+    enqueue_many([photo])
@@ -0,0 +1,285 @@
+"""Resumable, chunked uploads that stream straight into storage."""
+import calendar
+import hashlib
+import logging
+import os
+import tempfile
+import uuid
+from datetime import timedelta
+from tempfile import SpooledTemporaryFile
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler,
+    TemporaryFileUploadHandler
+)
+from django.utils import timezone
+from .blobs import digest_of, save_content
+from .models import ChunkedUpload
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER = 64 * 1024
+
+# S3 rejects multipart parts under 5MB, except for the last one.
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class UploadError(Exception):
+    """A chunk could not be accepted."""
+
+
+class HashingUploadMixin(object):
+    """Hash uploaded files chunk by chunk as they stream in.
+
+    The finished file carries its hex digest as a sha256 attribute, so
+    deduplication does not need a second pass over the bytes.
+    """
+
+    def new_file(self, *args, **kwargs):
+        """Start a fresh digest for each file."""
+        self.sha = hashlib.sha256()
+        super(HashingUploadMixin, self).new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        """Feed the chunk to the digest before storing it."""
+        self.sha.update(raw_data)
+        return super(HashingUploadMixin, self).receive_data_chunk(raw_data,
+                                                                  start)
+
+    def file_complete(self, file_size):
+        """Attach the digest to the completed file."""
+        upload = super(HashingUploadMixin, self).file_complete(file_size)
+        if upload is not None:
+            upload.sha256 = self.sha.hexdigest()
+        return upload
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin,
+                                     MemoryFileUploadHandler):
+    """Keep small uploads in memory, hashing them on the way in."""
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin,
+                                        TemporaryFileUploadHandler):
+    """Spool large uploads to disk, hashing them on the way in."""
+
+
+def max_upload_size():
+    """Largest original an upload may declare."""
+    return getattr(settings, 'IMAGER_UPLOAD_MAX_SIZE', 200 * 1024 * 1024)
+
+
+def expiry():
+    """Seconds an unfinished upload may sit idle before it is discarded."""
+    return getattr(settings, 'IMAGER_UPLOAD_EXPIRES', 24 * 60 * 60)
+
+
+def max_chunk_size():
+    """Largest chunk a single request may carry."""
+    return getattr(settings, 'IMAGER_UPLOAD_MAX_CHUNK', 8 * 1024 * 1024)
+
+
+def temp_dir():
+    """Directory holding partial local uploads."""
+    path = getattr(settings, 'IMAGER_UPLOAD_TEMP_DIR',
+                   os.path.join(tempfile.gettempdir(), 'imager_uploads'))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def upload_key(filename):
+    """Pick the storage name a finished upload will live under."""
+    name = default_storage.get_valid_name(os.path.basename(filename))
+    return 'user_images/{}_{}'.format(uuid.uuid4().hex[:12], name)
+
+
+def copy_stream(stream, dest, length):
+    """Copy exactly length bytes from stream to dest in small buffers."""
+    remaining = length
+    while remaining:
+        data = stream.read(min(COPY_BUFFER, remaining))
+        if not data:
+            raise UploadError('Chunk ended early.')
+        dest.write(data)
+        remaining -= len(data)
+
+
+class LocalSink(object):
+    """Append chunks to a temporary file, then hand it to storage."""
+
+    def __init__(self, upload):
+        """Locate the partial file for an upload."""
+        self.upload = upload
+        self.path = os.path.join(temp_dir(), str(upload.id))
+
+    def start(self):
+        """Create the empty partial file."""
+        open(self.path, 'wb').close()
+
+    def append(self, stream, length):
+        """Write a chunk at the upload's current offset."""
+        with open(self.path, 'r+b') as part:
+            # Drop any bytes left over from an interrupted chunk.
+            part.truncate(self.upload.offset)
+            part.seek(self.upload.offset)
+            copy_stream(stream, part, length)
+
+    def finish(self):
+        """Move the assembled file into content-addressed storage.
+
+        Returns the storage name and the content digest.
+        """
+        with open(self.path, 'rb') as part:
+            upload = File(part, name=self.upload.filename)
+            digest = digest_of(upload)
+            name = save_content(upload, digest)
+        os.remove(self.path)
+        return name, digest
+
+    def abort(self):
+        """Throw away the partial file."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class S3Sink(object):
+    """Send each chunk as one part of an S3 multipart upload."""
+
+    def __init__(self, upload):
+        """Resolve the bucket and key for an upload."""
+        self.upload = upload
+        self.client = default_storage.connection.meta.client
+        self.target = {
+            'Bucket': default_storage.bucket_name,
+            'Key': default_storage._encode_name(
+                default_storage._normalize_name(
+                    default_storage._clean_name(upload.key))),
+        }
+
+    def start(self):
+        """Initiate the multipart upload."""
+        response = self.client.create_multipart_upload(
+            ACL=default_storage.default_acl, **self.target)
+        self.upload.upload_id = response['UploadId']
+
+    def append(self, stream, length):
+        """Upload a chunk as the next part, spooling it to bound memory."""
+        last = self.upload.offset + length >= self.upload.size
+        if length < S3_MIN_PART_SIZE and not last:
+            raise UploadError('Chunks must be at least {} bytes.'.format(
+                S3_MIN_PART_SIZE))
+        with SpooledTemporaryFile(max_size=COPY_BUFFER * 16) as spool:
+            copy_stream(stream, spool, length)
+            spool.seek(0)
+            self.client.upload_part(Body=spool,
+                                    PartNumber=self.upload.parts + 1,
+                                    UploadId=self.upload.upload_id,
+                                    **self.target)
+        self.upload.parts += 1
+
+    def finish(self):
+        """Stitch the parts together and return the storage name.
+
+        The parts never pass through this server, so there is no digest
+        to deduplicate on.
+        """
+        pages = self.client.get_paginator('list_parts').paginate(
+            UploadId=self.upload.upload_id, **self.target)
+        parts = [{'ETag': part['ETag'], 'PartNumber': part['PartNumber']}
+                 for page in pages for part in page.get('Parts', [])]
+        self.client.complete_multipart_upload(
+            UploadId=self.upload.upload_id,
+            MultipartUpload={'Parts': parts},
+            **self.target)
+        return self.upload.key, None
+
+    def abort(self):
+        """Cancel the multipart upload and free its parts."""
+        self.client.abort_multipart_upload(UploadId=self.upload.upload_id,
+                                           **self.target)
+
+
+def sink_for(upload):
+    """Return the sink matching the configured file storage."""
+    if hasattr(default_storage, 'bucket_name'):
+        return S3Sink(upload)
+    return LocalSink(upload)
+
+
+def remove_local_orphans(keep, cutoff):
+    """Delete partial files older than cutoff that no upload is using."""
+    if timezone.is_naive(cutoff):
+        cutoff = timezone.make_aware(cutoff)
+    cutoff_time = calendar.timegm(cutoff.utctimetuple())
+    removed = 0
+    directory = temp_dir()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name in keep or os.path.getmtime(path) >= cutoff_time:
+            continue
+        os.remove(path)
+        removed += 1
+    return removed
+
+
+def abort_s3_orphans(storage, keep, cutoff):
+    """Abort multipart uploads begun before cutoff that no upload is using.
+
+    Parts of an unfinished multipart upload are billed until aborted,
+    even though they never show up as objects.
+    """
+    client = storage.connection.meta.client
+    pages = client.get_paginator('list_multipart_uploads').paginate(
+        Bucket=storage.bucket_name,
+        Prefix=storage._normalize_name('user_images/'))
+    if timezone.is_naive(cutoff):
+        cutoff = timezone.make_aware(cutoff)
+    aborted = 0
+    for page in pages:
+        for part in page.get('Uploads', []):
+            if part['UploadId'] in keep or part['Initiated'] >= cutoff:
+                continue
+            client.abort_multipart_upload(Bucket=storage.bucket_name,
+                                          Key=part['Key'],
+                                          UploadId=part['UploadId'])
+            aborted += 1
+    return aborted
+
+
+def expire_uploads(now=None):
+    """Discard uploads left idle past expiry() and whatever they stored.
+
+    Returns how many uploads were aborted, how many finished upload rows
+    were deleted, and how many orphaned partial files or multipart
+    uploads were removed.
+    """
+    cutoff = (now or timezone.now()) - timedelta(seconds=expiry())
+    # A completing upload idle this long lost its request mid-way.
+    idle = ChunkedUpload.objects.filter(status__in=('AC', 'CG'),
+                                        date_modified__lt=cutoff)
+    aborted = 0
+    for upload in idle.iterator():
+        # Losing the update means a chunk arrived since; leave it be.
+        if not idle.filter(id=upload.id).update(status='AB'):
+            continue
+        try:
+            sink_for(upload).abort()
+        except Exception:
+            logger.exception('Could not abort upload %s', upload.id)
+        aborted += 1
+    deleted, _ = (ChunkedUpload.objects
+                  .filter(status__in=('CP', 'AB'), date_modified__lt=cutoff)
+                  .delete())
+    active = ChunkedUpload.objects.filter(status__in=('AC', 'CG'))
+    if hasattr(default_storage, 'bucket_name'):
+        orphans = abort_s3_orphans(
+            default_storage,
+            set(active.values_list('upload_id', flat=True)), cutoff)
+    else:
+        orphans = remove_local_orphans(
+            set(str(upload_id) for upload_id in
+                active.values_list('id', flat=True)), cutoff)
+    return aborted, deleted, orphans
@@ -7,23 +7,49 @@ from .views import (
     PhotoDetailView,
     PhotoListView,
     PhotoCreate,
+    PhotoBulkCreate,
     PhotoEdit,
     AlbumCreate,
     AlbumEdit,
-    TagListView
+    DirectUploadFinalize,
+    DirectUploadPut,
+    DirectUploadStart,
+    PopularTagsView,
+    SearchView,
+    TagListView,
+    UploadStart,
+    UploadChunk,
+    UploadComplete
 )
 
+UUID = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+
 urlpatterns = [
     url(r'^library/$', LibraryView.as_view(), name='library'),
     url(r'^photos/(?P<pk>\d+)/$', PhotoDetailView.as_view(),
         name='single_photo'),
     url(r'^photos/add/$', PhotoCreate.as_view(), name='photo_add'),
+    url(r'^photos/add/bulk/$', PhotoBulkCreate.as_view(),
+        name='photo_bulk_add'),
     url(r'^photos/$', PhotoListView.as_view(), name='photos'),
     url(r'^photos/(?P<pk>\w+)/edit/$', PhotoEdit.as_view(), name='photo_edit'),
-    url(r'^photos/tag/(?P<slug>[-\w]+)/$', TagListView.as_view(), name="tagged_images"),
+    url(r'^search/$', SearchView.as_view(), name='search'),
+    url(r'^photos/tag/(?P<slug>[-\w+,]+)/$', TagListView.as_view(), name="tagged_images"),
+    url(r'^tags/popular/$', PopularTagsView.as_view(), name='popular_tags'),
     url(r'^albums/(?P<pk>\d+)/$', AlbumDetailView.as_view(),
         name='single_album'),
     url(r'^albums/$', AlbumListView.as_view(), name='albums'),
     url(r'^albums/add/$', AlbumCreate.as_view(), name='album_add'),
-    url(r'^albums/(?P<pk>\w+)/edit/$', AlbumEdit.as_view(), name='album_edit')
+    url(r'^albums/(?P<pk>\w+)/edit/$', AlbumEdit.as_view(), name='album_edit'),
+    url(r'^uploads/$', UploadStart.as_view(), name='upload_start'),
+    url(r'^uploads/(?P<pk>{})/$'.format(UUID), UploadChunk.as_view(),
+        name='upload_chunk'),
+    url(r'^uploads/(?P<pk>{})/complete/$'.format(UUID),
+        UploadComplete.as_view(), name='upload_complete'),
+    url(r'^uploads/direct/$', DirectUploadStart.as_view(),
+        name='direct_upload_start'),
+    url(r'^uploads/direct/finalize/$', DirectUploadFinalize.as_view(),
+        name='direct_upload_finalize'),
+    url(r'^uploads/direct/(?P<token>[-\w:]+)/$', DirectUploadPut.as_view(),
+        name='direct_upload_put')
 ]
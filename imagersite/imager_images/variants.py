@@ -0,0 +1,162 @@
+"""Responsive width and format variants of photo originals.
+
+Variants of a shared original are rendered once and kept on its
+ImageBlob, so uploading the same bytes again costs no encoding.
+"""
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils.six import BytesIO
+from PIL import Image
+from .metadata import UnreadableImage
+from .models import ImageBlob, PhotoVariant
+
+DEFAULT_WIDTHS = (320, 640, 1024, 1600)
+# Preferred first: browsers take the first <source> type they support.
+DEFAULT_FORMATS = ('avif', 'webp', 'jpeg')
+DEFAULT_QUALITY = {'avif': 50, 'webp': 75, 'jpeg': 80}
+
+PIL_FORMATS = {'avif': 'AVIF', 'webp': 'WEBP', 'jpeg': 'JPEG'}
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'jpeg': 'jpg'}
+
+
+def widths():
+    """Configured variant widths, smallest first."""
+    return sorted(getattr(settings, 'IMAGER_VARIANT_WIDTHS', DEFAULT_WIDTHS))
+
+
+def supported(fmt):
+    """Whether this Pillow build can encode a variant format."""
+    if fmt not in PIL_FORMATS:
+        return False
+    Image.init()
+    return PIL_FORMATS[fmt] in Image.SAVE
+
+
+def formats():
+    """Configured variant formats this Pillow build can write.
+
+    JPEG is always kept last as the fallback every browser understands.
+    """
+    configured = getattr(settings, 'IMAGER_VARIANT_FORMATS', DEFAULT_FORMATS)
+    found = [fmt for fmt in configured if fmt != 'jpeg' and supported(fmt)]
+    return found + ['jpeg']
+
+
+def quality(fmt):
+    """Encoder quality for a format."""
+    configured = getattr(settings, 'IMAGER_VARIANT_QUALITY', {})
+    return configured.get(fmt, DEFAULT_QUALITY[fmt])
+
+
+def target_widths(original_width):
+    """Widths to render for an original, never upscaling."""
+    largest = min(original_width, widths()[-1])
+    return [width for width in widths() if width < largest] + [largest]
+
+
+def variant_name(key, fmt, width):
+    """Storage name for a variant file of a blob digest or photo id."""
+    return 'variants/{}/{}.{}'.format(key, width, EXTENSIONS[fmt])
+
+
+def of_photo(photo):
+    """A photo's variants: its blob's, or its own if it has no blob."""
+    if photo.blob_id is not None:
+        return PhotoVariant.objects.filter(blob_id=photo.blob_id)
+    return PhotoVariant.objects.filter(photo_id=photo.id)
+
+
+def encode(image, fmt):
+    """Encode a PIL image in a variant format and return the bytes."""
+    out = BytesIO()
+    if fmt == 'jpeg':
+        image.save(out, 'JPEG', quality=quality(fmt), optimize=True,
+                   progressive=True)
+    else:
+        image.save(out, PIL_FORMATS[fmt], quality=quality(fmt))
+    return out.getvalue()
+
+
+def render_files(photo, owner, key):
+    """Write a photo's variant files and return their unsaved rows.
+
+    The original is decoded once; each width is resized from the
+    previous, larger one so big originals are not resampled repeatedly.
+    """
+    with default_storage.open(photo.photo.name) as original:
+        try:
+            image = Image.open(original)
+            image.load()
+        except (IOError, SyntaxError) as error:
+            raise UnreadableImage(error)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    rows = []
+    current = image
+    for width in reversed(target_widths(image.width)):
+        height = max(1, int(round(image.height * width / float(image.width))))
+        current = current.resize((width, height), Image.LANCZOS)
+        for fmt in formats():
+            encoded = current.convert('RGB') if fmt == 'jpeg' else current
+            content = encode(encoded, fmt)
+            name = default_storage.save(variant_name(key, fmt, width),
+                                        ContentFile(content))
+            rows.append(PhotoVariant(format=fmt, width=width, height=height,
+                                     size=len(content), file=name, **owner))
+    return rows
+
+
+def render_variants(photo):
+    """Render and record every configured variant of a photo.
+
+    A shared original whose variants exist already is not decoded again.
+    Otherwise its blob row stays locked while it renders, so photos
+    sharing it take turns rather than writing the same files at once.
+    """
+    delete_variants(photo)
+    if not photo.photo:
+        return []
+    if photo.blob_id is None:
+        return PhotoVariant.objects.bulk_create(
+            render_files(photo, {'photo_id': photo.id}, photo.id))
+    existing = list(of_photo(photo))
+    if existing:
+        return existing
+    with transaction.atomic():
+        blob = (ImageBlob.objects.select_for_update()
+                         .filter(id=photo.blob_id).first())
+        if blob is None:
+            return []
+        existing = list(of_photo(photo))
+        if existing:
+            return existing
+        return PhotoVariant.objects.bulk_create(
+            render_files(photo, {'blob_id': blob.id}, blob.sha256))
+
+
+def delete_variants(photo):
+    """Remove a photo's own variant rows; their files go with them.
+
+    Variants of its blob stay for the other photos sharing it, and go
+    when the blob does.
+    """
+    PhotoVariant.objects.filter(photo_id=photo.id).delete()
+
+
+def srcsets(variants):
+    """Group variants into (format, mime type, srcset) tuples.
+
+    Formats come back in the configured order with JPEG last, ready to be
+    written out as <source> elements followed by the <img> fallback.
+    """
+    grouped = {}
+    for variant in variants:
+        grouped.setdefault(variant.format, []).append(variant)
+    order = formats() + [fmt for fmt in grouped if fmt not in formats()]
+    return [(fmt, MIME_TYPES.get(fmt, ''), ', '.join(
+                '{} {}w'.format(v.file.url, v.width)
+                for v in sorted(grouped[fmt], key=lambda v: v.width)))
+            for fmt in order if fmt in grouped]
@@ -1,11 +1,27 @@
 """."""
-from django.views.generic.base import TemplateView
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic.base import TemplateView, View
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
-from django.views.generic.edit import CreateView, UpdateView
+from django.views.generic.edit import CreateView, FormView, UpdateView
 from django.urls import reverse_lazy
-from .models import Photo, Album
+from .models import Photo, Album, ChunkedUpload, ImageBlob
+from .page_cache import PublicPageCacheMixin
+from .pagination import KeysetPaginationMixin, id_page
+from . import (blobs, bulk, covers, direct_uploads, metadata, postings,
+               search, similarity, thumbnails, uploads)
+from .forms import BulkPhotoForm
+from PIL import Image
+from taggit.utils import parse_tags
+from .tag_cloud import album_tags, library_tags, popular_limit, popular_tags
 
 
 class LibraryView(LoginRequiredMixin, TemplateView):
@@ -17,56 +33,94 @@ class LibraryView(LoginRequiredMixin, TemplateView):
         """Build context to create view."""
         context = super(LibraryView, self).get_context_data(**kwargs)
         username = context['view'].request.user
-        context['photos'] = Photo.objects.filter(user=username)
-        context['albums'] = Album.objects.filter(user=username)
-        context['tags'] = set([tag for photo in context['photos'] for tag in photo.tags.names()])
+        photos = Photo.objects.filter(user=username)
+        taken_from = metadata.parse_day(self.request.GET.get('taken_from'))
+        taken_to = metadata.parse_day(self.request.GET.get('taken_to'))
+        if taken_from or taken_to:
+            photos = metadata.taken_between(photos, taken_from, taken_to)
+        context['taken_from'], context['taken_to'] = taken_from, taken_to
+        context['photos'] = thumbnails.prefetch_thumbnails(
+            list(photos), '100x100')
+        context['albums'] = covers.prefetch_covers(
+            list(Album.objects.filter(user=username)
+                              .select_related('effective_cover')), '100x100')
+        context['tags'] = library_tags(username)
         return context
 
 
-class PhotoListView(ListView):
+class PhotoListView(PublicPageCacheMixin, KeysetPaginationMixin, ListView):
     """Generic view for photo lists."""
 
+    read_replica = True
     template_name = 'imager_images/photos.html'
     model = Photo
 
-    def get_context_data(self, **kwargs):
-        """Build context to create view."""
-        context = super(PhotoListView, self).get_context_data(**kwargs)
-        context['photo_list'] = context['photo_list'].filter(published='PB')
-        return context
+    def get_cache_scopes(self):
+        """The listing changes with any public photo."""
+        return ['photos']
+
+    def get_queryset(self):
+        """Only list public photos."""
+        return Photo.objects.filter(published='PB')
 
 
 class PhotoDetailView(DetailView):
     """Generic django view for single photos."""
 
+    read_replica = True
     template_name = 'imager_images/photo.html'
     model = Photo
 
+    def get_context_data(self, **kwargs):
+        """Add look-alike public photos, and the owner's own copies."""
+        context = super(PhotoDetailView, self).get_context_data(**kwargs)
+        context['similar_photos'] = thumbnails.prefetch_thumbnails(
+            similarity.similar_photos(self.object), '100x100')
+        if self.request.user.id == self.object.user_id:
+            context['duplicate_photos'] = thumbnails.prefetch_thumbnails(
+                similarity.near_duplicates(self.object), '100x100')
+        return context
+
 
-class AlbumListView(ListView):
+class AlbumListView(PublicPageCacheMixin, KeysetPaginationMixin, ListView):
     """Generic view for photo lists."""
 
+    read_replica = True
     template_name = 'imager_images/albums.html'
     model = Album
 
+    def get_cache_scopes(self):
+        """The listing changes with any public album or its cover."""
+        return ['albums']
+
+    def get_queryset(self):
+        """Only list public albums."""
+        return (Album.objects.filter(published='PB')
+                             .select_related('effective_cover'))
+
     def get_context_data(self, **kwargs):
-        """Filter albums by published."""
+        """Prefetch the cover thumbnails for the page."""
         context = super(AlbumListView, self).get_context_data(**kwargs)
-        context['album_list'] = context['album_list'].filter(published='PB')
+        covers.prefetch_covers(context['album_list'], '200x200')
         return context
 
 
-class AlbumDetailView(DetailView):
+class AlbumDetailView(PublicPageCacheMixin, DetailView):
     """Generic django view for single photos."""
 
+    read_replica = True
     template_name = 'imager_images/album.html'
     model = Album
 
+    def get_cache_scopes(self):
+        """The page changes with the album and its photos."""
+        return ['album:{}'.format(self.kwargs['pk'])]
+
     def get_context_data(self, **kwargs):
         """Build context to create view."""
         context = super(AlbumDetailView, self).get_context_data(**kwargs)
         context['album_photos'] = context['album'].photos.filter(published='PB')
-        context['tags'] = set([tag for photo in context['album_photos'] for tag in photo.tags.names()])
+        context['tags'] = album_tags(context['album'])
         return context
 
 
@@ -81,10 +135,33 @@ class PhotoCreate(LoginRequiredMixin, CreateView):
         """Identify form data with user and save in db."""
         self.object = form.save(commit=False)
         self.object.user = self.request.user
+        blobs.attach(self.object, form.cleaned_data['photo'])
         self.object.save()
+        thumbnails.enqueue(self.object)
         return super(CreateView, self).form_valid(form)
 
 
+class PhotoBulkCreate(LoginRequiredMixin, FormView):
+    """Upload many photos in one request and report on each file."""
+
+    form_class = BulkPhotoForm
+    template_name = 'imager_images/photo_bulk_form.html'
+
+    def form_valid(self, form):
+        """Store the files and show what happened to each one."""
+        files = self.request.FILES.getlist('photos')
+        if len(files) > bulk.max_files():
+            form.add_error('photos', 'Upload at most {} photos at once.'.format(
+                bulk.max_files()))
+            return self.form_invalid(form)
+        results = bulk.bulk_upload(self.request.user,
+                                   files,
+                                   published=form.cleaned_data['published'],
+                                   tags=form.cleaned_data['tags'])
+        return self.render_to_response(
+            self.get_context_data(form=form, results=results))
+
+
 class PhotoEdit(LoginRequiredMixin, UpdateView):
     """Class-based view to edit photos."""
 
@@ -96,7 +173,15 @@ class PhotoEdit(LoginRequiredMixin, UpdateView):
         """Identify form data with user and save in db."""
         self.object = form.save(commit=False)
         self.object.user = self.request.user
+        replaced_blob = None
+        if 'photo' in form.changed_data:
+            replaced_blob = self.object.blob_id
+            blobs.attach(self.object, form.cleaned_data['photo'])
         self.object.save()
+        if 'photo' in form.changed_data:
+            if replaced_blob is not None:
+                blobs.release(replaced_blob)
+            thumbnails.enqueue(self.object)
         return super(UpdateView, self).form_valid(form)
 
 
@@ -146,20 +231,290 @@ class AlbumEdit(LoginRequiredMixin, UpdateView):
         return super(UpdateView, self).form_valid(form)
 
 
-class TagListView(ListView):
-    """The listing for tagged books."""
+class SearchView(ListView):
+    """Ranked full-text search over public photos and albums."""
+
+    read_replica = True
+    template_name = 'imager_images/search.html'
+    paginate_by = 24
+    album_limit = 6
+
+    def get_query(self):
+        """The search text from the query string."""
+        return self.request.GET.get('q', '').strip()
 
+    def get_queryset(self):
+        """Public photos matching the search, best match first."""
+        return search.search_photos(self.get_query())
+
+    def get_context_data(self, **kwargs):
+        """Add the query and the best matching albums."""
+        context = super(SearchView, self).get_context_data(**kwargs)
+        context['q'] = self.get_query()
+        context['albums'] = list(search.search_albums(self.get_query())
+                                 .select_related('effective_cover')
+                                 [:self.album_limit])
+        return context
+
+
+class TagListView(PublicPageCacheMixin, KeysetPaginationMixin, ListView):
+    """The listing for tagged books.
+
+    The slug is a tag expression: 'a+b' lists photos tagged both a and b,
+    'a,b' photos tagged either. Matching ids come from the per-tag posting
+    lists and only the current page's photos are loaded, newest upload
+    first.
+    """
+
+    read_replica = True
     template_name = "imager_images/photos.html"
 
+    def get_cache_scopes(self):
+        """Tag listings change with any public photo or its tags."""
+        return ['photos']
+
     def get_queryset(self):
-        """Filter queryset by slug."""
-        # import pdb; pdb.set_trace()
-        return (Photo.objects.filter(tags__slug=self.kwargs.get("slug"))
-                             .filter(published='PB')
-                             .all())
+        """Public photos; the tag filter is applied by id in pagination."""
+        return Photo.objects.filter(published='PB')
+
+    def paginate_queryset(self, queryset, page_size):
+        """Load the requested page of the photos matching the tags."""
+        page = id_page(postings.photo_ids(self.kwargs.get("slug")),
+                       page_size,
+                       after=self.request.GET.get('after'),
+                       before=self.request.GET.get('before'))
+        photos = dict((photo.id, photo) for photo in
+                      queryset.filter(id__in=page.object_list))
+        page.object_list = [photos[photo_id] for photo_id in page.object_list
+                            if photo_id in photos]
+        return (None, page, page.object_list, page.has_other_pages())
 
     def get_context_data(self, **kwargs):
         """Return the context with the given tags."""
         context = super(TagListView, self).get_context_data(**kwargs)
         context["tag"] = self.kwargs.get("slug")
         return context
+
+
+class PopularTagsView(View):
+    """The most used tags on public photos, as JSON."""
+
+    read_replica = True
+
+    def get(self, request):
+        """Return up to ?limit= tags with their public photo counts.
+
+        Only IMAGER_POPULAR_TAGS_LIMIT tags are cached, so larger limits
+        are lowered to it; the limit applied is returned with the tags.
+        """
+        try:
+            limit = int(request.GET.get('limit', 20))
+        except ValueError:
+            return JsonResponse({'error': 'limit must be a number.'},
+                                status=400)
+        limit = max(1, min(limit, popular_limit()))
+        return JsonResponse({'limit': limit, 'tags': popular_tags(limit)})
+
+
+def upload_status(upload):
+    """Describe an upload so a client can resume it."""
+    return {
+        'id': str(upload.id),
+        'filename': upload.filename,
+        'size': upload.size,
+        'offset': upload.offset,
+        'status': upload.get_status_display(),
+    }
+
+
+class UploadStart(LoginRequiredMixin, View):
+    """Begin a resumable upload of a photo original."""
+
+    def post(self, request):
+        """Create the upload session from a filename and total size."""
+        try:
+            size = int(request.POST.get('size', ''))
+        except ValueError:
+            return JsonResponse({'error': 'size is required.'}, status=400)
+        filename = request.POST.get('filename', '')
+        if not filename or not 0 < size <= uploads.max_upload_size():
+            return JsonResponse({'error': 'Invalid filename or size.'},
+                                status=400)
+        upload = ChunkedUpload(user=request.user,
+                               filename=filename,
+                               size=size,
+                               key=uploads.upload_key(filename))
+        uploads.sink_for(upload).start()
+        upload.save()
+        return JsonResponse(upload_status(upload), status=201)
+
+
+class UploadChunk(LoginRequiredMixin, View):
+    """Report, extend or abort a resumable upload.
+
+    Chunks are PUT with an Upload-Offset header that must match the
+    server's offset; a mismatch returns 409 with the offset to resume from.
+    """
+
+    def get_upload(self, lock=False):
+        """Fetch the user's active upload."""
+        uploads_qs = ChunkedUpload.objects.filter(user=self.request.user,
+                                                  status='AC')
+        if lock:
+            uploads_qs = uploads_qs.select_for_update()
+        return get_object_or_404(uploads_qs, pk=self.kwargs['pk'])
+
+    def get(self, request, pk):
+        """Return the current offset."""
+        return JsonResponse(upload_status(self.get_upload()))
+
+    def put(self, request, pk):
+        """Stream one chunk into storage at the current offset."""
+        with transaction.atomic():
+            upload = self.get_upload(lock=True)
+            try:
+                offset = int(request.META.get('HTTP_UPLOAD_OFFSET', ''))
+                length = int(request.META.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                return JsonResponse({'error': 'Upload-Offset is required.'},
+                                    status=400)
+            if offset != upload.offset:
+                return JsonResponse(upload_status(upload), status=409)
+            if (not 0 < length <= uploads.max_chunk_size() or
+                    offset + length > upload.size):
+                return JsonResponse({'error': 'Invalid chunk length.'},
+                                    status=400)
+            try:
+                uploads.sink_for(upload).append(request, length)
+            except uploads.UploadError as error:
+                return JsonResponse({'error': str(error)}, status=400)
+            upload.offset += length
+            upload.save()
+        return JsonResponse(upload_status(upload))
+
+    def delete(self, request, pk):
+        """Abort the upload and discard what was received."""
+        upload = self.get_upload()
+        uploads.sink_for(upload).abort()
+        upload.status = 'AB'
+        upload.save()
+        return JsonResponse(upload_status(upload))
+
+
+class UploadComplete(LoginRequiredMixin, View):
+    """Finish a resumable upload and create its Photo."""
+
+    def post(self, request, pk):
+        """Assemble the file and save a photo pointing at it.
+
+        The request first claims the upload by moving it from active to
+        completing, so a second complete request finds it no longer
+        active. Assembling and checking the file then runs without any
+        row locked; only saving the photo is a transaction.
+        """
+        upload = get_object_or_404(ChunkedUpload, pk=pk, user=request.user)
+        if upload.status != 'AC':
+            raise Http404('Upload is not active.')
+        if upload.offset != upload.size:
+            return JsonResponse(upload_status(upload), status=409)
+        published = request.POST.get('published', 'PV')
+        if published not in dict(Photo.PUBLISHED_STATUS):
+            return JsonResponse({'error': 'Invalid published status.'},
+                                status=400)
+        claimed = ChunkedUpload.objects.filter(pk=upload.pk, status='AC')
+        if not claimed.update(status='CG', date_modified=timezone.now()):
+            raise Http404('Upload is not active.')
+        upload.status = 'CG'
+        try:
+            name, digest = uploads.sink_for(upload).finish()
+        except Exception:
+            # Hand the upload back so the client can retry.
+            ChunkedUpload.objects.filter(pk=upload.pk).update(status='AC')
+            raise
+        try:
+            with default_storage.open(name) as image:
+                Image.open(image).verify()
+        except Exception:
+            if not (digest and ImageBlob.objects.filter(sha256=digest).exists()):
+                default_storage.delete(name)
+            upload.status = 'AB'
+            upload.save()
+            return JsonResponse({'error': 'Upload is not a valid image.'},
+                                status=400)
+        with transaction.atomic():
+            photo = Photo(user=request.user,
+                          title=request.POST.get('title', ''),
+                          description=request.POST.get('description', ''),
+                          published=published)
+            if digest:
+                photo.blob = blobs.acquire(digest, name, upload.size)
+                name = photo.blob.name
+            photo.photo.name = name
+            photo.save()
+            photo.tags.add(*parse_tags(request.POST.get('tags', '')))
+            upload.status = 'CP'
+            upload.save()
+            thumbnails.enqueue(photo)
+        return JsonResponse({'photo': photo.id,
+                             'url': reverse('single_photo',
+                                            kwargs={'pk': photo.id})},
+                            status=201)
+
+
+class DirectUploadStart(LoginRequiredMixin, View):
+    """Grant the client a presigned upload straight to storage."""
+
+    def post(self, request):
+        """Issue a grant for a filename, content type and size."""
+        try:
+            size = int(request.POST.get('size', ''))
+        except ValueError:
+            return JsonResponse({'error': 'size is required.'}, status=400)
+        try:
+            grant = direct_uploads.issue(
+                request.user, request.POST.get('filename', ''),
+                request.POST.get('content_type', ''), size)
+        except direct_uploads.DirectUploadError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        return JsonResponse(grant, status=201)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class DirectUploadPut(View):
+    """Accept a granted upload when storage is not S3.
+
+    The signed token in the URL is the only credential, as with a
+    presigned S3 URL.
+    """
+
+    def put(self, request, token):
+        """Store the request body under the granted name."""
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+            direct_uploads.receive(token, request, length)
+        except ValueError:
+            return JsonResponse({'error': 'Content-Length is required.'},
+                                status=400)
+        except direct_uploads.DirectUploadError as error:
+            return JsonResponse({'error': str(error)}, status=403)
+        return JsonResponse({}, status=201)
+
+
+class DirectUploadFinalize(LoginRequiredMixin, View):
+    """Create the Photo for a finished direct upload."""
+
+    def post(self, request):
+        """Check the upload landed, save its photo and queue processing."""
+        try:
+            photo = direct_uploads.finalize(
+                request.user, request.POST.get('name', ''),
+                title=request.POST.get('title', ''),
+                description=request.POST.get('description', ''),
+                published=request.POST.get('published', 'PV'),
+                tags=request.POST.get('tags', ''))
+        except direct_uploads.DirectUploadError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        return JsonResponse({'photo': photo.id,
+                             'url': reverse('single_photo',
+                                            kwargs={'pk': photo.id})},
+                            status=201)
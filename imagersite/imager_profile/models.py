@@ -4,6 +4,7 @@ from django.contrib.auth.models import User
 from django.dispatch import receiver
 from django.db.models.signals import post_save
 from django.utils.encoding import python_2_unicode_compatible
+from imager_images import page_cache
 
 
 class ProfileManager(models.Manager):
@@ -55,3 +56,11 @@ def make_profile_for_new_user(sender, **kwargs):
         new_profile = ImagerProfile(
             user=kwargs['instance'])
         new_profile.save()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=ImagerProfile)
+def invalidate_public_profile(sender, instance, **kwargs):
+    """Drop cached public profile pages when the user or profile changes."""
+    user_id = instance.id if sender is User else instance.user_id
+    page_cache.bump('user:{}'.format(user_id))
@@ -3,8 +3,9 @@
 from django.test import TestCase, Client
 from django.contrib.auth.models import User
 from imager_profile.models import ImagerProfile
+from imager_profile.views import publish_counts
 from imager_images.models import Photo, Album
-from imagersite.settings import MEDIA_ROOT
+from imager_images.tests import use_temp_media
 from django.urls import reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
 from bs4 import BeautifulSoup
@@ -155,6 +156,7 @@ class PublicProfileView(TestCase):
 
     def setUp(self):
         """Make users, photos and albums."""
+        use_temp_media(self)
         user_1 = User(
             username='morgan',
             email='morgan@morgan.com'
@@ -204,11 +206,6 @@ class PublicProfileView(TestCase):
         self.album_1 = album_1
         self.album_2 = album_2
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_logged_logged_out_in_users_see_same_stuff(self):
         """Test logged out and logged in users see the same public profile."""
         response_logged_out = self.client.get(reverse('public_profile',
@@ -261,3 +258,47 @@ class PublicProfileView(TestCase):
         html = BeautifulSoup(response.content, 'html.parser')
         p_tag = html.find_all('p')
         self.assertIn('user doesn\'t exist', p_tag[0])
+
+
+class ProfileCounts(TestCase):
+    """Private profile photo and album counts."""
+
+    def setUp(self):
+        """Make a user with photos and albums in each state."""
+        use_temp_media(self)
+        user = User(
+            username='morgan',
+            email='morgan@morgan.com'
+        )
+        user.save()
+        self.user = user
+        for published in ['PV', 'PV', 'PB', 'SH']:
+            photo = PhotoFactory.build()
+            photo.user = user
+            photo.published = published
+            photo.save()
+        for published in ['PB', 'PB', 'PB', 'PV']:
+            album = AlbumFactory.build()
+            album.user = user
+            album.published = published
+            album.save()
+
+    def test_profile_counts_by_status(self):
+        """Profile shows private and public counts."""
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('profile'))
+        self.assertEqual(response.context['photos_priv'], 2)
+        self.assertEqual(response.context['photos_pub'], 1)
+        self.assertEqual(response.context['albums_priv'], 1)
+        self.assertEqual(response.context['albums_pub'], 3)
+
+    def test_publish_counts_single_query(self):
+        """Both counts come from one query."""
+        with self.assertNumQueries(1):
+            counts = publish_counts(Photo.objects.filter(user=self.user))
+        self.assertEqual(counts, {'private': 2, 'public': 1})
+
+    def test_publish_counts_empty(self):
+        """Users without photos get zero counts."""
+        counts = publish_counts(Photo.objects.filter(user=None))
+        self.assertEqual(counts, {'private': 0, 'public': 0})
@@ -1,7 +1,11 @@
 """."""
 from imager_images.models import Photo, Album
+from imager_images.thumbnails import prefetch_thumbnails
+from imager_images.covers import prefetch_covers
+from imager_images.page_cache import PublicPageCacheMixin
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
+from django.db.models import Case, IntegerField, Sum, When
 from imager_profile.models import ImagerProfile
 from django.views.generic.base import TemplateView
 from django.views.generic.edit import UpdateView
@@ -10,6 +14,16 @@ from django.http import HttpResponseRedirect
 from .forms import UserForm
 
 
+def publish_counts(queryset):
+    """Count private and public rows of a queryset in a single query."""
+    def count_if(status):
+        return Sum(Case(When(published=status, then=1),
+                        default=0,
+                        output_field=IntegerField()))
+    counts = queryset.aggregate(private=count_if('PV'), public=count_if('PB'))
+    return dict((key, value or 0) for key, value in counts.items())
+
+
 class ProfileView(LoginRequiredMixin, TemplateView):
     """Class based view for private profiles."""
 
@@ -18,22 +32,12 @@ class ProfileView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         """Build context for view."""
         context = super(ProfileView, self).get_context_data(**kwargs)
-        context['photos_priv'] = (Photo.objects
-                                  .filter(published='PV')
-                                  .filter(user=self.request.user)
-                                  .count())
-        context['photos_pub'] = (Photo.objects
-                                 .filter(published='PB')
-                                 .filter(user=self.request.user)
-                                 .count())
-        context['albums_priv'] = (Album.objects
-                                  .filter(published='PV')
-                                  .filter(user=self.request.user)
-                                  .count())
-        context['albums_pub'] = (Album.objects
-                                 .filter(published='PB')
-                                 .filter(user=self.request.user)
-                                 .count())
+        photos = publish_counts(Photo.objects.filter(user=self.request.user))
+        albums = publish_counts(Album.objects.filter(user=self.request.user))
+        context['photos_priv'] = photos['private']
+        context['photos_pub'] = photos['public']
+        context['albums_priv'] = albums['private']
+        context['albums_pub'] = albums['public']
 
         return context
 
@@ -76,22 +80,36 @@ class ProfileEdit(UpdateView):
         return self.render_to_response(self.get_context_data(**kwargs))
 
 
-class PublicProfileView(TemplateView):
+class PublicProfileView(PublicPageCacheMixin, TemplateView):
     """Class based public profile view."""
 
+    read_replica = True
     template_name = 'imager_profile/public_profile.html'
 
+    def get_cache_scopes(self):
+        """The page changes with the user's public photos and albums."""
+        user_id = (User.objects.filter(username=self.kwargs['request_username'])
+                   .values_list('id', flat=True).first())
+        if user_id is None:
+            return None
+        return ['user:{}'.format(user_id)]
+
     def get_context_data(self, **kwargs):
         """Build context for view."""
         context = super(PublicProfileView, self).get_context_data(**kwargs)
         request_user = User.objects.filter(username=self.kwargs['request_username'])
         imager_profile = ImagerProfile.objects.filter(user=request_user)
-        context['photos_pub'] = (Photo.objects
-                                 .filter(user=request_user)
-                                 .filter(published='PB'))
-        context['albums_pub'] = (Album.objects
-                                 .filter(user=request_user)
-                                 .filter(published='PB'))
+        context['photos_pub'] = prefetch_thumbnails(
+            list(Photo.objects
+                 .filter(user=request_user)
+                 .filter(published='PB')
+                 .order_by('-date_published', '-id')), '100x100')
+        context['albums_pub'] = prefetch_covers(
+            list(Album.objects
+                 .filter(user=request_user)
+                 .filter(published='PB')
+                 .select_related('effective_cover')
+                 .order_by('-date_published', '-id')), '100x100')
         context['imager_user'] = imager_profile
 
         return context
@@ -1,15 +1,22 @@
 """Custom storage classes for static and media files."""
 from django.conf import settings
-from storages.backends.s3boto import S3BotoStorage
+from django.contrib.staticfiles.storage import ManifestFilesMixin
+from .metrics import InstrumentedStorageMixin
+from .s3 import ParallelUploadMixin, PooledS3Storage
+from .static_assets import DiffUploadMixin
+from .storage_urls import FastUrlMixin
 
 
-class StaticStorage(S3BotoStorage):
-    """Custom storage class for static files."""
+class StaticStorage(InstrumentedStorageMixin, DiffUploadMixin,
+                    ParallelUploadMixin, ManifestFilesMixin, FastUrlMixin,
+                    PooledS3Storage):
+    """Custom storage class for hashed, compressed static files."""
 
     location = settings.STATICFILES_LOCATION
+    url_mode = 'public'
 
 
-class MediaStorage(S3BotoStorage):
+class MediaStorage(InstrumentedStorageMixin, FastUrlMixin, PooledS3Storage):
     """Custom storage class for media files."""
 
-    location = settings.MEDIAFILES_LOCATION
\ No newline at end of file
+    location = settings.MEDIAFILES_LOCATION
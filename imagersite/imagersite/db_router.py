@@ -0,0 +1,144 @@
+"""Send reads from the public gallery views to read replicas.
+
+Views opt in with a ``read_replica = True`` class attribute. For the
+duration of such a GET, ReplicaRouter sends reads to a random alias from
+settings.IMAGER_REPLICA_DATABASES; everything else, writes, and reads
+inside a transaction always use 'default'.
+
+After a user makes a write request, ReplicaMiddleware stores a deadline in
+their session. Until it passes, their reads stay on the primary, so the
+photo they just posted is visible even if the replicas lag behind.
+
+Shared caches need the same care for every visitor, not just the writer:
+a cache filled from a lagging replica just after an invalidation would
+serve the old data until it times out. Invalidations call note_changed(),
+and cache fills run inside primary_if_changed(), which keeps their reads
+on the primary for IMAGER_PRIMARY_STICKY_SECONDS after the change.
+
+Any database aliases can serve as replicas, including extra SQLite or
+PostgreSQL aliases in local settings; give them TEST = {'MIRROR': 'default'}
+so the test runner points them at the test database.
+"""
+import random
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+SESSION_KEY = '_primary_until'
+CHANGED_KEY = 'imagersite:changed:{}'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_state = threading.local()
+
+
+def replicas():
+    """Configured replica aliases."""
+    return list(getattr(settings, 'IMAGER_REPLICA_DATABASES', ()))
+
+
+def sticky_seconds():
+    """How long a user's reads stay on the primary after they write."""
+    return getattr(settings, 'IMAGER_PRIMARY_STICKY_SECONDS', 10)
+
+
+def replicas_enabled():
+    """Whether the current thread may read from a replica."""
+    return getattr(_state, 'enabled', False)
+
+
+class use_replicas(object):
+    """Context manager letting reads in this thread go to replicas."""
+
+    def __init__(self, enabled=True):
+        """Remember whether to enable replicas."""
+        self.enabled = enabled
+
+    def __enter__(self):
+        """Switch replica reads on or off for this thread."""
+        self.previous = replicas_enabled()
+        _state.enabled = self.enabled
+
+    def __exit__(self, *exc_info):
+        """Restore the previous setting."""
+        _state.enabled = self.previous
+
+
+def note_changed(names):
+    """Record that the cached data under names was just invalidated."""
+    if replicas():
+        cache.set_many(dict((CHANGED_KEY.format(name), time.time())
+                            for name in names), sticky_seconds())
+
+
+def primary_if_changed(names):
+    """Context manager keeping reads on the primary if names just changed.
+
+    A fill more than IMAGER_PRIMARY_STICKY_SECONDS after the last change
+    reads from a replica again.
+    """
+    enabled = replicas_enabled()
+    if enabled:
+        since = time.time() - sticky_seconds()
+        changed = cache.get_many([CHANGED_KEY.format(name) for name in names])
+        if any(when > since for when in changed.values()):
+            enabled = False
+    return use_replicas(enabled)
+
+
+class ReplicaRouter(object):
+    """Route reads to replicas when the current view allows it."""
+
+    def db_for_read(self, model, **hints):
+        """A random replica for read-only views, otherwise the primary."""
+        aliases = replicas()
+        if (not aliases or not replicas_enabled() or
+                connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        """Writes always go to the primary."""
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """Rows from the primary and its replicas may be related."""
+        pool = set([DEFAULT_DB_ALIAS] + replicas())
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        """Only migrate the primary; replicas copy it."""
+        return db not in replicas()
+
+
+class ReplicaMiddleware(object):
+    """Enable replica reads for read-only views and pin recent writers.
+
+    Must come after SessionMiddleware.
+    """
+
+    def __init__(self, get_response):
+        """Store the next handler."""
+        self.get_response = get_response
+
+    def __call__(self, request):
+        """Run the request, then pin the session after a write."""
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.enabled = False
+        if request.method not in SAFE_METHODS and replicas():
+            request.session[SESSION_KEY] = time.time() + sticky_seconds()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Allow replica reads for opted-in views on safe requests."""
+        view_class = getattr(view_func, 'view_class', view_func)
+        _state.enabled = bool(
+            replicas() and
+            request.method in SAFE_METHODS and
+            getattr(view_class, 'read_replica', False) and
+            request.session.get(SESSION_KEY, 0) < time.time())
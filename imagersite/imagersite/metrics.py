@@ -0,0 +1,252 @@
+"""Per-view query, template and storage timings.
+
+With IMAGER_METRICS on, MetricsMiddleware records each request's query
+count, database time, template render time and storage calls, totalled
+per URL name. metrics_view serves the totals in the Prometheus text
+format; IMAGER_SERVER_TIMING also reports them on every response in a
+Server-Timing header for the browser's network panel.
+
+Totals live in process memory, so every worker process is scraped
+separately. With IMAGER_METRICS off the middleware removes itself from
+the stack and nothing is measured.
+"""
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import Http404, HttpResponse
+
+FIELDS = (
+    ('requests', 'counter', 'Requests served.'),
+    ('request_seconds', 'counter', 'Time spent serving requests.'),
+    ('db_queries', 'counter', 'Database queries run.'),
+    ('db_seconds', 'counter', 'Time spent in database queries.'),
+    ('template_seconds', 'counter', 'Time spent rendering templates.'),
+    ('storage_calls', 'counter', 'Calls made to file storage.'),
+    ('storage_seconds', 'counter', 'Time spent in file storage calls.'),
+)
+
+_state = threading.local()
+_lock = threading.Lock()
+_totals = defaultdict(lambda: defaultdict(float))
+
+
+def enabled():
+    """Whether requests are being measured."""
+    return getattr(settings, 'IMAGER_METRICS', False)
+
+
+def current():
+    """Timings of the request running in this thread, if measured."""
+    return getattr(_state, 'timings', None)
+
+
+class RequestTimings(object):
+    """What one request spent in the database, templates and storage."""
+
+    def __init__(self):
+        """Start the clock."""
+        self.start = time.time()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.storage_calls = 0
+        self.storage_seconds = 0.0
+
+    @property
+    def request_seconds(self):
+        """Time since the request started."""
+        return time.time() - self.start
+
+    def server_timing(self):
+        """Render the timings as a Server-Timing header value."""
+        return ', '.join([
+            'db;dur={:.1f};desc="{} queries"'.format(
+                self.db_seconds * 1000, self.db_queries),
+            'tpl;dur={:.1f}'.format(self.template_seconds * 1000),
+            'storage;dur={:.1f};desc="{} calls"'.format(
+                self.storage_seconds * 1000, self.storage_calls),
+            'total;dur={:.1f}'.format(self.request_seconds * 1000),
+        ])
+
+
+class collect(object):
+    """Measure the code in a with block as if it were a request."""
+
+    def __enter__(self):
+        """Start timing this thread's storage calls."""
+        self.previous = current()
+        self.timings = _state.timings = RequestTimings()
+        return self.timings
+
+    def __exit__(self, *exc_info):
+        """Stop timing."""
+        _state.timings = self.previous
+
+
+def record_storage(seconds):
+    """Count a storage call against the current request."""
+    timings = current()
+    if timings is not None:
+        timings.storage_calls += 1
+        timings.storage_seconds += seconds
+
+
+def render_response(response):
+    """Render a template response now, timing it against the request.
+
+    For views that must render before returning, e.g. to cache the page;
+    the middleware's post-render callback then adds nothing more.
+    """
+    timings = current()
+    start = time.time()
+    response.render()
+    if timings is not None:
+        timings.template_seconds += time.time() - start
+    return response
+
+
+def record(view, timings):
+    """Add a finished request to the per-view totals."""
+    with _lock:
+        totals = _totals[view]
+        totals['requests'] += 1
+        for field, _, _ in FIELDS[1:]:
+            totals[field] += getattr(timings, field)
+
+
+def reset():
+    """Forget every total."""
+    with _lock:
+        _totals.clear()
+
+
+def snapshot():
+    """A copy of the per-view totals."""
+    with _lock:
+        return dict((view, dict(totals)) for view, totals in _totals.items())
+
+
+def _label(value):
+    """Escape a Prometheus label value."""
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+                 .replace('\n', '\\n'))
+
+
+def render():
+    """The totals in the Prometheus text exposition format."""
+    totals = snapshot()
+    lines = []
+    for field, kind, help_text in FIELDS:
+        name = 'imager_view_{}_total'.format(field)
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for view in sorted(totals):
+            lines.append('{}{{view="{}"}} {}'.format(
+                name, _label(view), repr(float(totals[view].get(field, 0)))))
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentedStorageMixin(object):
+    """Time the calls a storage makes to its backend."""
+
+    def _timed(self, method, *args, **kwargs):
+        """Run a storage method, recording its duration."""
+        if current() is None:
+            return method(*args, **kwargs)
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            record_storage(time.time() - start)
+
+    def _open(self, *args, **kwargs):
+        """Open a stored file."""
+        return self._timed(super(InstrumentedStorageMixin, self)._open,
+                           *args, **kwargs)
+
+    def _save(self, *args, **kwargs):
+        """Store a file."""
+        return self._timed(super(InstrumentedStorageMixin, self)._save,
+                           *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        """Delete a stored file."""
+        return self._timed(super(InstrumentedStorageMixin, self).delete,
+                           *args, **kwargs)
+
+    def exists(self, *args, **kwargs):
+        """Check whether a file is stored."""
+        return self._timed(super(InstrumentedStorageMixin, self).exists,
+                           *args, **kwargs)
+
+    def size(self, *args, **kwargs):
+        """Look up a stored file's size."""
+        return self._timed(super(InstrumentedStorageMixin, self).size,
+                           *args, **kwargs)
+
+    def listdir(self, *args, **kwargs):
+        """List a stored directory."""
+        return self._timed(super(InstrumentedStorageMixin, self).listdir,
+                           *args, **kwargs)
+
+
+class MetricsMiddleware(object):
+    """Measure each request and total the timings by URL name.
+
+    Put it first in MIDDLEWARE so the total covers the whole stack.
+    """
+
+    def __init__(self, get_response):
+        """Drop out of the stack unless metrics are enabled."""
+        if not enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.server_timing = getattr(settings, 'IMAGER_SERVER_TIMING', False)
+
+    def __call__(self, request):
+        """Time the request, logging queries on every database alias."""
+        timings = _state.timings = RequestTimings()
+        logged = []
+        for alias in connections:
+            connection = connections[alias]
+            logged.append((connection, connection.force_debug_cursor,
+                           len(connection.queries_log)))
+            connection.force_debug_cursor = True
+        try:
+            response = self.get_response(request)
+        finally:
+            for connection, forced, start in logged:
+                connection.force_debug_cursor = forced
+                queries = list(connection.queries_log)[start:]
+                timings.db_queries += len(queries)
+                timings.db_seconds += sum(float(query['time'])
+                                          for query in queries)
+            _state.timings = None
+        match = getattr(request, 'resolver_match', None)
+        record(match.view_name if match else '<unresolved>', timings)
+        if self.server_timing:
+            response['Server-Timing'] = timings.server_timing()
+        return response
+
+    def process_template_response(self, request, response):
+        """Time the rendering of a template response."""
+        timings = current()
+        if timings is not None:
+            start = time.time()
+
+            def rendered(response):
+                timings.template_seconds += time.time() - start
+            response.add_post_render_callback(rendered)
+        return response
+
+
+def metrics_view(request):
+    """Serve the totals to Prometheus from INTERNAL_IPS or to staff."""
+    internal = request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS
+    if not enabled() or not (internal or request.user.is_staff):
+        raise Http404
+    return HttpResponse(render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
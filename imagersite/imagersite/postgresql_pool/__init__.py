@@ -0,0 +1 @@
+"""PostgreSQL database backend with per-process connection pooling."""
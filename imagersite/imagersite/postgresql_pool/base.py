@@ -0,0 +1,101 @@
+"""PostgreSQL backend that checks connections out of a per-process pool.
+
+Use it as the ENGINE and configure the pool under a POOL key:
+
+    'ENGINE': 'imagersite.postgresql_pool',
+    'POOL': {'MAX_SIZE': 10, 'TIMEOUT': 10, 'MAX_LIFETIME': 1800,
+             'CHECK_AFTER': 30},
+
+Django still closes the connection at the end of each request; closing
+returns it to the pool instead of hanging up, so the next request skips
+the TCP, TLS and authentication round trips.
+"""
+import threading
+from django.db.backends.postgresql.base import (
+    Database,
+    DatabaseWrapper as PostgresDatabaseWrapper
+)
+from psycopg2 import extensions
+from .pool import ConnectionPool
+
+DEFAULT_POOL = {
+    'MAX_SIZE': 10,
+    'TIMEOUT': 10,
+    'MAX_LIFETIME': 30 * 60,
+    'CHECK_AFTER': 30,
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def is_usable(conn):
+    """Whether a raw psycopg2 connection still answers."""
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except Database.Error:
+        return False
+    return True
+
+
+def get_pool(alias, settings_dict, conn_params):
+    """The pool for a database alias and connection parameters."""
+    key = (alias, repr(sorted(conn_params.items())))
+    with _pools_lock:
+        if key not in _pools:
+            options = dict(DEFAULT_POOL, **settings_dict.get('POOL') or {})
+            _pools[key] = ConnectionPool(
+                connect=lambda: Database.connect(**conn_params),
+                is_usable=is_usable,
+                close=lambda conn: conn.close(),
+                max_size=options['MAX_SIZE'],
+                timeout=options['TIMEOUT'],
+                max_lifetime=options['MAX_LIFETIME'],
+                check_after=options['CHECK_AFTER'])
+        return _pools[key]
+
+
+def close_pools():
+    """Close every idle pooled connection in this process."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+
+class DatabaseWrapper(PostgresDatabaseWrapper):
+    """A PostgreSQL wrapper whose connections come from a pool."""
+
+    def get_new_connection(self, conn_params):
+        """Check a connection out of the pool instead of dialing one."""
+        self._pool = get_pool(self.alias, self.settings_dict, conn_params)
+        connection = self._pool.get()
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        """Hand the connection back, rolled back and healthy, or drop it."""
+        if self.connection is None:
+            return
+        connection = self.connection
+        discard = bool(connection.closed)
+        if not discard:
+            status = connection.get_transaction_status()
+            if status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except Database.Error:
+                    discard = True
+        if not discard and self.errors_occurred:
+            discard = not is_usable(connection)
+        self._pool.put(connection, discard=discard)
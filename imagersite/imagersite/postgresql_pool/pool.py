@@ -0,0 +1,134 @@
+"""A small, fork-aware pool of open database connections."""
+import os
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    """No connection became free before the checkout timeout."""
+
+
+class ConnectionPool(object):
+    """Hand out reusable connections, opening at most max_size of them.
+
+    connect() opens a new connection, is_usable(conn) checks one before it
+    is handed out again and close(conn) discards one. Connections idle for
+    longer than check_after seconds are health checked on checkout, and any
+    connection older than max_lifetime seconds is replaced.
+
+    The pool belongs to the process that created it. A forked child starts
+    over with an empty pool instead of sharing its parent's sockets.
+    """
+
+    def __init__(self, connect, is_usable, close, max_size=10, timeout=10,
+                 max_lifetime=None, check_after=30):
+        """Configure the pool; connections are opened lazily."""
+        self.connect = connect
+        self.is_usable = is_usable
+        self.close = close
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        self._condition = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        """Forget every connection; used at creation and after a fork."""
+        self._pid = os.getpid()
+        self._idle = []
+        self._opened = {}
+        self._size = 0
+
+    def _check_pid(self):
+        """Drop connections inherited from a parent process."""
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _expired(self, conn, now):
+        """Whether a connection has outlived max_lifetime."""
+        return (self.max_lifetime is not None and
+                now - self._opened.get(id(conn), now) > self.max_lifetime)
+
+    def _discard(self, conn):
+        """Close a connection and free its slot."""
+        with self._condition:
+            if self._opened.pop(id(conn), None) is not None:
+                self._size -= 1
+            self._condition.notify()
+        try:
+            self.close(conn)
+        except Exception:
+            pass
+
+    def get(self):
+        """Check out a healthy connection, waiting for a free slot if needed."""
+        deadline = time.time() + self.timeout
+        while True:
+            conn = None
+            with self._condition:
+                self._check_pid()
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            'No database connection free after {}s '
+                            '(pool size {}).'.format(self.timeout,
+                                                     self.max_size))
+                    self._condition.wait(remaining)
+                if self._idle:
+                    conn, returned = self._idle.pop()
+                else:
+                    self._size += 1
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+                with self._condition:
+                    self._opened[id(conn)] = time.time()
+                return conn
+            now = time.time()
+            if self._expired(conn, now):
+                self._discard(conn)
+                continue
+            if now - returned >= self.check_after and not self.is_usable(conn):
+                self._discard(conn)
+                continue
+            return conn
+
+    def put(self, conn, discard=False):
+        """Return a checked out connection, or close it if discard is set."""
+        with self._condition:
+            foreign = (self._pid != os.getpid() or
+                       id(conn) not in self._opened)
+        if foreign:
+            # Closing a socket shared with the parent would break the
+            # parent's session too; just let it go.
+            return
+        if discard or self._expired(conn, time.time()):
+            self._discard(conn)
+            return
+        with self._condition:
+            self._idle.append((conn, time.time()))
+            self._condition.notify()
+
+    def close_all(self):
+        """Close every idle connection."""
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    @property
+    def size(self):
+        """Connections currently open, idle or checked out."""
+        return self._size
+
+    @property
+    def idle(self):
+        """Connections waiting in the pool."""
+        return len(self._idle)
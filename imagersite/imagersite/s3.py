@@ -0,0 +1,205 @@
+"""A shared, pooled boto3 client for the S3 storages.
+
+Every storage instance in a process talks to S3 through one boto3
+resource, and so through one thread-safe client with one connection
+pool. The thumbnail workers, bulk upload threads and parallel static
+uploads therefore reuse warm connections instead of each opening their
+own. The pool size, retries and timeouts come from IMAGER_S3_* settings.
+Objects above IMAGER_S3_MULTIPART_THRESHOLD move as concurrent multipart
+transfers in both directions.
+
+Like the database pool, the client belongs to the process that created
+it; a forked worker builds its own.
+"""
+import atexit
+import os
+import threading
+from gzip import GzipFile
+from tempfile import SpooledTemporaryFile
+from multiprocessing.pool import ThreadPool
+import boto3.session
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from django.conf import settings
+from django.core.files.base import ContentFile
+from storages.backends.s3boto3 import S3Boto3Storage, S3Boto3StorageFile
+
+MB = 1024 * 1024
+
+_lock = threading.Lock()
+_resources = {}
+_pid = [os.getpid()]
+
+
+def client_config(addressing_style=None, signature_version=None):
+    """botocore settings for pooling, retries and timeouts."""
+    return Config(
+        max_pool_connections=getattr(settings,
+                                     'IMAGER_S3_MAX_POOL_CONNECTIONS', 32),
+        retries={'max_attempts': getattr(settings,
+                                         'IMAGER_S3_MAX_ATTEMPTS', 5)},
+        connect_timeout=getattr(settings, 'IMAGER_S3_CONNECT_TIMEOUT', 5),
+        read_timeout=getattr(settings, 'IMAGER_S3_READ_TIMEOUT', 60),
+        s3={'addressing_style': addressing_style},
+        signature_version=signature_version)
+
+
+def transfer_config():
+    """How large objects are split and how many parts move at once."""
+    return TransferConfig(
+        multipart_threshold=getattr(settings, 'IMAGER_S3_MULTIPART_THRESHOLD',
+                                    8 * MB),
+        multipart_chunksize=getattr(settings, 'IMAGER_S3_MULTIPART_CHUNKSIZE',
+                                    8 * MB),
+        max_concurrency=getattr(settings, 'IMAGER_S3_MAX_CONCURRENCY', 10),
+        use_threads=True)
+
+
+def shared_resource(storage):
+    """The process-wide S3 resource for a storage's credentials."""
+    key = (storage.access_key, storage.secret_key, storage.security_token,
+           storage.region_name, storage.endpoint_url, storage.use_ssl,
+           storage.addressing_style, storage.signature_version)
+    with _lock:
+        if _pid[0] != os.getpid():
+            _resources.clear()
+            _pid[0] = os.getpid()
+        resource = _resources.get(key)
+        if resource is None:
+            # Sessions are not thread-safe, so each resource gets its own
+            # and is only ever built under the lock.
+            resource = boto3.session.Session().resource(
+                's3',
+                aws_access_key_id=storage.access_key,
+                aws_secret_access_key=storage.secret_key,
+                aws_session_token=storage.security_token,
+                region_name=storage.region_name,
+                use_ssl=storage.use_ssl,
+                endpoint_url=storage.endpoint_url,
+                config=client_config(storage.addressing_style,
+                                     storage.signature_version))
+            _resources[key] = resource
+        return resource
+
+
+def close_all():
+    """Forget every shared resource."""
+    with _lock:
+        _resources.clear()
+
+
+class PooledS3File(S3Boto3StorageFile):
+    """A stored file downloaded with concurrent ranged requests."""
+
+    def _get_file(self):
+        """Fetch the object on first access."""
+        if self._file is None and 'r' in self._mode:
+            spool = SpooledTemporaryFile(
+                max_size=self._storage.max_memory_size,
+                suffix='.PooledS3File',
+                dir=getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None))
+            self.obj.download_fileobj(spool, Config=transfer_config())
+            spool.seek(0)
+            self._file = spool
+            if self._storage.gzip and self.obj.content_encoding == 'gzip':
+                self._file = GzipFile(mode=self._mode, fileobj=spool,
+                                      mtime=0.0)
+        return super(PooledS3File, self)._get_file()
+
+    file = property(_get_file, S3Boto3StorageFile._set_file)
+
+
+class PooledS3Storage(S3Boto3Storage):
+    """An S3 storage on the shared client, with multipart transfers."""
+
+    file_class = PooledS3File
+
+    @property
+    def connection(self):
+        """The shared resource rather than one per storage instance."""
+        return shared_resource(self)
+
+    def _save_content(self, obj, content, parameters):
+        """Upload with the multipart transfer settings."""
+        put_parameters = parameters.copy() if parameters else {}
+        if self.encryption:
+            put_parameters['ServerSideEncryption'] = 'AES256'
+        if self.reduced_redundancy:
+            put_parameters['StorageClass'] = 'REDUCED_REDUNDANCY'
+        if self.default_acl:
+            put_parameters['ACL'] = self.default_acl
+        content.seek(0, os.SEEK_SET)
+        obj.upload_fileobj(content, ExtraArgs=put_parameters,
+                           Config=transfer_config())
+
+
+class ParallelUploadMixin(object):
+    """Upload files from a thread pool instead of one at a time.
+
+    collectstatic saves every file in turn and then calls post_process(),
+    so saves are queued here and post_process() waits for them all once
+    the storages after this one have post-processed. Saves and deletes of
+    one name still happen in the order they were made.
+    """
+
+    upload_workers = getattr(settings, 'IMAGER_STATIC_UPLOAD_WORKERS', 16)
+
+    def _wait_for(self, name):
+        """Let a queued upload of name finish first."""
+        result = (getattr(self, '_pending', None) or {}).get(name)
+        if result is not None:
+            result.wait()
+
+    def _save(self, name, content):
+        """Queue the upload of a copy of content."""
+        if getattr(self, '_uploads', None) is None:
+            self._uploads = []
+            self._pending = {}
+            self._upload_pool = ThreadPool(self.upload_workers)
+            # Pool threads are daemons; don't let the process exit early.
+            atexit.register(self.wait_for_uploads)
+        self._wait_for(name)
+        copy = ContentFile(content.read(), name=name)
+        if hasattr(content, 'content_type'):
+            copy.content_type = content.content_type
+        save = super(ParallelUploadMixin, self)._save
+        result = self._upload_pool.apply_async(save, (name, copy))
+        self._uploads.append((name, result))
+        self._pending[name] = result
+        return name.replace('\\', '/')
+
+    def exists(self, name):
+        """Queued uploads count as stored."""
+        if name in (getattr(self, '_pending', None) or {}):
+            return True
+        return super(ParallelUploadMixin, self).exists(name)
+
+    def delete(self, name):
+        """Delete a file once its queued upload is done."""
+        self._wait_for(name)
+        return super(ParallelUploadMixin, self).delete(name)
+
+    def wait_for_uploads(self):
+        """Block until queued uploads finish; return (name, error) pairs."""
+        uploads, self._uploads = getattr(self, '_uploads', None) or [], None
+        pool, self._upload_pool = getattr(self, '_upload_pool', None), None
+        failed = []
+        for name, result in uploads:
+            try:
+                result.get()
+            except Exception as error:
+                failed.append((name, error))
+        self._pending = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        return failed
+
+    def post_process(self, paths, dry_run=False, **options):
+        """Post-process, then finish the uploads, reporting any failures."""
+        parent = super(ParallelUploadMixin, self)
+        if hasattr(parent, 'post_process'):
+            for processed in parent.post_process(paths, dry_run, **options):
+                yield processed
+        for name, error in self.wait_for_uploads():
+            yield name, None, error
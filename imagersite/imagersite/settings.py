@@ -51,11 +51,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'imagersite.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'imagersite.db_router.ReplicaMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -92,12 +94,44 @@ DATABASES = {
         'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
         'HOST': os.environ.get('DATABASE_HOST', ''),
         'PORT': '5432',
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', '0')),
         'TEST': {
             'NAME': 'test_db'
         }
     }
 }
 
+# Opt-in connection pooling, sized per process. With threaded servers
+# (e.g. gunicorn --threads 8) give each process as many connections as it
+# has threads; with pre-fork workers (one request at a time) use 1 or 2.
+# Keep DATABASE_POOL_SIZE x processes below the server's max_connections.
+if os.environ.get('DATABASE_POOL', '') == 'True':
+    DATABASES['default'].update({
+        'ENGINE': 'imagersite.postgresql_pool',
+        'CONN_MAX_AGE': 0,
+        'POOL': {
+            'MAX_SIZE': int(os.environ.get('DATABASE_POOL_SIZE', '10')),
+            'TIMEOUT': float(os.environ.get('DATABASE_POOL_TIMEOUT', '10')),
+            'MAX_LIFETIME': int(
+                os.environ.get('DATABASE_POOL_MAX_LIFETIME', '1800')),
+            'CHECK_AFTER': float(
+                os.environ.get('DATABASE_POOL_CHECK_AFTER', '30')),
+        },
+    })
+
+# Read replicas for the public gallery views, as comma separated hosts
+# sharing the primary's credentials. A user's reads stay on the primary
+# for IMAGER_PRIMARY_STICKY_SECONDS after they write.
+IMAGER_REPLICA_DATABASES = []
+for number, host in enumerate(
+        filter(None, os.environ.get('DATABASE_REPLICAS', '').split(',')), 1):
+    alias = 'replica{}'.format(number)
+    DATABASES[alias] = dict(DATABASES['default'], HOST=host.strip(),
+                            TEST={'MIRROR': 'default'})
+    IMAGER_REPLICA_DATABASES.append(alias)
+DATABASE_ROUTERS = ['imagersite.db_router.ReplicaRouter']
+IMAGER_PRIMARY_STICKY_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -138,12 +172,33 @@ if not DEBUG:
     AWS_ACCESS_KEY_ID = os.environ.get('IAM_USER_ACCESS_KEY_ID', '')
     AWS_SECRET_ACCESS_KEY = os.environ.get('IAM_USER_SECRET_ACCESS_KEY', '')
     AWS_S3_CUSTOM_DOMAIN = '%s.s3.amazonaws.com' % AWS_STORAGE_BUCKET_NAME
+    AWS_S3_REGION_NAME = os.environ.get('AWS_S3_REGION_NAME') or None
+    # Point at an S3-compatible server (e.g. MinIO) for local benchmarks.
+    AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL') or None
+
+    # One pooled boto3 client per process, shared by every storage.
+    IMAGER_S3_MAX_POOL_CONNECTIONS = int(
+        os.environ.get('IMAGER_S3_MAX_POOL_CONNECTIONS', '32'))
+    IMAGER_S3_MAX_ATTEMPTS = int(os.environ.get('IMAGER_S3_MAX_ATTEMPTS', '5'))
+    IMAGER_S3_CONNECT_TIMEOUT = 5
+    IMAGER_S3_READ_TIMEOUT = 60
+    IMAGER_S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    IMAGER_S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    IMAGER_S3_MAX_CONCURRENCY = 10
+    IMAGER_STATIC_UPLOAD_WORKERS = 16
+    # Hashed static files are cached for a year; other names this long.
+    IMAGER_STATIC_MAX_AGE = 300
+    IMAGER_STATIC_BROTLI_QUALITY = 11
 
     STATICFILES_LOCATION = 'static'
     STATICFILES_STORAGE = 'imagersite.custom_storages.StaticStorage'
     STATIC_URL = 'https://{}/{}/'.format(AWS_S3_CUSTOM_DOMAIN, STATICFILES_LOCATION)
 
     MEDIAFILES_LOCATION = 'media'
+    # 'public' builds media URLs from the key under the CDN or custom
+    # domain; 'signed' caches presigned URLs for private buckets.
+    IMAGER_MEDIA_URL_MODE = os.environ.get('IMAGER_MEDIA_URL_MODE', 'public')
+    IMAGER_MEDIA_CDN_URL = os.environ.get('IMAGER_MEDIA_CDN_URL') or None
     DEFAULT_FILE_STORAGE = 'imagersite.custom_storages.MediaStorage'
     MEDIA_URL = 'htts://{}/{}/'.format(AWS_S3_CUSTOM_DOMAIN, MEDIAFILES_LOCATION)
 
@@ -159,12 +214,86 @@ else:
     MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 
+# Local memory by default; point CACHE_BACKEND/CACHE_LOCATION at a shared
+# cache (e.g. memcached or a file cache directory) in production.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'imager'),
+    }
+}
+
+# Anonymous public pages are cached until the photos, albums or tags
+# they show change.
+IMAGER_PAGE_CACHE_TIMEOUT = 60 * 60
+
+# The home page tag cloud and popular tags endpoint are cached for this
+# many seconds, holding up to IMAGER_POPULAR_TAGS_LIMIT tags.
+IMAGER_POPULAR_TAGS_TIMEOUT = 5 * 60
+IMAGER_POPULAR_TAGS_LIMIT = 50
+
+# Per-view query, template and storage timings, served at /metrics to
+# INTERNAL_IPS and staff. IMAGER_SERVER_TIMING also adds them to every
+# response in a Server-Timing header.
+IMAGER_METRICS = os.environ.get('IMAGER_METRICS', '') == 'True'
+IMAGER_SERVER_TIMING = os.environ.get('IMAGER_SERVER_TIMING', '') == 'True'
+INTERNAL_IPS = [ip for ip in os.environ.get('INTERNAL_IPS', '').split(',')
+                if ip]
+
+# Text search configuration used to stem titles, tags and descriptions.
+IMAGER_SEARCH_CONFIG = 'english'
+
 # Login redirects
 LOGIN_REDIRECT_URL = 'profile'
 LOGOUT_REDIRECT_URL = 'home'
 
 TAGGIT_CASE_INSENSITIVE = True
 
+# Thumbnails pre-rendered on upload; keep in sync with the templates.
+IMAGER_THUMBNAIL_GEOMETRIES = (
+    ('100x100', {'crop': 'center'}),
+    ('200x200', {'crop': 'center'}),
+    ('500x500', {'crop': 'center'}),
+)
+# Off renders inline; on queues a job for the run_jobs workers.
+IMAGER_THUMBNAIL_ASYNC = True
+
+# Background jobs: retries back off exponentially from IMAGER_JOB_BACKOFF
+# seconds up to IMAGER_JOB_BACKOFF_MAX; running jobs older than
+# IMAGER_JOB_TIMEOUT are presumed abandoned and run again.
+IMAGER_JOB_MAX_ATTEMPTS = 5
+IMAGER_JOB_BACKOFF = 10
+IMAGER_JOB_BACKOFF_MAX = 60 * 60
+IMAGER_JOB_TIMEOUT = 15 * 60
+IMAGER_JOB_POLL_INTERVAL = 1.0
+
+# Responsive variants served through <picture>/srcset. Formats the
+# installed Pillow cannot encode are skipped; JPEG is always rendered.
+IMAGER_VARIANT_WIDTHS = (320, 640, 1024, 1600)
+IMAGER_VARIANT_FORMATS = ('avif', 'webp', 'jpeg')
+IMAGER_VARIANT_QUALITY = {'avif': 50, 'webp': 75, 'jpeg': 80}
+
+# Resumable chunked uploads of photo originals.
+IMAGER_UPLOAD_MAX_SIZE = 200 * 1024 * 1024
+IMAGER_UPLOAD_MAX_CHUNK = 8 * 1024 * 1024
+# expire_uploads discards uploads idle this many seconds; run it from cron.
+IMAGER_UPLOAD_EXPIRES = 24 * 60 * 60
+
+# Hash uploads as they stream in so identical originals are stored once.
+FILE_UPLOAD_HANDLERS = [
+    'imager_images.uploads.HashingMemoryFileUploadHandler',
+    'imager_images.uploads.HashingTemporaryFileUploadHandler',
+]
+
+# Bulk uploads: files per request and storage threads per request.
+IMAGER_BULK_UPLOAD_MAX_FILES = 200
+IMAGER_BULK_UPLOAD_WORKERS = 8
+
+# Browsers upload straight to storage with grants valid this many seconds.
+IMAGER_DIRECT_UPLOAD_EXPIRES = 15 * 60
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_USE_TLS = True
 EMAIL_HOST = 'smtp.gmail.com'
@@ -0,0 +1,192 @@
+"""Compressed, far-future cached static files, uploaded only when changed.
+
+StaticStorage stores every file under a content-hashed name as well
+(ManifestFilesMixin), so a hashed file never changes and is served with
+a year-long immutable Cache-Control; repeat page loads then fetch no
+static bytes at all. Unhashed names keep a short max-age.
+
+During collectstatic each compressible file is stored gzip-encoded,
+which every browser accepts straight from S3, with a brotli copy beside
+it under name + '.br' for a CDN that negotiates Accept-Encoding. The
+compression is deterministic, so an unchanged file compresses to the
+same bytes.
+
+DiffUploadMixin lists the bucket once and skips any upload whose bytes
+already match the stored object's ETag, so a deploy only sends what
+changed. collectstatic deletes a file before copying over it; since an
+S3 PUT overwrites anyway, deletes are held until post-processing ends
+and dropped for every name that was saved again.
+"""
+import atexit
+import gzip
+import hashlib
+import re
+import threading
+from io import BytesIO
+import brotli
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}(\.[^./]+)?$')
+
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/vnd.ms-fontobject',
+    'application/x-font-ttf',
+    'application/x-javascript',
+    'application/xml',
+    'font/otf',
+    'font/ttf',
+    'image/svg+xml',
+    'image/vnd.microsoft.icon',
+    'image/x-icon',
+)
+
+
+def is_hashed(name):
+    """Whether a static name carries its content hash."""
+    return bool(HASHED_NAME.search(name))
+
+
+def cache_control(name):
+    """The Cache-Control header for a static file."""
+    if is_hashed(name):
+        return IMMUTABLE
+    return 'public, max-age={}'.format(
+        getattr(settings, 'IMAGER_STATIC_MAX_AGE', 300))
+
+
+def compressible(content_type):
+    """Whether files of a content type are worth compressing."""
+    content_type = (content_type or '').split(';')[0].strip()
+    return (content_type.startswith('text/') or
+            content_type in COMPRESSIBLE_TYPES)
+
+
+def gzip_bytes(data):
+    """Gzip data the same way every time."""
+    buf = BytesIO()
+    with gzip.GzipFile(mode='wb', compresslevel=9, fileobj=buf,
+                       mtime=0) as packed:
+        packed.write(data)
+    return buf.getvalue()
+
+
+def brotli_bytes(data):
+    """Brotli-compress data."""
+    return brotli.compress(
+        data, quality=getattr(settings, 'IMAGER_STATIC_BROTLI_QUALITY', 11))
+
+
+def md5_hex(data):
+    """The ETag S3 gives an object uploaded in one part."""
+    return hashlib.md5(data).hexdigest()
+
+
+class DiffUploadMixin(object):
+    """Compress and upload static files to S3, skipping unchanged ones.
+
+    Put it before ParallelUploadMixin so the uploads themselves run in the
+    pool, and before ManifestFilesMixin so it sees the hashed files too.
+    """
+
+    preload_metadata = True
+
+    def __init__(self, *args, **kwargs):
+        """Start with nothing listed and nothing deleted."""
+        self._etags = None
+        self._listing_lock = threading.Lock()
+        self._stale = set()
+        self.uploaded = []
+        self.skipped = []
+        super(DiffUploadMixin, self).__init__(*args, **kwargs)
+
+    def remote_etags(self):
+        """The ETag of every stored object by key, listed once."""
+        with self._listing_lock:
+            if self._etags is None:
+                self._etags = {}
+                for summary in self.bucket.objects.filter(
+                        Prefix=self.location):
+                    name = self._decode_name(summary.key)
+                    self._entries.setdefault(name, summary)
+                    self._etags[name] = summary.e_tag.strip('"')
+        return self._etags
+
+    @property
+    def entries(self):
+        """Stored objects from the same single listing."""
+        self.remote_etags()
+        return self._entries
+
+    def exists(self, name):
+        """Deleted files are gone even before the delete is sent."""
+        if self._clean_name(name) in self._stale:
+            return False
+        return super(DiffUploadMixin, self).exists(name)
+
+    def delete(self, name):
+        """Hold the delete until post-processing is over."""
+        if not self._stale:
+            atexit.register(self.delete_stale)
+        self._stale.add(self._clean_name(name))
+
+    def delete_stale(self):
+        """Send the deletes of files that were not saved again."""
+        while self._stale:
+            name = self._stale.pop()
+            super(DiffUploadMixin, self).delete(name)
+            key = self._normalize_name(name)
+            self._entries.pop(key, None)
+            self.remote_etags().pop(key, None)
+
+    def _save(self, name, content):
+        """Saving a file cancels its pending delete."""
+        self._stale.discard(self._clean_name(name))
+        return super(DiffUploadMixin, self)._save(name, content)
+
+    def _save_content(self, obj, content, parameters):
+        """Store the file compressed and cacheable, with a brotli copy."""
+        content.seek(0)
+        data = content.read()
+        name = self._decode_name(obj.key)
+        parameters = dict(parameters or {}, CacheControl=cache_control(name))
+        body = data
+        packable = (compressible(parameters.get('ContentType')) and
+                    'ContentEncoding' not in parameters)
+        if packable:
+            packed = gzip_bytes(data)
+            if len(packed) < len(data):
+                body = packed
+                parameters['ContentEncoding'] = 'gzip'
+        self._put_if_changed(obj, body, parameters)
+        if packable:
+            packed = brotli_bytes(data)
+            if len(packed) < len(data):
+                self._put_if_changed(
+                    self.bucket.Object(obj.key + '.br'), packed,
+                    dict(parameters, ContentEncoding='br'))
+
+    def _put_if_changed(self, obj, body, parameters):
+        """Upload body unless the stored object already holds it."""
+        name = self._decode_name(obj.key)
+        digest = md5_hex(body)
+        if self.remote_etags().get(name) == digest:
+            self.skipped.append(name)
+            return
+        super(DiffUploadMixin, self)._save_content(obj, ContentFile(body),
+                                                   parameters)
+        self._etags[name] = digest
+        self.uploaded.append(name)
+
+    def post_process(self, paths, dry_run=False, **options):
+        """Post-process, then send the deletes that still apply."""
+        parent = super(DiffUploadMixin, self)
+        if hasattr(parent, 'post_process'):
+            for processed in parent.post_process(paths, dry_run, **options):
+                yield processed
+        if not dry_run:
+            self.delete_stale()
@@ -0,0 +1,116 @@
+"""URL building for S3 storages without network calls.
+
+The S3 storages sign every URL afresh, and can look the bucket up over
+the network first. FastUrlMixin replaces that with one of two modes, set
+by url_mode (IMAGER_MEDIA_URL_MODE):
+
+'public' builds the URL from the key alone, under cdn_url
+(IMAGER_MEDIA_CDN_URL) or the storage's custom domain. It suits
+public-read objects behind a CDN.
+
+'signed' signs from the configured bucket name without any lookup, and
+caches each URL until half its lifetime has passed, so every URL handed
+out stays valid for at least half of querystring_expire. Anything
+caching HTML that holds media URLs must cap its timeout with
+cache_timeout() so a cached page never outlives its signatures.
+
+Any other mode, or a call passing extra arguments, uses the storage's
+own url().
+"""
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.encoding import filepath_to_uri
+
+
+def cache_timeout(timeout):
+    """Cap timeout to how long every media URL handed out now stays valid."""
+    if getattr(settings, 'IMAGER_MEDIA_URL_MODE', None) != 'signed':
+        return timeout
+    lifetime = int(getattr(settings, 'AWS_QUERYSTRING_EXPIRE', 3600) / 2)
+    if timeout is None:
+        return lifetime
+    return min(timeout, lifetime)
+
+
+class UrlCache(object):
+    """A bounded, least recently used map of names to expiring URLs."""
+
+    def __init__(self, max_size=10000, clock=time.time):
+        """Hold at most max_size URLs."""
+        self.max_size = max_size
+        self.clock = clock
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """The cached URL for name, unless it is missing or stale."""
+        with self._lock:
+            entry = self._urls.get(name)
+            if entry is None:
+                return None
+            url, fresh_until = entry
+            if fresh_until <= self.clock():
+                del self._urls[name]
+                return None
+            # Reinsert to mark as recently used.
+            del self._urls[name]
+            self._urls[name] = entry
+            return url
+
+    def set(self, name, url, ttl):
+        """Cache a URL for ttl seconds, evicting the least recently used."""
+        with self._lock:
+            self._urls.pop(name, None)
+            self._urls[name] = (url, self.clock() + ttl)
+            while len(self._urls) > self.max_size:
+                self._urls.popitem(last=False)
+
+    def __len__(self):
+        """Number of cached URLs."""
+        return len(self._urls)
+
+
+class FastUrlMixin(object):
+    """Build public or cached signed URLs without touching the network."""
+
+    url_mode = getattr(settings, 'IMAGER_MEDIA_URL_MODE', None)
+    cdn_url = getattr(settings, 'IMAGER_MEDIA_CDN_URL', None)
+    url_cache_size = getattr(settings, 'IMAGER_SIGNED_URL_CACHE_SIZE', 10000)
+
+    def url_key(self, name):
+        """The bucket key for a storage name."""
+        return self._normalize_name(self._clean_name(name))
+
+    def public_url(self, name):
+        """The URL of a public object, from its key alone."""
+        base = self.cdn_url or '{}//{}'.format(
+            self.url_protocol,
+            self.custom_domain or '{}.s3.amazonaws.com'.format(
+                self.bucket_name))
+        return '{}/{}'.format(base.rstrip('/'),
+                              filepath_to_uri(self.url_key(name)))
+
+    def signed_url(self, name):
+        """A signed URL for a private object, cached for half its life."""
+        if getattr(self, '_url_cache', None) is None:
+            self._url_cache = UrlCache(self.url_cache_size)
+        url = self._url_cache.get(name)
+        if url is None:
+            url = self.connection.meta.client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': self.bucket_name,
+                        'Key': self._encode_name(self.url_key(name))},
+                ExpiresIn=self.querystring_expire)
+            self._url_cache.set(name, url, self.querystring_expire / 2.0)
+        return url
+
+    def url(self, name, *args, **kwargs):
+        """Route plain URL requests through the configured mode."""
+        if not any(args) and not any(kwargs.values()):
+            if self.url_mode == 'public':
+                return self.public_url(name)
+            if self.url_mode == 'signed':
+                return self.signed_url(name)
+        return super(FastUrlMixin, self).url(name, *args, **kwargs)
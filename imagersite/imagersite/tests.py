@@ -1,5 +1,21 @@
 """Tests for config route and registration."""
-from django.test import TestCase, Client, RequestFactory
+from django.core.cache import cache
+from django.contrib.staticfiles.storage import (
+    ManifestFilesMixin,
+    StaticFilesStorage
+)
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    Client,
+    RequestFactory,
+    override_settings
+)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.models import User
 from imagersite.settings import MEDIA_ROOT
@@ -7,11 +23,23 @@ from django.core import mail
 from bs4 import BeautifulSoup
 from imagersite.views import HomeView
 from imager_images.models import Photo
+from imagersite.postgresql_pool.pool import ConnectionPool, PoolTimeout
+from imagersite import db_router, metrics, s3, static_assets, storage_urls
+from imager_images import page_cache
+from imager_images.tests import use_temp_media
+from imager_images.views import PhotoEdit, PhotoListView
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
+from botocore.stub import ANY, Stubber
 import faker
 import datetime
 import factory
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 
 HERE = os.path.dirname(__file__)
 
@@ -132,6 +160,7 @@ class LoginLogout(TestCase):
 
     def setUp(self):
         """Create a client instance."""
+        use_temp_media(self)
         user = User(
             username='mcgee',
             email='mcgee@mcgee.com'
@@ -153,11 +182,6 @@ class LoginLogout(TestCase):
         self.photos_1 = photos_1
         self.photos_2 = photos_2
 
-    def tearDown(self):
-        """Teardown when tests complete."""
-        to_delete = os.path.join(MEDIA_ROOT, 'user_images', 'example*.jpg')
-        os.system('rm -rf ' + to_delete)
-
     def test_home_view_returns_status_code_200(self):
         """Test home view has status 200."""
         request = RequestFactory().get('/')
@@ -213,4 +237,611 @@ class LoginLogout(TestCase):
         test_user.set_password('helloiammorgan')
         test_user.save()
         response = self.client.post(reverse('login'), {'username': 'morgan', 'password': 'helloiammorgan'}, follow=True)
-        self.assertTrue(response.request['PATH_INFO'] == '/profile/')
\ No newline at end of file
+        self.assertTrue(response.request['PATH_INFO'] == '/profile/')
+
+class HomeViewImages(TestCase):
+    """Tests for the home page hero image."""
+
+    def setUp(self):
+        """Create a user with private and public photos."""
+        use_temp_media(self)
+        user = User(
+            username='mcgee',
+            email='mcgee@mcgee.com'
+        )
+        user.save()
+        self.user = user
+        self.private = []
+        self.public = []
+        for i in range(4):
+            photo = PhotoFactory.build()
+            photo.user = self.user
+            photo.save()
+            self.private.append(photo)
+        for i in range(4):
+            photo = PhotoFactory.build()
+            photo.user = self.user
+            photo.published = 'PB'
+            photo.save()
+            self.public.append(photo)
+
+    def test_home_view_only_samples_public_photos(self):
+        """Home page images only come from public photos."""
+        public_urls = set(photo.photo.url for photo in self.public)
+        for i in range(10):
+            response = self.client.get(reverse('home'))
+            for url in response.context['image']:
+                self.assertIn(url, public_urls)
+
+    def test_home_view_samples_handful_of_photos(self):
+        """Home page resolves at most sample_size photo urls."""
+        response = self.client.get(reverse('home'))
+        self.assertTrue(1 <= len(response.context['image']) <= HomeView.sample_size)
+
+    def test_home_view_no_public_photos(self):
+        """Home page falls back to the default image without public photos."""
+        Photo.objects.filter(published='PB').delete()
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['image'], [])
+
+    def test_random_public_query_count_is_constant(self):
+        """Picking photos costs the same with more photos in the table."""
+        for i in range(10):
+            photo = PhotoFactory.build()
+            photo.user = self.user
+            photo.published = 'PB'
+            photo.save()
+        with CaptureQueriesContext(connection) as queries:
+            Photo.objects.random_public(HomeView.sample_size)
+        self.assertTrue(len(queries) <= 1 + HomeView.sample_size * 2)
+
+
+class FakeConnection(object):
+    """Stands in for a database connection."""
+
+    def __init__(self):
+        """Start open."""
+        self.closed = False
+
+
+class ConnectionPooling(SimpleTestCase):
+    """Test the per-process connection pool."""
+
+    def setUp(self):
+        """Build a pool around fake connections."""
+        self.opened = []
+        self.healthy = True
+
+        def connect():
+            conn = FakeConnection()
+            self.opened.append(conn)
+            return conn
+
+        def close(conn):
+            conn.closed = True
+
+        self.pool = ConnectionPool(connect, lambda conn: self.healthy, close,
+                                   max_size=2, timeout=0.05, check_after=0)
+
+    def test_returned_connection_is_reused(self):
+        """A connection put back is handed out again without reconnecting."""
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.assertIs(self.pool.get(), conn)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_pool_never_exceeds_max_size(self):
+        """Checkouts beyond the max size time out."""
+        self.pool.get()
+        self.pool.get()
+        with self.assertRaises(PoolTimeout):
+            self.pool.get()
+        self.assertEqual(self.pool.size, 2)
+
+    def test_waiting_checkout_gets_released_connection(self):
+        """A blocked checkout proceeds once another thread returns one."""
+        self.pool.timeout = 2
+        first = self.pool.get()
+        self.pool.get()
+        timer = threading.Timer(0.05, self.pool.put, [first])
+        timer.start()
+        self.assertIs(self.pool.get(), first)
+        timer.join()
+
+    def test_unhealthy_connection_is_replaced(self):
+        """A connection failing its health check is closed and replaced."""
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.healthy = False
+        replacement = self.pool.get()
+        self.assertIsNot(replacement, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.pool.size, 1)
+
+    def test_discarded_connection_frees_slot(self):
+        """Broken connections are closed rather than pooled."""
+        conn = self.pool.get()
+        self.pool.put(conn, discard=True)
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.pool.size, 0)
+        self.assertEqual(self.pool.idle, 0)
+
+    def test_old_connection_is_recycled(self):
+        """Connections past their max lifetime are not reused."""
+        self.pool.max_lifetime = 0
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.assertTrue(conn.closed)
+        self.assertIsNot(self.pool.get(), conn)
+
+    def test_forked_child_starts_empty(self):
+        """A child process does not reuse its parent's connections."""
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.pool._pid = -1
+        self.assertIsNot(self.pool.get(), conn)
+        self.assertFalse(conn.closed)
+
+    def test_benchmark_needs_postgres(self):
+        """The connection benchmark refuses to run on other databases."""
+        if connection.vendor == 'postgresql':
+            self.skipTest('Running against PostgreSQL.')
+        with self.assertRaises(CommandError):
+            call_command('benchmark_connections', threads=1, requests=1)
+
+
+@override_settings(IMAGER_REPLICA_DATABASES=['replica'],
+                   IMAGER_PRIMARY_STICKY_SECONDS=10)
+class ReplicaRouting(SimpleTestCase):
+    """Test reads are sent to replicas only when it is safe."""
+
+    def setUp(self):
+        """Build a router, middleware and request factory."""
+        self.router = db_router.ReplicaRouter()
+        self.responses = []
+        self.middleware = db_router.ReplicaMiddleware(self.get_response)
+        self.factory = RequestFactory()
+
+    def get_response(self, request):
+        """Record whether replica reads were on while handling a request."""
+        self.responses.append(db_router.replicas_enabled())
+        return 'response'
+
+    def request(self, method, view, session=None):
+        """Run a request through the middleware for a view."""
+        request = getattr(self.factory, method)('/')
+        request.session = session if session is not None else {}
+        self.middleware.process_view(request, view.as_view(), (), {})
+        self.middleware(request)
+        return request
+
+    def test_reads_use_primary_by_default(self):
+        """Without an opted-in view, reads stay on the primary."""
+        self.assertEqual(self.router.db_for_read(Photo), 'default')
+
+    def test_reads_use_replica_when_enabled(self):
+        """Reads go to a replica when the thread allows it."""
+        with db_router.use_replicas():
+            self.assertEqual(self.router.db_for_read(Photo), 'replica')
+        self.assertFalse(db_router.replicas_enabled())
+
+    def test_writes_use_primary(self):
+        """Writes always go to the primary."""
+        with db_router.use_replicas():
+            self.assertEqual(self.router.db_for_write(Photo), 'default')
+
+    def test_replicas_are_not_migrated(self):
+        """Migrations only run on the primary."""
+        self.assertTrue(self.router.allow_migrate('default', 'imager_images'))
+        self.assertFalse(self.router.allow_migrate('replica', 'imager_images'))
+
+    def test_read_only_view_uses_replicas(self):
+        """A GET to a read-only view reads from replicas."""
+        self.request('get', PhotoListView)
+        self.assertEqual(self.responses, [True])
+        self.assertFalse(db_router.replicas_enabled())
+
+    def test_other_views_use_primary(self):
+        """Views that write are never sent to replicas."""
+        self.request('get', PhotoEdit)
+        self.assertEqual(self.responses, [False])
+
+    def test_write_pins_session_to_primary(self):
+        """After a write, the same user reads from the primary."""
+        request = self.request('post', PhotoEdit)
+        self.assertGreater(request.session[db_router.SESSION_KEY], time.time())
+        self.request('get', PhotoListView, request.session)
+        self.assertEqual(self.responses, [False, False])
+
+    def test_pin_expires(self):
+        """Once the sticky window passes, replicas are used again."""
+        session = {db_router.SESSION_KEY: time.time() - 1}
+        self.request('get', PhotoListView, session)
+        self.assertEqual(self.responses, [True])
+
+    def test_cache_fill_after_change_uses_primary(self):
+        """Refilling a cache just after it was invalidated reads the primary."""
+        cache.clear()
+        db_router.note_changed(['cloud'])
+        with db_router.use_replicas():
+            with db_router.primary_if_changed(['cloud', 'other']):
+                self.assertEqual(self.router.db_for_read(Photo), 'default')
+            with db_router.primary_if_changed(['other']):
+                self.assertEqual(self.router.db_for_read(Photo), 'replica')
+            self.assertTrue(db_router.replicas_enabled())
+
+    def test_old_change_lets_cache_fill_use_replica(self):
+        """Once the change is older than the sticky window, replicas serve."""
+        cache.clear()
+        cache.set(db_router.CHANGED_KEY.format('cloud'), time.time() - 11)
+        with db_router.use_replicas():
+            with db_router.primary_if_changed(['cloud']):
+                self.assertEqual(self.router.db_for_read(Photo), 'replica')
+
+    def test_page_cache_bump_is_noted(self):
+        """Bumping a page scope marks it as changed for routing."""
+        cache.clear()
+        page_cache.bump('photos')
+        with db_router.use_replicas():
+            with db_router.primary_if_changed(['page:photos']):
+                self.assertFalse(db_router.replicas_enabled())
+
+    @override_settings(IMAGER_REPLICA_DATABASES=[])
+    def test_no_replicas_notes_nothing(self):
+        """Without replicas configured, changes are not recorded."""
+        cache.clear()
+        db_router.note_changed(['cloud'])
+        self.assertIsNone(cache.get(db_router.CHANGED_KEY.format('cloud')))
+
+    @override_settings(IMAGER_REPLICA_DATABASES=[])
+    def test_no_replicas_leaves_session_alone(self):
+        """Without replicas configured, sessions are not touched."""
+        request = self.request('post', PhotoEdit)
+        self.assertEqual(request.session, {})
+
+
+class InstrumentedStorage(metrics.InstrumentedStorageMixin, FileSystemStorage):
+    """A local storage whose calls are timed."""
+
+
+@override_settings(IMAGER_METRICS=True, IMAGER_SERVER_TIMING=True,
+                   INTERNAL_IPS=['127.0.0.1'])
+class RequestMetrics(TestCase):
+    """Test per-view query, template and storage timings."""
+
+    def setUp(self):
+        """Start from empty totals with a public photo to list."""
+        use_temp_media(self)
+        cache.clear()
+        metrics.reset()
+        self.user = UserFactory.create()
+        PhotoFactory.create(user=self.user, published='PB')
+
+    def tearDown(self):
+        """Forget the totals these tests recorded."""
+        metrics.reset()
+
+    def test_totals_per_url_name(self):
+        """Queries and template time are totalled by URL name."""
+        self.client.force_login(self.user)
+        self.client.get(reverse('photos'))
+        first = metrics.snapshot()['photos']
+        self.client.get(reverse('photos'))
+        totals = metrics.snapshot()['photos']
+        self.assertEqual(totals['requests'], 2)
+        self.assertGreater(first['db_queries'], 0)
+        self.assertGreater(totals['db_queries'], first['db_queries'])
+        self.assertGreater(totals['template_seconds'], 0)
+
+    def test_cached_page_render_is_timed(self):
+        """A page cache miss still reports its template time."""
+        from django.template.backends.django import Template
+        render = Template.render
+
+        def slow_render(*args, **kwargs):
+            time.sleep(0.05)
+            return render(*args, **kwargs)
+        Template.render = slow_render
+        self.addCleanup(setattr, Template, 'render', render)
+        self.client.get(reverse('photos'))
+        self.assertGreaterEqual(
+            metrics.snapshot()['photos']['template_seconds'], 0.05)
+
+    def test_server_timing_header(self):
+        """Responses carry the request's timings."""
+        response = self.client.get(reverse('photos'))
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('total;dur=', response['Server-Timing'])
+
+    @override_settings(IMAGER_SERVER_TIMING=False)
+    def test_server_timing_optional(self):
+        """The header is only sent when asked for."""
+        response = self.client.get(reverse('photos'))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_prometheus_endpoint(self):
+        """The endpoint lists every total in the text format."""
+        self.client.get(reverse('home'))
+        response = self.client.get(reverse('metrics'))
+        body = response.content.decode('utf-8')
+        self.assertIn('# TYPE imager_view_db_queries_total counter', body)
+        self.assertIn('imager_view_requests_total{view="home"} 1.0', body)
+
+    def test_endpoint_hidden_from_public(self):
+        """Other addresses get a 404 unless they are staff."""
+        response = self.client.get(reverse('metrics'),
+                                   REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 404)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('metrics'),
+                                   REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(IMAGER_METRICS=False)
+    def test_disabled(self):
+        """With metrics off nothing is recorded and the endpoint is gone."""
+        self.client.get(reverse('photos'))
+        self.assertEqual(metrics.snapshot(), {})
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    def test_storage_calls(self):
+        """Storage calls made during a request are counted."""
+        storage = InstrumentedStorage(location=MEDIA_ROOT)
+        timings = metrics._state.timings = metrics.RequestTimings()
+        try:
+            storage.exists('missing.jpg')
+            storage.exists('other.jpg')
+        finally:
+            metrics._state.timings = None
+        self.assertEqual(timings.storage_calls, 2)
+        storage.exists('missing.jpg')
+        self.assertEqual(timings.storage_calls, 2)
+
+
+class StorageUrls(SimpleTestCase):
+    """Test media URLs are built without network calls."""
+
+    def storage(self, **options):
+        """An S3 storage with fast URLs that must never reach the network."""
+        class Storage(storage_urls.FastUrlMixin, s3.PooledS3Storage):
+            @property
+            def bucket(self):
+                raise AssertionError('Looked up the bucket.')
+
+        options.setdefault('location', 'media')
+        return Storage(bucket='imager', access_key='key', secret_key='secret',
+                       region_name='us-east-1', **options)
+
+    def test_public_url_from_key(self):
+        """Public URLs are the CDN base plus the key."""
+        storage = self.storage(url_mode='public',
+                               cdn_url='https://cdn.example.com/')
+        self.assertEqual(storage.url('user_images/a b.jpg'),
+                         'https://cdn.example.com/media/user_images/a%20b.jpg')
+
+    def test_public_url_defaults_to_bucket_domain(self):
+        """Without a CDN the bucket's own domain is used."""
+        storage = self.storage(url_mode='public')
+        self.assertEqual(storage.url('a.jpg'),
+                         'https://imager.s3.amazonaws.com/media/a.jpg')
+
+    def test_signed_urls_are_cached(self):
+        """A signed URL is reused instead of being signed again."""
+        storage = self.storage(url_mode='signed', querystring_expire=3600)
+        url = storage.url('a.jpg')
+        self.assertIn('Signature=', url)
+        client = storage.connection.meta.client
+        client.generate_presigned_url = None
+        try:
+            self.assertEqual(storage.url('a.jpg'), url)
+        finally:
+            del client.generate_presigned_url
+
+    def test_extra_arguments_bypass_cache(self):
+        """Extra parameters fall back to the storage's own URL building."""
+        storage = self.storage(url_mode='signed')
+        with self.assertRaises(AssertionError):
+            storage.url('a.jpg', parameters={'ResponseContentType': 'a/b'})
+
+    def test_cache_timeout_capped_when_signing(self):
+        """HTML with signed URLs is cached for at most half their life."""
+        with override_settings(IMAGER_MEDIA_URL_MODE='public'):
+            self.assertEqual(storage_urls.cache_timeout(3600), 3600)
+            self.assertIsNone(storage_urls.cache_timeout(None))
+        with override_settings(IMAGER_MEDIA_URL_MODE='signed',
+                               AWS_QUERYSTRING_EXPIRE=600):
+            self.assertEqual(storage_urls.cache_timeout(3600), 300)
+            self.assertEqual(storage_urls.cache_timeout(60), 60)
+            self.assertEqual(storage_urls.cache_timeout(None), 300)
+
+    def test_url_cache_expires(self):
+        """Cached URLs go stale after their time to live."""
+        now = [1000.0]
+        cache = storage_urls.UrlCache(clock=lambda: now[0])
+        cache.set('a.jpg', 'url', 60)
+        self.assertEqual(cache.get('a.jpg'), 'url')
+        now[0] += 61
+        self.assertIsNone(cache.get('a.jpg'))
+        self.assertEqual(len(cache), 0)
+
+    def test_url_cache_evicts_least_recently_used(self):
+        """The cache stays within its size, dropping the oldest use."""
+        cache = storage_urls.UrlCache(max_size=2)
+        cache.set('a', 'A', 60)
+        cache.set('b', 'B', 60)
+        cache.get('a')
+        cache.set('c', 'C', 60)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'C')
+
+
+class PooledS3(SimpleTestCase):
+    """Test the shared S3 client and parallel static uploads."""
+
+    def tearDown(self):
+        """Remove files uploaded to local storage."""
+        s3.close_all()
+        for name in ['parallel-0.txt', 'parallel-1.txt', 'parallel-2.txt']:
+            if os.path.exists(os.path.join(MEDIA_ROOT, name)):
+                os.remove(os.path.join(MEDIA_ROOT, name))
+
+    def storage(self, **options):
+        """An S3 storage that is never asked to reach the network."""
+        options.setdefault('access_key', 'key')
+        return s3.PooledS3Storage(bucket='imager', secret_key='secret',
+                                  region_name='us-east-1', **options)
+
+    def test_storages_share_one_client(self):
+        """Storages with the same credentials reuse one connection pool."""
+        first, second = self.storage(), self.storage(location='media')
+        self.assertIs(first.connection, second.connection)
+        other = self.storage(access_key='other')
+        self.assertIsNot(first.connection, other.connection)
+
+    @override_settings(IMAGER_S3_MAX_POOL_CONNECTIONS=7,
+                       IMAGER_S3_MAX_ATTEMPTS=3)
+    def test_client_config_from_settings(self):
+        """Pool size and retries come from settings."""
+        config = self.storage().connection.meta.client.meta.config
+        self.assertEqual(config.max_pool_connections, 7)
+        self.assertEqual(config.retries, {'max_attempts': 3})
+
+    def test_parallel_uploads_finish_in_post_process(self):
+        """Queued saves are all written once post_process runs."""
+        class Storage(s3.ParallelUploadMixin, FileSystemStorage):
+            upload_workers = 2
+
+        storage = Storage(location=MEDIA_ROOT)
+        names = ['parallel-{}.txt'.format(i) for i in range(3)]
+        for name in names:
+            storage.save(name, SimpleUploadedFile(name, b'static'))
+        self.assertEqual(list(storage.post_process(names)), [])
+        for name in names:
+            with storage.open(name) as saved:
+                self.assertEqual(saved.read(), b'static')
+
+    def test_failed_uploads_are_reported(self):
+        """post_process yields the error of an upload that failed."""
+        class Broken(FileSystemStorage):
+            def _save(self, name, content):
+                raise IOError('Bucket unavailable.')
+
+        class Storage(s3.ParallelUploadMixin, Broken):
+            upload_workers = 1
+
+        storage = Storage(location=MEDIA_ROOT)
+        storage.save('parallel-0.txt', SimpleUploadedFile('a', b'static'))
+        processed = list(storage.post_process(['parallel-0.txt']))
+        self.assertEqual(processed[0][0], 'parallel-0.txt')
+        self.assertIsInstance(processed[0][2], IOError)
+
+
+class ParallelManifestStorage(s3.ParallelUploadMixin, ManifestFilesMixin,
+                              StaticFilesStorage):
+    """Hashed static files saved from a thread pool."""
+
+    upload_workers = 4
+
+
+class StaticAssets(SimpleTestCase):
+    """Test hashed, compressed and diff-based static uploads."""
+
+    css = b'body { color: #333; }\n' * 50
+
+    def tearDown(self):
+        """Drop the stubbed client."""
+        s3.close_all()
+
+    def storage(self, stored=()):
+        """A static storage whose bucket holds the given (key, body)s."""
+        class Storage(static_assets.DiffUploadMixin, s3.PooledS3Storage):
+            location = 'static'
+
+        storage = Storage(bucket='imager', access_key='static',
+                          secret_key='secret', region_name='us-east-1')
+        stubber = Stubber(storage.connection.meta.client)
+        stubber.add_response('list_objects', {'Contents': [
+            {'Key': key, 'ETag': '"{}"'.format(static_assets.md5_hex(body)),
+             'Size': len(body), 'LastModified': datetime.datetime(2017, 1, 1)}
+            for key, body in stored]})
+        stubber.activate()
+        return storage, stubber
+
+    def test_hashed_names_are_immutable(self):
+        """Only content-hashed names get the far-future header."""
+        self.assertEqual(static_assets.cache_control('css/app.0123456789ab.css'),
+                         static_assets.IMMUTABLE)
+        self.assertNotIn('immutable', static_assets.cache_control('css/app.css'))
+        self.assertNotIn('immutable',
+                         static_assets.cache_control('staticfiles.json'))
+
+    def test_gzip_is_deterministic(self):
+        """The same bytes always compress to the same ETag."""
+        self.assertEqual(static_assets.gzip_bytes(self.css),
+                         static_assets.gzip_bytes(self.css))
+        self.assertTrue(static_assets.compressible('text/css'))
+        self.assertFalse(static_assets.compressible('image/png'))
+
+    def test_unchanged_files_are_not_uploaded(self):
+        """Files whose compressed bytes match the bucket are skipped."""
+        storage, stubber = self.storage([
+            ('static/app.css', static_assets.gzip_bytes(self.css)),
+            ('static/app.css.br', static_assets.brotli_bytes(self.css))])
+        storage.save('app.css', ContentFile(self.css))
+        stubber.assert_no_pending_responses()
+        self.assertEqual(storage.skipped, ['static/app.css',
+                                           'static/app.css.br'])
+        self.assertEqual(storage.uploaded, [])
+
+    def test_changed_files_are_uploaded_compressed(self):
+        """A new file is stored gzip-encoded with a brotli copy."""
+        storage, stubber = self.storage()
+        for key, encoding in [('static/app.0123456789ab.css', 'gzip'),
+                              ('static/app.0123456789ab.css.br', 'br')]:
+            stubber.add_response('put_object', {}, {
+                'Bucket': 'imager', 'Key': key, 'Body': ANY,
+                'ACL': 'public-read', 'ContentType': 'text/css', 'ContentEncoding': encoding,
+                'CacheControl': static_assets.IMMUTABLE})
+        storage.save('app.0123456789ab.css', ContentFile(self.css))
+        stubber.assert_no_pending_responses()
+        self.assertEqual(len(storage.uploaded), 2)
+
+    def test_deletes_wait_and_are_dropped_when_saved_again(self):
+        """collectstatic's delete before a copy never reaches S3."""
+        storage, stubber = self.storage([
+            ('static/app.css', static_assets.gzip_bytes(self.css)),
+            ('static/app.css.br', static_assets.brotli_bytes(self.css)),
+            ('static/old.css', b'old')])
+        self.assertTrue(storage.exists('app.css'))
+        storage.delete('app.css')
+        storage.delete('old.css')
+        self.assertFalse(storage.exists('app.css'))
+        storage.save('app.css', ContentFile(self.css))
+        stubber.add_response('delete_object', {},
+                             {'Bucket': 'imager', 'Key': 'static/old.css'})
+        self.assertEqual(list(storage.post_process({})), [])
+        stubber.assert_no_pending_responses()
+        self.assertTrue(storage.exists('app.css'))
+        self.assertFalse(storage.exists('old.css'))
+
+    def test_collectstatic_hashes_with_parallel_uploads(self):
+        """Hashed copies and the manifest are written before it returns."""
+        root = tempfile.mkdtemp()
+        try:
+            with self.settings(
+                    STATIC_ROOT=root,
+                    STATICFILES_STORAGE='imagersite.tests.'
+                                        'ParallelManifestStorage'):
+                call_command('collectstatic', interactive=False, verbosity=0)
+            with open(os.path.join(root, 'staticfiles.json')) as manifest:
+                paths = json.load(manifest)['paths']
+            self.assertTrue(paths)
+            for name, hashed in paths.items():
+                self.assertTrue(static_assets.is_hashed(hashed))
+                self.assertTrue(os.path.exists(os.path.join(root, name)))
+                self.assertTrue(os.path.exists(os.path.join(root, hashed)))
+        finally:
+            shutil.rmtree(root)
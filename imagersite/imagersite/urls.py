@@ -18,6 +18,7 @@ from django.conf.urls import url, include
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.contrib.auth import views as auth_views
+from imagersite.metrics import metrics_view
 from imagersite.views import HomeView
 
 
@@ -30,7 +31,8 @@ urlpatterns = [
     url(r'^logout/$', auth_views.LogoutView.as_view(
         template_name='imagersite/home.html'), name='logout'),
     url(r'^profile/', include('imager_profile.urls')),
-    url(r'^images/', include('imager_images.urls'))
+    url(r'^images/', include('imager_images.urls')),
+    url(r'^metrics$', metrics_view, name='metrics')
 ]
 
 if settings.DEBUG:
@@ -2,16 +2,22 @@
 from django.shortcuts import render
 from django.views.generic.base import TemplateView
 from imager_images.models import Photo
+from imager_images.tag_cloud import popular_tags
 
 
 class HomeView(TemplateView):
     """View for the home page."""
+    read_replica = True
     template_name = 'imagersite/home.html'
+    sample_size = 3
+    tag_limit = 30
 
     def get_context_data(self, **kwargs):
-        photos = Photo.objects.all()
+        """Build context with sample public photos and the popular tags."""
         context = super(HomeView, self).get_context_data(**kwargs)
-        context['image'] = [photos[i].photo.url for i in range(len(photos))]
+        photos = Photo.objects.random_public(self.sample_size)
+        context['image'] = [photo.photo.url for photo in photos]
+        context['tags'] = popular_tags(self.tag_limit)
 
         return context
 